@@ -0,0 +1,94 @@
+import select
+from time import sleep
+
+# Post changes streamed from the firehose to the feeds service over Postgres NOTIFY, so the feeds
+# service's in-memory timelines stay in sync without re-reading the posts table. Each notification
+# payload is a batch of tab-separated lines:
+#   +<TAB>author<TAB>rkey<TAB>cid_key<TAB>subject_author<TAB>subject_rkey<TAB>created_at (epoch seconds)
+#   -<TAB>uri
+# with rkeys and cid_keys as the integers stored in the posts table (see storage.py), and the subject fields
+# empty for posts.
+
+POSTS_CHANGED_CHANNEL = 'posts_changed'
+
+# NOTIFY payloads must be shorter than 8000 bytes
+_MAX_PAYLOAD_BYTES = 7900
+
+def _chunk_lines(lines: list[str]) -> list[str]:
+    payloads = []
+    chunk = []
+    chunk_size = 0
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if chunk_size + line_size > _MAX_PAYLOAD_BYTES and len(chunk) > 0:
+            payloads.append('\n'.join(chunk))
+            chunk = []
+            chunk_size = 0
+        chunk.append(line)
+        chunk_size += line_size
+    if len(chunk) > 0:
+        payloads.append('\n'.join(chunk))
+    return payloads
+
+# created_rows are the firehose's (uri, author, rkey, cid_key, subject_author, subject_rkey, created_at) post infos,
+# deleted_rows are (uri, ) rows
+def encode_post_changes(created_rows: list[tuple], deleted_rows: list[tuple]) -> list[str]:
+    lines = []
+    for _, author, rkey, cid_key, subject_author, subject_rkey, created_at in created_rows:
+        subject_rkey = '' if subject_rkey is None else subject_rkey
+        lines.append(f'+\t{author}\t{rkey}\t{cid_key}\t{subject_author or ""}\t{subject_rkey}\t{created_at.timestamp()}')
+    for deleted_row in deleted_rows:
+        lines.append(f'-\t{deleted_row[0]}')
+    return _chunk_lines(lines)
+
+def decode_post_changes(payload: str):
+    for line in payload.split('\n'):
+        fields = line.split('\t')
+        if fields[0] == '+' and len(fields) == 7:
+            _, author, rkey, cid_key, subject_author, subject_rkey, created_at = fields
+            yield ('+', author, int(rkey), int(cid_key), subject_author or None, int(subject_rkey) if subject_rkey else None, float(created_at))
+        elif fields[0] == '-' and len(fields) == 2:
+            yield ('-', fields[1])
+
+# Delivered to listeners when the current transaction commits
+def publish_post_changes(cur, created_rows: list[tuple], deleted_rows: list[tuple]):
+    payloads = encode_post_changes(created_rows, deleted_rows)
+    if len(payloads) > 0:
+        cur.execute(f"SELECT pg_notify('{POSTS_CHANGED_CHANNEL}', payload) FROM unnest(%s::TEXT[]) AS payload", (payloads, ))
+
+# The feeds service sends the DID of each user once their follows are primed, so the firehose starts keeping
+# that user's follows
+FOLLOWS_PRIMED_CHANNEL = 'follows_primed'
+
+# The firehose sends the DID of each primed user whose follows it has just written or deleted
+FOLLOWS_CHANGED_CHANNEL = 'follows_changed'
+
+# The one LISTEN loop every listener runs, so they all reconnect and reload the same way. Runs forever: connects,
+# listens on channels, calls on_connect(cur), then on_notify(cur, payload) for each notification, and on_idle(cur)
+# whenever idle_seconds pass without one. Any error closes the connection and starts over 5 seconds later, on_connect
+# included, since anything could have changed while nobody was listening.
+def listen(name: str, connect, channels: list[str], on_connect, on_notify=None, on_idle=None, on_error=None, idle_seconds: float = 60.0):
+    while True:
+        con = None
+        try:
+            con = connect()
+            con.autocommit = True
+            cur = con.cursor()
+            # Listening before on_connect, so notifications sent while it runs are queued and handled after
+            for channel in channels:
+                cur.execute(f'LISTEN {channel}')
+            on_connect(cur)
+
+            while True:
+                con.poll()
+                while con.notifies:
+                    on_notify(cur, con.notifies.pop(0).payload)
+                if select.select([con], [], [], idle_seconds) == ([], [], []) and on_idle is not None:
+                    on_idle(cur)
+        except Exception as ex:
+            print(f'{name} error! {ex}')
+            if on_error is not None:
+                on_error()
+            if con is not None:
+                con.close()
+            sleep(5.0)
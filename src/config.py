@@ -1,3 +1,4 @@
+import os
 import yaml
 
 with open('./config.yml', 'r') as file:
@@ -7,3 +8,68 @@ PASSWORD: str = config_data['password']
 HOSTNAME: str = config_data['hostname']
 DB_PASSWORD: str = config_data['db_password']
 FEEDS: dict[str, dict[str, str]] = config_data['feeds']
+
+# Keep per-author timelines in the feeds service's memory, streamed from the firehose, instead of querying posts
+TIMELINE_STORE: bool = config_data.get('timeline_store', False)
+
+# Firehose ingestion settings (all optional)
+firehose_data: dict[str] = config_data.get('firehose') or {}
+FIREHOSE_WRITE_MODE: str = firehose_data.get('write_mode', 'batch')
+FIREHOSE_DECODE_WORKERS: int = firehose_data.get('decode_workers', 0)
+FIREHOSE_QUEUE_SIZE: int = firehose_data.get('queue_size', 200_000)
+FIREHOSE_FLUSH_INTERVAL: float = firehose_data.get('flush_interval_seconds', 2.0)
+FIREHOSE_FLUSH_TARGET_SECONDS: float = firehose_data.get('flush_target_seconds', 1.0)
+FIREHOSE_MIN_BATCH_SIZE: int = firehose_data.get('min_batch_size', 1000)
+FIREHOSE_MAX_BATCH_SIZE: int = firehose_data.get('max_batch_size', 50_000)
+FIREHOSE_PARTITION_HOURS: int = firehose_data.get('partition_hours', 1)
+FIREHOSE_PARTITIONS_AHEAD: int = firehose_data.get('partitions_ahead', 2)
+FIREHOSE_CREATED_AT_INDEX: str = firehose_data.get('created_at_index', 'btree')
+FIREHOSE_DELETE_FILTER_BITS_PER_HOUR: int = firehose_data.get('delete_filter_bits_per_hour', 2 ** 24)
+# Max DID -> actor id mappings remembered between flushes
+FIREHOSE_ACTOR_CACHE_SIZE: int = firehose_data.get('actor_cache_size', 500_000)
+# Prometheus metrics listener (0 = off), and whether each flush's timings and row counts are also printed
+FIREHOSE_METRICS_PORT: int = firehose_data.get('metrics_port', 8000)
+FIREHOSE_LOG_FLUSHES: bool = firehose_data.get('log_flushes', True)
+# Number of consumer processes, each writing the repos in its hash range over its own connection (FIREHOSE_SHARDS in
+# the environment, e.g. from docker-compose, takes precedence), and max frames waiting for each one. Shard i serves
+# its metrics on FIREHOSE_METRICS_PORT + 1 + i.
+FIREHOSE_SHARDS: int = int(os.environ.get('FIREHOSE_SHARDS') or firehose_data.get('shards', 1))
+FIREHOSE_SHARD_BACKLOG: int = firehose_data.get('shard_backlog', 10_000)
+
+# Feed server settings (all optional)
+feed_server_data: dict[str] = config_data.get('feed_server') or {}
+FEED_SERVER_DB_POOL_SIZE: int = feed_server_data.get('db_pool_size', 8)
+FEED_SERVER_FOLLOWEE_CACHE_SIZE: int = feed_server_data.get('followee_cache_size', 2_000_000)
+FEED_SERVER_FEED_CACHE_SIZE: int = feed_server_data.get('feed_cache_size', 1_000_000)
+FEED_SERVER_FEED_CACHE_TTL: float = feed_server_data.get('feed_cache_ttl_seconds', 900.0)
+# Background priming of the follows of users new to the feed
+FEED_SERVER_PRIMING_WORKERS: int = feed_server_data.get('priming_workers', 4)
+FEED_SERVER_PRIMING_WAIT: float = feed_server_data.get('priming_wait_seconds', 2.0)
+# Fetch every user's follows from this PDS instead of the one in their DID document (e.g. mock_pds.py when testing locally)
+FEED_SERVER_PDS_ENDPOINT: str = feed_server_data.get('pds_endpoint', '')
+# Resolve DID documents from this PLC directory instead of plc.directory (e.g. mock_pds.py, for bench_feeds.py)
+FEED_SERVER_PLC_ENDPOINT: str = feed_server_data.get('plc_endpoint', '')
+# Verified JWTs are cached until they expire, and resolved DID documents (bounded, expiring after a day) are kept on disk across restarts
+FEED_SERVER_TOKEN_CACHE_SIZE: int = feed_server_data.get('token_cache_size', 100_000)
+FEED_SERVER_DID_CACHE_SIZE: int = feed_server_data.get('did_cache_size', 500_000)
+FEED_SERVER_DID_CACHE_PATH: str = feed_server_data.get('did_cache_path', './state/did_cache.jsonl')
+FEED_SERVER_DID_CACHE_SAVE_INTERVAL: float = feed_server_data.get('did_cache_save_interval_seconds', 60.0)
+# Metrics are always exported; this also prints the details of every feed request
+FEED_SERVER_LOG_REQUESTS: bool = feed_server_data.get('log_requests', True)
+# Number of feed server worker processes, and where the per-user feed seeds they share are kept: 'postgres' (also shared
+# between replicas) or 'shared_memory' (workers on this host only, in a table of seed_store_size users)
+FEED_SERVER_WORKERS: int = feed_server_data.get('workers', 1)
+# With more than one worker, each has its own metrics, so worker i serves them on metrics_port + i instead of at /metrics
+FEED_SERVER_METRICS_PORT: int = feed_server_data.get('metrics_port', 8000)
+FEED_SERVER_SEED_STORE: str = feed_server_data.get('seed_store', 'postgres')
+FEED_SERVER_SEED_STORE_SIZE: int = feed_server_data.get('seed_store_size', 1_000_000)
+# Each feed request has latency_budget_seconds (set per feed in feeds, or this default) to be served in. Db statements
+# are cancelled when it runs out, and the user's last candidate set (up to fallback_cache_size posts held in total) or a
+# sample of the recent_posts newest posts (refreshed every recent_posts_refresh_seconds) is served instead.
+FEED_SERVER_LATENCY_BUDGET: float = feed_server_data.get('latency_budget_seconds', 3.0)
+FEED_SERVER_FALLBACK_CACHE_SIZE: int = feed_server_data.get('fallback_cache_size', 500_000)
+FEED_SERVER_RECENT_POSTS: int = feed_server_data.get('recent_posts', 5000)
+FEED_SERVER_RECENT_POSTS_REFRESH: float = feed_server_data.get('recent_posts_refresh_seconds', 60.0)
+# Timeouts of DID document lookups, and of each request to a PDS while priming
+FEED_SERVER_DID_TIMEOUT: float = feed_server_data.get('did_timeout_seconds', 2.0)
+FEED_SERVER_PRIMING_REQUEST_TIMEOUT: float = feed_server_data.get('priming_request_timeout_seconds', 10.0)
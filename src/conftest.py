@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# Each service runs with its own directory, and the shared modules copied in from src, on its path. Each service's
+# tests/conftest.py adds its own directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# config.py reads ./config.yml when it's first imported, so run from a directory with a minimal one
+_CONFIG_DIR = tempfile.mkdtemp(prefix='bsky_feeds_tests_')
+with open(os.path.join(_CONFIG_DIR, 'config.yml'), 'w') as file:
+    file.write("""handle: 'test.example.com'
+password: ''
+hostname: 'feeds.example.com'
+db_password: ''
+feeds:
+  random_from_follows:
+    record_name: 'chaos'
+""")
+os.chdir(_CONFIG_DIR)
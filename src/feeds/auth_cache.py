@@ -0,0 +1,163 @@
+from atproto import DidDocument
+from atproto_identity.cache.base_cache import DidBaseCache
+from atproto_identity.cache.models import CachedDid, CachedDidResult
+from collections import OrderedDict
+from datetime import datetime, timezone
+from hashlib import sha256
+import json
+import os
+from threading import Lock, Thread
+from time import sleep, time
+
+class VerifiedTokenCache:
+    # Requester DIDs of JWTs whose signatures already checked out, so later pages with the same token skip
+    # the signature check. Keyed by a digest of the token, and only valid until the token's exp.
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[bytes, tuple[str, int]] = OrderedDict() # digest -> (iss, exp)
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, jwt: str) -> str:
+        key = sha256(jwt.encode()).digest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, jwt: str, iss: str, exp: int):
+        # Tokens without an expiry are verified every time
+        if exp is None:
+            return
+
+        key = sha256(jwt.encode()).digest()
+        with self.lock:
+            self.entries[key] = (iss, exp)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+            }
+
+class PersistentDidCache(DidBaseCache):
+    # DID document cache for the IdResolver, bounded by entry count (least recently used evicted first)
+    # and dropping documents after max_ttl. Saved to disk so a restart doesn't re-resolve every active user.
+    def __init__(self, max_entries: int, path: str, stale_ttl: int = None, max_ttl: int = None):
+        super().__init__(stale_ttl, max_ttl)
+        self.max_entries = max_entries
+        self.path = path
+        self.entries: OrderedDict[str, CachedDid] = OrderedDict()
+        self.lock = Lock()
+        self.dirty = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, did: str) -> CachedDidResult:
+        with self.lock:
+            entry = self.entries.get(did)
+            now = time()
+            if entry is not None and now > entry.updated_at.timestamp() + self.max_ttl:
+                del self.entries[did]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(did)
+            self.hits += 1
+            stale = now > entry.updated_at.timestamp() + self.stale_ttl
+            return CachedDidResult(did, entry.document, entry.updated_at, stale, False)
+
+    def set(self, did: str, document: DidDocument):
+        self._set(did, CachedDid(document, datetime.now(timezone.utc)))
+
+    def _set(self, did: str, entry: CachedDid):
+        with self.lock:
+            self.entries[did] = entry
+            self.entries.move_to_end(did)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def refresh(self, did: str, get_doc_callback):
+        document = get_doc_callback()
+        if document:
+            self.set(did, document)
+
+    def delete(self, did: str):
+        with self.lock:
+            if self.entries.pop(did, None) is not None:
+                self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        cutoff = time() - self.max_ttl
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    saved = json.loads(line)
+                    updated_at = datetime.fromtimestamp(saved['updated_at'], timezone.utc)
+                    if updated_at.timestamp() > cutoff:
+                        self._set(saved['did'], CachedDid(DidDocument.from_dict(saved['document']), updated_at))
+        except Exception as ex:
+            print(f'Could not load DID cache from {self.path}! {ex}')
+        self.dirty = False
+
+    # Written to a temporary file and renamed over the old one, so a crash mid-save keeps the previous copy
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            saved = [(did, entry.document.model_dump(by_alias=True, exclude_none=True), entry.updated_at.timestamp())
+                     for did, entry in self.entries.items()]
+            self.dirty = False
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Per process, since every feed server worker saves its own cache to the same path
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            for did, document, updated_at in saved:
+                file.write(json.dumps({'did': did, 'document': document, 'updated_at': updated_at}))
+                file.write('\n')
+        os.replace(temp_path, self.path)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+            }
+
+def save_periodically(cache: PersistentDidCache, interval_seconds: float):
+    while True:
+        sleep(interval_seconds)
+        try:
+            cache.save()
+        except Exception as ex:
+            print(f'Could not save DID cache to {cache.path}! {ex}')
+
+def start_saver(cache: PersistentDidCache, interval_seconds: float):
+    Thread(target=save_periodically, args=(cache, interval_seconds), daemon=True).start()
@@ -0,0 +1,187 @@
+import argparse
+from atproto_crypto.consts import P256_CURVE_ORDER
+from base64 import urlsafe_b64encode
+from bench_seed import copy_posts, create_partitions
+import config
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+import db
+from datetime import datetime, timezone
+import httpx
+from io import StringIO
+import json
+from mock_pds import mock_did, mock_follows, mock_signing_key
+from random import Random
+from statistics import quantiles
+from storage import create_tables, intern_actors
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+
+# Load test of getFeedSkeleton against a running feed server: seeds the local Postgres with a synthetic follow
+# graph and posts, then has simulated users refresh and page through both feeds at rising concurrency,
+# reporting latency percentiles and throughput for each level.
+# The feed server has to resolve the synthetic DIDs through mock_pds.py, so on a local stack:
+#   python mock_pds.py &  (with feed_server.plc_endpoint and pds_endpoint set to 'http://localhost:5001')
+#   python bench_feeds.py --url http://localhost:5000 --concurrency 1 4 16 64
+# Synthetic accounts all have mock_did DIDs, and their rows are deleted afterwards unless --keep is given.
+
+MOCK_DID_PATTERN = 'did:plc:mock%'
+
+# The synthetic actors are kept, so later runs reuse their ids
+def delete_synthetic(cur):
+    cur.execute('DELETE FROM follows USING actors WHERE follows.follower_id = actors.id AND actors.did LIKE %s', (MOCK_DID_PATTERN, ))
+    cur.execute('DELETE FROM posts USING actors WHERE posts.author_id = actors.id AND actors.did LIKE %s', (MOCK_DID_PATTERN, ))
+
+# Users follow the same accounts mock_pds.py serves for them, so unseeded users prime to the same graph
+def seed(cur, user_count: int, follow_count: int, universe: int, post_count: int, seed_follows: bool, r: Random):
+    now = datetime.now(timezone.utc)
+    create_tables(cur)
+    create_partitions(cur, now)
+    delete_synthetic(cur)
+    actor_ids = intern_actors(cur, [mock_did(index) for index in range(max(user_count, universe))])
+
+    if seed_follows:
+        rows = StringIO()
+        for user in range(user_count):
+            did = mock_did(user)
+            for rkey, followee in enumerate(mock_follows(did, follow_count, universe)):
+                rows.write(f'{actor_ids[did]}\t{actor_ids[mock_did(followee)]}\t{rkey}\n')
+        rows.seek(0)
+        cur.copy_expert('COPY follows FROM STDIN', rows)
+
+    copy_posts(cur, [actor_ids[mock_did(index)] for index in range(universe)], post_count, now, 12, r)
+    cur.execute('ANALYZE posts')
+    cur.execute('ANALYZE follows')
+
+def _b64(data: bytes) -> str:
+    return urlsafe_b64encode(data).rstrip(b'=').decode()
+
+# ES256 service-auth JWT, signed with the key mock_pds.py publishes in the user's DID document
+def sign_jwt(did: str, audience: str, lifetime_seconds: float) -> str:
+    header = _b64(json.dumps({'alg': 'ES256', 'typ': 'JWT'}).encode())
+    payload = _b64(json.dumps({'iss': did, 'aud': audience, 'iat': int(time()), 'exp': int(time() + lifetime_seconds)}).encode())
+    signing_input = f'{header}.{payload}'.encode()
+    r, s = decode_dss_signature(mock_signing_key(did).sign(signing_input, ec.ECDSA(hashes.SHA256())))
+    # atproto only accepts low-S signatures
+    if s > P256_CURVE_ORDER // 2:
+        s = P256_CURVE_ORDER - s
+    return f'{header}.{payload}.{_b64(r.to_bytes(32, "big") + s.to_bytes(32, "big"))}'
+
+class LoadStage:
+    # Each worker is one simulated user at a time: a refresh, then following cursors down the feed, with
+    # page_probability of scrolling on after each page
+    def __init__(self, url: str, tokens: dict[str, str], feed_uris: dict[str, str], page_probability: float, limit: int):
+        self.url = f'{url}/xrpc/app.bsky.feed.getFeedSkeleton'
+        self.tokens = tokens
+        self.users = list(tokens)
+        self.feed_uris = feed_uris
+        self.page_probability = page_probability
+        self.limit = limit
+
+        self.lock = Lock()
+        # (variant, 'refresh' or 'page') -> seconds
+        self.latencies: dict[tuple[str, str], list[float]] = {(variant, kind): [] for variant in feed_uris for kind in ('refresh', 'page')}
+        self.errors = 0
+        self.stopped = Event()
+
+    def _request(self, client: httpx.Client, kind: str, did: str, variant: str, cursor: str) -> str:
+        params = {'feed': self.feed_uris[variant], 'limit': self.limit}
+        if cursor is not None:
+            params['cursor'] = cursor
+        start_time = perf_counter()
+        try:
+            response = client.get(self.url, params=params, headers={'Authorization': f'Bearer {self.tokens[did]}'})
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        elapsed_seconds = perf_counter() - start_time
+        with self.lock:
+            if ok:
+                self.latencies[(variant, kind)].append(elapsed_seconds)
+            else:
+                self.errors += 1
+        return response.json().get('cursor') if ok else None
+
+    def _worker(self, worker_seed: int):
+        r = Random(worker_seed)
+        with httpx.Client(timeout=60.0) as client:
+            while not self.stopped.is_set():
+                did = r.choice(self.users)
+                variant = r.choice(list(self.feed_uris))
+                cursor = self._request(client, 'refresh', did, variant, None)
+                while cursor is not None and not self.stopped.is_set() and r.random() < self.page_probability:
+                    cursor = self._request(client, 'page', did, variant, cursor)
+
+    def run(self, concurrency: int, duration_seconds: float, seed: int) -> float:
+        workers = [Thread(target=self._worker, args=(seed * 1000 + i, ), daemon=True) for i in range(concurrency)]
+        start_time = perf_counter()
+        for worker in workers:
+            worker.start()
+        self.stopped.wait(duration_seconds)
+        self.stopped.set()
+        for worker in workers:
+            worker.join()
+        return perf_counter() - start_time
+
+def describe(latencies: list[float]) -> str:
+    if len(latencies) < 2:
+        return f'{len(latencies)} requests'
+    cuts = quantiles(latencies, n=100)
+    return f'p50 {cuts[49] * 1000:.0f} ms, p95 {cuts[94] * 1000:.0f} ms, p99 {cuts[98] * 1000:.0f} ms'
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--url', default='http://localhost:5000')
+    arg_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    arg_parser.add_argument('--duration', type=float, default=30.0, help='Seconds per concurrency level')
+    arg_parser.add_argument('--warmup', type=float, default=10.0, help='Unreported seconds first, so DID documents and followees get cached')
+    arg_parser.add_argument('--users', type=int, default=2000)
+    arg_parser.add_argument('--follows', type=int, default=500, help='Follows per user')
+    arg_parser.add_argument('--universe', type=int, default=100_000, help='Number of distinct followable accounts')
+    arg_parser.add_argument('--posts', type=int, default=1_000_000)
+    arg_parser.add_argument('--page-probability', type=float, default=0.6, help='Chance of loading another page after each page')
+    arg_parser.add_argument('--limit', type=int, default=30)
+    arg_parser.add_argument('--unprimed', action='store_true', help="Don't seed follows, so each user's first request primes them from mock_pds.py")
+    arg_parser.add_argument('--no-seed', action='store_true', help='Reuse the synthetic rows from a previous --keep run')
+    arg_parser.add_argument('--keep', action='store_true', help='Keep the synthetic rows afterwards')
+    args = arg_parser.parse_args()
+
+    con = db.connect()
+    cur = con.cursor()
+    if not args.no_seed:
+        print(f'Seeding {args.users} users following {args.follows} of {args.universe} accounts, and {args.posts} posts...')
+        seed(cur, args.users, args.follows, args.universe, args.posts, not args.unprimed, Random(0))
+        con.commit()
+
+    service_did = f'did:web:{config.HOSTNAME}'
+    lifetime_seconds = args.warmup + args.duration * len(args.concurrency) + 3600
+    tokens = {mock_did(user): sign_jwt(mock_did(user), service_did, lifetime_seconds) for user in range(args.users)}
+    # Both variants, whatever feeds the config defines: the server includes reposts for record names ending in
+    # 'chaos', and serves posts only for any other
+    feed_uris = {
+        'with reposts': f'at://{service_did}/app.bsky.feed.generator/chaos',
+        'posts only': f'at://{service_did}/app.bsky.feed.generator/posts',
+    }
+
+    try:
+        if args.warmup > 0:
+            LoadStage(args.url, tokens, feed_uris, args.page_probability, args.limit).run(max(args.concurrency), args.warmup, 0)
+
+        for concurrency in args.concurrency:
+            stage = LoadStage(args.url, tokens, feed_uris, args.page_probability, args.limit)
+            elapsed_seconds = stage.run(concurrency, args.duration, concurrency)
+            all_latencies = [latency for latencies in stage.latencies.values() for latency in latencies]
+            print(f'Concurrency {concurrency}: {len(all_latencies) / elapsed_seconds:.1f} requests/sec, {describe(all_latencies)}, {stage.errors} errors')
+            for variant in feed_uris:
+                for kind in ('refresh', 'page'):
+                    latencies = stage.latencies[(variant, kind)]
+                    print(f'  {variant}, {kind}: {len(latencies) / elapsed_seconds:.1f} requests/sec, {describe(latencies)}')
+    finally:
+        if not args.keep:
+            delete_synthetic(cur)
+            con.commit()
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+from bench_seed import copy_posts, create_partitions
+import db
+from datetime import datetime, timezone
+from random import Random
+from sampling import DEFAULT_SAMPLE_SIZE, sample_candidates
+from statistics import median
+from storage import create_tables, intern_actors
+from time import perf_counter_ns
+
+# Compares the old "ORDER BY cid_key LIMIT n" candidate query with the sampling engine as follow count grows.
+# Builds its own posts table in a scratch schema, shaped like the real hourly partitions.
+# Run with: python bench_sampling.py --follows 100 5000
+
+SCHEMA = 'bench_sampling'
+
+def seed_posts(cur, author_count: int, post_count: int, r: Random) -> list[str]:
+    cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    cur.execute(f'CREATE SCHEMA {SCHEMA}')
+    cur.execute(f'SET search_path = {SCHEMA}')
+    # Follows are unused, but every prepared statement needs its tables to exist
+    create_tables(cur)
+    cur.execute('CREATE INDEX idx_posts_created_at ON posts (created_at)')
+
+    now = datetime.now(timezone.utc)
+    create_partitions(cur, now)
+    authors = [f'did:plc:{r.getrandbits(120):030x}'[:32] for _ in range(author_count)]
+    actor_ids = intern_actors(cur, authors)
+    copy_posts(cur, [actor_ids[author] for author in authors], post_count, now, 13, r)
+    cur.execute('ANALYZE actors')
+    cur.execute('ANALYZE posts')
+    return authors
+
+def time_ms(function, repeats: int) -> tuple[float, int]:
+    timings = []
+    result_count = 0
+    for _ in range(repeats):
+        start_time = perf_counter_ns()
+        result_count = len(function())
+        timings.append((perf_counter_ns() - start_time) / 1_000_000)
+    return median(timings), result_count
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--follows', type=int, nargs='+', default=[100, 5000])
+    arg_parser.add_argument('--authors', type=int, default=200_000)
+    arg_parser.add_argument('--posts', type=int, default=2_000_000)
+    arg_parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE)
+    arg_parser.add_argument('--repeats', type=int, default=5)
+    arg_parser.add_argument('--keep', action='store_true', help=f'Keep the {SCHEMA} schema afterwards')
+    args = arg_parser.parse_args()
+
+    r = Random(0)
+    con = db.connect(connection_factory=db.PreparedConnection)
+    cur = con.cursor()
+    print(f'Seeding {args.posts} posts from {args.authors} authors...')
+    authors = seed_posts(cur, args.authors, args.posts, r)
+    con.commit()
+
+    # Prepared with the scratch schema on the search path, so every statement reads the benchmark tables
+    db.prepare(con)
+
+    try:
+        for follow_count in args.follows:
+            followees = tuple(r.sample(authors, follow_count))
+            for include_reposts in (True, False):
+                lowest_ms, lowest_count = time_ms(lambda: db.candidate_posts(cur, followees, include_reposts), args.repeats)
+                seeds = iter(range(args.repeats))
+                sample_ms, sample_count = time_ms(lambda: sample_candidates(cur, followees, include_reposts, args.sample_size, f'bench:{next(seeds)}'), args.repeats)
+                print(f'{follow_count} follows, reposts {"on" if include_reposts else "off"}: '
+                      f'ORDER BY cid_key {lowest_ms:.1f} ms ({lowest_count} posts), '
+                      f'sampled {sample_ms:.1f} ms ({sample_count} posts)')
+                con.rollback()
+    finally:
+        con.rollback()
+        if not args.keep:
+            cur.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+            con.commit()
+        con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+import argparse
+from base64 import b32encode
+from bench_seed import create_partitions, post_authors
+import db
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from random import Random
+from sampling import allocate_sample, DEFAULT_SAMPLE_SIZE, sample_candidates
+from statistics import median
+from storage import cid_key, create_tables, FOLLOW_COLLECTION, intern_actors, POST_COLLECTION, record_uri, REPOST_COLLECTION
+from time import perf_counter_ns
+
+# Compares the original posts/follows layout (uris, DIDs and reversed CID strings as TEXT) with the compact one in
+# storage.py: table and index bytes, and the followees and sampled candidate queries. Both layouts are built in
+# scratch schemas from the same synthetic rows, shaped like the real network and hourly partitions.
+# Run with: python bench_schema.py --authors 200000 --posts 2000000 --users 2000 --follows 500
+
+TEXT_SCHEMA = 'bench_schema_text'
+COMPACT_SCHEMA = 'bench_schema_compact'
+_FOLLOW_TIME_US = 1_700_000_000_000_000
+
+# The queries the feeds service ran against the original layout
+_TEXT_FOLLOWEES = 'SELECT followee FROM follows WHERE follower = %s'
+_TEXT_AUTHOR_POST_COUNTS = 'SELECT author, count(*) FROM posts WHERE author = ANY(%s::TEXT[]) GROUP BY author'
+_TEXT_SAMPLE_POSTS = """
+    SELECT p.uri, p.repost_uri, p.cid_rev
+    FROM unnest(%s::TEXT[], %s::INT[]) AS s(author, n)
+    CROSS JOIN LATERAL (
+        SELECT uri, repost_uri, cid_rev
+        FROM posts
+        WHERE posts.author = s.author
+        ORDER BY md5(posts.cid_rev || %s)
+        LIMIT s.n
+    ) p"""
+
+def synthetic_rows(author_count: int, post_count: int, user_count: int, follow_count: int, r: Random) -> tuple[list[str], list[tuple], list[tuple]]:
+    authors = [f'did:plc:{b32encode(r.randbytes(15)).decode().lower()}' for _ in range(author_count)]
+    now = datetime.now(timezone.utc)
+
+    # Posts are (author, rkey, cid, subject author, subject rkey, created_at), with heavy-tailed post counts per author
+    posts = []
+    for author in post_authors(range(author_count), post_count, r):
+        created_at = now - timedelta(seconds=r.uniform(0, 13 * 3600))
+        rkey = int(created_at.timestamp() * 1_000_000) << 10 | r.getrandbits(10)
+        # CIDv1, dag-cbor, sha2-256
+        cid = bytes([0x01, 0x71, 0x12, 0x20]) + r.randbytes(32)
+        if r.random() < 0.2:
+            posts.append((author, rkey, cid, r.randrange(author_count), rkey - r.getrandbits(30), created_at))
+        else:
+            posts.append((author, rkey, cid, None, None, created_at))
+
+    # Follows are (follower, followee, rkey), with the users being the first user_count authors
+    follows = []
+    for follower in range(min(user_count, author_count)):
+        for index, followee in enumerate(r.sample(range(author_count), min(follow_count, author_count))):
+            follows.append((follower, followee, _FOLLOW_TIME_US << 10 | index))
+    return authors, posts, follows
+
+def create_schema(cur, schema: str):
+    cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    cur.execute(f'CREATE SCHEMA {schema}')
+    cur.execute(f'SET search_path = {schema}')
+
+def _copy(cur, table: str, lines):
+    rows = StringIO()
+    for line in lines:
+        rows.write(line)
+    rows.seek(0)
+    cur.copy_expert(f'COPY {table} FROM STDIN', rows)
+
+# Same tables and indexes as the firehose made before the compact layout
+def build_text_layout(cur, authors: list[str], posts: list[tuple], follows: list[tuple]):
+    create_schema(cur, TEXT_SCHEMA)
+    cur.execute(
+        """CREATE TABLE posts(
+            uri TEXT,
+            cid_rev TEXT,
+            repost_uri TEXT,
+            created_at TIMESTAMPTZ NOT NULL,
+            author TEXT
+        ) PARTITION BY RANGE(created_at)""")
+    cur.execute('CREATE INDEX idx_posts_uri ON posts (uri)')
+    cur.execute('CREATE INDEX idx_posts_created_at ON posts (created_at)')
+    cur.execute('CREATE INDEX idx_posts_author ON posts (author)')
+    create_partitions(cur, datetime.now(timezone.utc))
+    cur.execute(
+        """CREATE TABLE follows(
+            uri TEXT PRIMARY KEY,
+            follower TEXT,
+            followee TEXT
+        )""")
+    cur.execute('CREATE UNIQUE INDEX idx_follows_uri ON follows (uri)')
+    cur.execute('CREATE INDEX idx_follows_follower ON follows (follower)')
+
+    def post_line(post: tuple) -> str:
+        author, rkey, cid, subject_author, subject_rkey, created_at = post
+        cid_rev = ('b' + b32encode(cid).decode().lower().rstrip('='))[::-1]
+        if subject_author is None:
+            return f'{record_uri(authors[author], POST_COLLECTION, rkey)}\t{cid_rev}\t\\N\t{created_at.isoformat()}\t{authors[author]}\n'
+        return (f'{record_uri(authors[author], REPOST_COLLECTION, rkey)}\t{cid_rev}\t{record_uri(authors[subject_author], POST_COLLECTION, subject_rkey)}\t'
+                f'{created_at.isoformat()}\t{authors[author]}\n')
+    _copy(cur, 'posts', map(post_line, posts))
+    _copy(cur, 'follows', (f'{record_uri(authors[follower], FOLLOW_COLLECTION, rkey)}\t{authors[follower]}\t{authors[followee]}\n'
+                           for follower, followee, rkey in follows))
+    cur.execute('ANALYZE posts')
+    cur.execute('ANALYZE follows')
+
+def build_compact_layout(cur, authors: list[str], posts: list[tuple], follows: list[tuple]):
+    create_schema(cur, COMPACT_SCHEMA)
+    create_tables(cur)
+    cur.execute('CREATE INDEX idx_posts_created_at ON posts (created_at)')
+    create_partitions(cur, datetime.now(timezone.utc))
+    actor_ids = intern_actors(cur, authors)
+    ids = [actor_ids[author] for author in authors]
+
+    def post_line(post: tuple) -> str:
+        author, rkey, cid, subject_author, subject_rkey, created_at = post
+        if subject_author is None:
+            return f'{ids[author]}\t\\N\t{rkey}\t\\N\t{cid_key(cid)}\t{created_at.isoformat()}\n'
+        return f'{ids[author]}\t{ids[subject_author]}\t{rkey}\t{subject_rkey}\t{cid_key(cid)}\t{created_at.isoformat()}\n'
+    _copy(cur, 'posts', map(post_line, posts))
+    _copy(cur, 'follows', (f'{ids[follower]}\t{ids[followee]}\t{rkey}\n' for follower, followee, rkey in follows))
+    cur.execute('ANALYZE actors')
+    cur.execute('ANALYZE posts')
+    cur.execute('ANALYZE follows')
+
+def layout_sizes(cur, tables: list[str]) -> dict[str, tuple[int, int]]:
+    sizes = {}
+    for table in tables:
+        cur.execute(
+            """SELECT COALESCE(sum(pg_table_size(relid)), 0), COALESCE(sum(pg_indexes_size(relid)), 0)
+               FROM pg_partition_tree(%s::regclass) WHERE isleaf""", (table, ))
+        sizes[table] = tuple(int(size) for size in cur.fetchone())
+    return sizes
+
+def print_sizes(label: str, sizes: dict[str, tuple[int, int]]):
+    for table, (table_bytes, index_bytes) in sizes.items():
+        print(f'  {label} {table}: {table_bytes / 2**20:.1f} MiB of rows, {index_bytes / 2**20:.1f} MiB of indexes')
+    print(f'  {label} total: {sum(size[0] for size in sizes.values()) / 2**20:.1f} MiB of rows, '
+          f'{sum(size[1] for size in sizes.values()) / 2**20:.1f} MiB of indexes')
+
+def time_ms(function, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start_time = perf_counter_ns()
+        function()
+        timings.append((perf_counter_ns() - start_time) / 1_000_000)
+    return median(timings)
+
+def text_sample_candidates(cur, followees: tuple[str, ...], sample_size: int, sample_seed: str) -> list[tuple]:
+    cur.execute(_TEXT_AUTHOR_POST_COUNTS, (list(followees), ))
+    author_counts = sorted(cur.fetchall())
+    if sum(count for _, count in author_counts) <= sample_size:
+        cur.execute('SELECT uri, repost_uri, cid_rev FROM posts WHERE author = ANY(%s::TEXT[])', ([author for author, _ in author_counts], ))
+        return cur.fetchall()
+    authors, counts = allocate_sample(author_counts, sample_size, Random(sample_seed))
+    cur.execute(_TEXT_SAMPLE_POSTS, (authors, counts, sample_seed))
+    return cur.fetchall()
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--authors', type=int, default=200_000)
+    arg_parser.add_argument('--posts', type=int, default=2_000_000)
+    arg_parser.add_argument('--users', type=int, default=2000, help='Users with follows, out of the authors')
+    arg_parser.add_argument('--follows', type=int, default=500, help='Follows per user')
+    arg_parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE)
+    arg_parser.add_argument('--queries', type=int, default=50, help='Users to time the queries for')
+    arg_parser.add_argument('--keep', action='store_true', help=f'Keep the {TEXT_SCHEMA} and {COMPACT_SCHEMA} schemas afterwards')
+    args = arg_parser.parse_args()
+
+    r = Random(0)
+    print(f'Generating {args.posts} posts from {args.authors} authors, and {args.follows} follows for each of {args.users} users...')
+    authors, posts, follows = synthetic_rows(args.authors, args.posts, args.users, args.follows, r)
+    users = r.sample(authors[:min(args.users, args.authors)], min(args.queries, args.users, args.authors))
+
+    text_con = db.connect()
+    text_cur = text_con.cursor()
+    # Prepared with the compact schema on the search path, so the feeds service's own statements are timed
+    compact_con = db.connect(connection_factory=db.PreparedConnection)
+    compact_cur = compact_con.cursor()
+    try:
+        start_time = perf_counter_ns()
+        build_text_layout(text_cur, authors, posts, follows)
+        text_con.commit()
+        print(f'Built the text layout in {(perf_counter_ns() - start_time) / 1_000_000_000:.1f} seconds.')
+        start_time = perf_counter_ns()
+        build_compact_layout(compact_cur, authors, posts, follows)
+        compact_con.commit()
+        print(f'Built the compact layout in {(perf_counter_ns() - start_time) / 1_000_000_000:.1f} seconds.')
+        db.prepare(compact_con)
+
+        print('Sizes:')
+        print_sizes('text', layout_sizes(text_cur, ['posts', 'follows']))
+        print_sizes('compact', layout_sizes(compact_cur, ['actors', 'posts', 'follows']))
+
+        # Each user's followees, then a sample of their posts, as the feed server does on a cache miss
+        followees = {}
+        def text_followees():
+            for user in users:
+                text_cur.execute(_TEXT_FOLLOWEES, (user, ))
+                followees[user] = tuple(row[0] for row in text_cur.fetchall())
+        def compact_followees():
+            for user in users:
+                db.followees(compact_cur, user)
+        seeds = iter(range(10**9))
+        def text_samples():
+            seed = next(seeds)
+            for user in users:
+                text_sample_candidates(text_cur, followees[user], args.sample_size, f'{user}:{seed}')
+        def compact_samples():
+            seed = next(seeds)
+            for user in users:
+                sample_candidates(compact_cur, followees[user], True, args.sample_size, f'{user}:{seed}')
+
+        print(f'Query times for {len(users)} users (median of 5 runs):')
+        print(f'  followees: text {time_ms(text_followees, 5):.1f} ms, compact {time_ms(compact_followees, 5):.1f} ms')
+        print(f'  sampled candidates: text {time_ms(text_samples, 5):.1f} ms, compact {time_ms(compact_samples, 5):.1f} ms')
+    finally:
+        text_con.rollback()
+        compact_con.rollback()
+        if not args.keep:
+            text_cur.execute(f'DROP SCHEMA IF EXISTS {TEXT_SCHEMA} CASCADE')
+            text_cur.execute(f'DROP SCHEMA IF EXISTS {COMPACT_SCHEMA} CASCADE')
+            text_con.commit()
+        text_con.close()
+        compact_con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+from io import StringIO
+import psycopg2
+from random import Random
+
+# Synthetic data shared by the benchmarks, shaped like the real network
+
+def create_partitions(cur, now: datetime, hours: int = 14):
+    # Hourly posts partitions, like the firehose makes. Hours that already have one are left alone.
+    hour_start = now.replace(minute=0, second=0, microsecond=0)
+    for hours_ago in range(hours):
+        table_time = hour_start - timedelta(hours=hours_ago)
+        cur.execute('SAVEPOINT partition')
+        try:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS posts_{table_time.strftime('y%Ym%md%dh%H')} PARTITION OF posts FOR VALUES FROM (%s) TO (%s)",
+                        (table_time, table_time + timedelta(hours=1)))
+        except psycopg2.errors.InvalidObjectDefinition:
+            cur.execute('ROLLBACK TO SAVEPOINT partition')
+        cur.execute('RELEASE SAVEPOINT partition')
+
+# The author of each of post_count posts. Post counts per author are heavy-tailed.
+def post_authors(authors, post_count: int, r: Random) -> list:
+    weights = [r.paretovariate(1.2) for _ in authors]
+    return r.choices(authors, weights, k=post_count)
+
+# Posts rows (see storage.py) spread over the last spread_hours, a fifth of them reposts
+def copy_posts(cur, author_ids: list[int], post_count: int, now: datetime, spread_hours: float, r: Random):
+    rows = StringIO()
+    for i, author_id in enumerate(post_authors(author_ids, post_count, r)):
+        cid_key = r.getrandbits(64) - 2**63
+        created_at = now - timedelta(seconds=r.uniform(0, spread_hours * 3600))
+        if r.random() < 0.2:
+            rows.write(f'{author_id}\t{r.choice(author_ids)}\t{i}\t{i}\t{cid_key}\t{created_at.isoformat()}\n')
+        else:
+            rows.write(f'{author_id}\t\\N\t{i}\t\\N\t{cid_key}\t{created_at.isoformat()}\n')
+    rows.seek(0)
+    cur.copy_expert('COPY posts FROM STDIN', rows)
@@ -0,0 +1,200 @@
+import config
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from storage import intern_actors, tid_value
+from threading import BoundedSemaphore, Lock
+
+# Server-side prepared statements, created once per pooled connection so Postgres can reuse their plans.
+# Posts come back as (author DID, rkey, cid_key, subject author DID, subject rkey), with the subject fields
+# null for posts (see storage.py).
+_PREPARED_STATEMENTS = {
+    'followees': """
+        SELECT followee.did
+        FROM actors follower
+        JOIN follows ON follows.follower_id = follower.id
+        JOIN actors followee ON followee.id = follows.followee_id
+        WHERE follower.did = $1""",
+    # The pre-sampling candidate query, kept as the baseline in bench_sampling.py
+    'candidate_posts': """
+        SELECT author.did, posts.rkey, posts.cid_key, subject.did, posts.subject_rkey
+        FROM actors author
+        JOIN posts ON posts.author_id = author.id
+        LEFT JOIN actors subject ON subject.id = posts.subject_author_id
+        WHERE author.did = ANY($1::TEXT[])
+        ORDER BY posts.cid_key
+        LIMIT 1000""",
+    'candidate_posts_no_reposts': """
+        SELECT author.did, posts.rkey, posts.cid_key, NULL, NULL
+        FROM actors author
+        JOIN posts ON posts.author_id = author.id
+        WHERE author.did = ANY($1::TEXT[])
+        AND posts.subject_author_id IS NULL
+        ORDER BY posts.cid_key
+        LIMIT 1000""",
+    'author_post_counts': """
+        SELECT author.did, author.id, count(*)
+        FROM actors author
+        JOIN posts ON posts.author_id = author.id
+        WHERE author.did = ANY($1::TEXT[])
+        GROUP BY author.did, author.id""",
+    'author_post_counts_no_reposts': """
+        SELECT author.did, author.id, count(*)
+        FROM actors author
+        JOIN posts ON posts.author_id = author.id
+        WHERE author.did = ANY($1::TEXT[])
+        AND posts.subject_author_id IS NULL
+        GROUP BY author.did, author.id""",
+    # Authors are passed as both ids and DIDs (from author_post_counts), so only subjects need looking up
+    'author_posts': """
+        SELECT a.did, posts.rkey, posts.cid_key, subject.did, posts.subject_rkey
+        FROM unnest($1::INT[], $2::TEXT[]) AS a(id, did)
+        JOIN posts ON posts.author_id = a.id
+        LEFT JOIN actors subject ON subject.id = posts.subject_author_id""",
+    'author_posts_no_reposts': """
+        SELECT a.did, posts.rkey, posts.cid_key, NULL, NULL
+        FROM unnest($1::INT[], $2::TEXT[]) AS a(id, did)
+        JOIN posts ON posts.author_id = a.id
+        WHERE posts.subject_author_id IS NULL""",
+    # One index probe per author, taking that author's share of the sample in a seeded random order,
+    # so only sampled authors' posts are read and nothing is sorted beyond a single author's posts
+    'sample_posts': """
+        SELECT s.did, p.rkey, p.cid_key, subject.did, p.subject_rkey
+        FROM unnest($1::INT[], $2::TEXT[], $3::INT[]) AS s(id, did, n)
+        CROSS JOIN LATERAL (
+            SELECT rkey, cid_key, subject_author_id, subject_rkey
+            FROM posts
+            WHERE posts.author_id = s.id
+            ORDER BY hashint8extended(posts.cid_key, $4::BIGINT)
+            LIMIT s.n
+        ) p
+        LEFT JOIN actors subject ON subject.id = p.subject_author_id""",
+    'sample_posts_no_reposts': """
+        SELECT s.did, p.rkey, p.cid_key, NULL, NULL
+        FROM unnest($1::INT[], $2::TEXT[], $3::INT[]) AS s(id, did, n)
+        CROSS JOIN LATERAL (
+            SELECT rkey, cid_key
+            FROM posts
+            WHERE posts.author_id = s.id
+            AND posts.subject_author_id IS NULL
+            ORDER BY hashint8extended(posts.cid_key, $4::BIGINT)
+            LIMIT s.n
+        ) p""",
+}
+
+_CONNECT_ARGS = {
+    'database': 'bluesky',
+    'host': 'db',
+    'user': 'postgres',
+    'password': config.DB_PASSWORD,
+    'port': 5432,
+}
+
+class PreparedConnection(Connection):
+    prepared = False
+
+_pool: ThreadedConnectionPool = None
+_pool_lock = Lock()
+# ThreadedConnectionPool raises when it runs out of connections, so requests wait on this instead
+_pool_slots = BoundedSemaphore(config.FEED_SERVER_DB_POOL_SIZE)
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(1, config.FEED_SERVER_DB_POOL_SIZE, connection_factory=PreparedConnection, **_CONNECT_ARGS)
+        return _pool
+
+# Unpooled connection, for long-lived listeners and benchmarks
+def connect(**kwargs):
+    return psycopg2.connect(**_CONNECT_ARGS, **kwargs)
+
+def prepare(con: PreparedConnection):
+    if con.prepared:
+        return
+
+    cur = con.cursor()
+    for name, query in _PREPARED_STATEMENTS.items():
+        cur.execute(f'PREPARE {name} AS {query}')
+    con.commit()
+    con.prepared = True
+
+class PoolTimeout(Exception):
+    ...
+
+# Raises PoolTimeout if no connection frees up within timeout_seconds (None waits as long as it takes)
+@contextmanager
+def connection(timeout_seconds: float = None):
+    if not _pool_slots.acquire(timeout=timeout_seconds):
+        raise PoolTimeout()
+    pool = _get_pool()
+    con: PreparedConnection = None
+    try:
+        con = pool.getconn()
+        prepare(con)
+        yield con
+    # Including KeyboardInterrupt, SystemExit and GeneratorExit, so a connection never goes back mid-transaction
+    except BaseException:
+        if con is not None and not con.closed:
+            con.rollback()
+        raise
+    finally:
+        if con is not None:
+            # Broken connections get thrown away instead of going back into the pool
+            pool.putconn(con, close=con.closed != 0)
+        _pool_slots.release()
+
+# Statements that run longer are cancelled (raising QueryCanceled), until the transaction ends
+def set_statement_timeout(cur, timeout_seconds: float):
+    cur.execute('SET LOCAL statement_timeout = %s', (max(int(timeout_seconds * 1000), 1), ))
+
+def followees(cur, did: str) -> tuple[str, ...]:
+    cur.execute('EXECUTE followees (%s)', (did, ))
+    return tuple(row[0] for row in cur.fetchall())
+
+# follows rows (follower id, followee id, rkey) of the follower's follow uri -> followee DID. Follows whose record
+# keys aren't TIDs can't be stored, and are skipped.
+def follow_rows(actor_ids: dict[str, int], follower: str, follows: dict[str, str]) -> list[tuple[int, int, int]]:
+    rows = []
+    for uri, followee in follows.items():
+        rkey = tid_value(uri[uri.rfind('/') + 1:])
+        if rkey is not None:
+            rows.append((actor_ids[follower], actor_ids[followee], rkey))
+    return rows
+
+# Multi-row INSERTs, so priming a big follow list is a handful of round trips. follows is follow uri -> followee DID.
+def insert_follows(cur, follower: str, follows: dict[str, str]):
+    actor_ids = intern_actors(cur, [follower, *follows.values()])
+    execute_values(cur, 'INSERT INTO follows VALUES %s ON CONFLICT DO NOTHING', follow_rows(actor_ids, follower, follows), page_size=1000)
+
+def candidate_posts(cur, authors: tuple[str, ...], include_reposts: bool) -> list[tuple]:
+    cur.execute(f"EXECUTE {'candidate_posts' if include_reposts else 'candidate_posts_no_reposts'} (%s)", (list(authors), ))
+    return cur.fetchall()
+
+# (author DID, author id, post count) of the authors with any posts
+def author_post_counts(cur, authors: tuple[str, ...], include_reposts: bool) -> list[tuple[str, int, int]]:
+    cur.execute(f"EXECUTE {'author_post_counts' if include_reposts else 'author_post_counts_no_reposts'} (%s)", (list(authors), ))
+    return cur.fetchall()
+
+def author_posts(cur, author_ids: list[int], authors: list[str], include_reposts: bool) -> list[tuple]:
+    cur.execute(f"EXECUTE {'author_posts' if include_reposts else 'author_posts_no_reposts'} (%s, %s)", (author_ids, authors))
+    return cur.fetchall()
+
+def sample_posts(cur, author_ids: list[int], authors: list[str], counts: list[int], sample_seed: int, include_reposts: bool) -> list[tuple]:
+    cur.execute(f"EXECUTE {'sample_posts' if include_reposts else 'sample_posts_no_reposts'} (%s, %s, %s, %s)", (author_ids, authors, counts, sample_seed))
+    return cur.fetchall()
+
+# Newest posts from everyone, for feeds that ran out of time (see fallback.py). Only the last hour is read, so older
+# partitions are pruned.
+def recent_posts(cur, limit: int) -> list[tuple]:
+    cur.execute(
+        """SELECT author.did, posts.rkey, posts.cid_key, subject.did, posts.subject_rkey
+           FROM posts
+           JOIN actors author ON author.id = posts.author_id
+           LEFT JOIN actors subject ON subject.id = posts.subject_author_id
+           WHERE posts.created_at > now() - interval '1 hour'
+           ORDER BY posts.created_at DESC
+           LIMIT %s""", (limit, ))
+    return cur.fetchall()
@@ -0,0 +1,82 @@
+from change_stream import listen
+from collections import OrderedDict
+import db
+from random import Random
+from threading import Lock, Thread
+from time import time
+
+# What a feed request serves when it runs out of its latency budget: the candidates of the user's last feed that was
+# built in time, or failing that, a sample of the newest posts from everyone. Candidates are (author, rkey, cid_key,
+# subject author, subject rkey), as returned by the db's candidate queries, so they're shuffled like any other feed.
+
+class CandidateCache:
+    # The last candidate set built for each (user, include_reposts). Bounded by the total number of posts held, least
+    # recently built first, and never expired, since a stale feed is still better than none.
+    def __init__(self, max_posts: int):
+        self.max_posts = max_posts
+        self.entries: OrderedDict[tuple, list[tuple]] = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> list[tuple]:
+        with self.lock:
+            posts = self.entries.get(key)
+            if posts is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return posts
+
+    def put(self, key: tuple, posts: list[tuple]):
+        if len(posts) > self.max_posts:
+            return
+
+        with self.lock:
+            old_posts = self.entries.pop(key, None)
+            if old_posts is not None:
+                self.size -= len(old_posts)
+            self.entries[key] = posts
+            self.size += len(posts)
+            while self.size > self.max_posts:
+                _, evicted_posts = self.entries.popitem(last=False)
+                self.size -= len(evicted_posts)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'posts': self.size,
+            }
+
+class RecentPosts:
+    # The newest posts and reposts across all authors, re-read in the background
+    def __init__(self, count: int):
+        self.count = count
+        self.posts: list[tuple] = []
+        self.refreshed_at: float = None
+
+    def refresh(self, cur):
+        self.posts = db.recent_posts(cur, self.count)
+        self.refreshed_at = time()
+
+    # Up to sample_size of them, fixed for a given sample_seed
+    def sample(self, include_reposts: bool, sample_size: int, sample_seed: str) -> list[tuple]:
+        posts = self.posts
+        if not include_reposts:
+            posts = [post for post in posts if post[3] is None]
+        if len(posts) > sample_size:
+            posts = Random(sample_seed).sample(posts, sample_size)
+        return posts
+
+# Nothing is listened for, but the listener's reconnecting and idle timeout make it a refresh loop
+def refresh_recent_posts(recent_posts: RecentPosts, interval_seconds: float):
+    listen('Recent posts refresh', db.connect, [], on_connect=recent_posts.refresh, on_idle=recent_posts.refresh, idle_seconds=interval_seconds)
+
+def start_refresher(recent_posts: RecentPosts, interval_seconds: float):
+    Thread(target=refresh_recent_posts, args=(recent_posts, interval_seconds), daemon=True).start()
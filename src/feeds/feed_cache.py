@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+import numpy as np
+from time import monotonic
+
+@dataclass
+class CachedFeed:
+    posts: list[dict]
+    rand_ids: np.ndarray # Sorted shuffle keys, parallel to posts, for checking or finding the cursor position
+    expires_at: float
+
+class FeedCache:
+    # Shuffled candidate lists keyed by (user, seed, include_reposts), so pages after a refresh are
+    # served by slicing instead of re-querying and re-sorting. Bounded by the total number of cached
+    # posts; least recently used feeds are evicted first, and entries expire after a TTL.
+    def __init__(self, max_posts: int, ttl_seconds: float):
+        self.max_posts = max_posts
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[tuple, CachedFeed] = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> CachedFeed:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, posts: list[dict], rand_ids: np.ndarray):
+        if len(posts) > self.max_posts:
+            return
+
+        entry = CachedFeed(posts, rand_ids, monotonic() + self.ttl_seconds)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.size += len(posts)
+
+            # Expired entries go first, then the least recently used ones
+            now = monotonic()
+            for expired_key in [k for k, e in self.entries.items() if e.expires_at <= now]:
+                self._remove(expired_key)
+            while self.size > self.max_posts:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.posts)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'posts': self.size,
+            }
@@ -1,27 +1,91 @@
-from atproto import Client, DidInMemoryCache, IdResolver, models, verify_jwt
+from atproto import IdResolver, verify_jwt
 from atproto.exceptions import TokenInvalidSignatureError
+import auth_cache
+from auth_cache import PersistentDidCache, VerifiedTokenCache
 import config
+from contextlib import contextmanager
+import db
+import fallback
+from fallback import CandidateCache, RecentPosts
+from feed_cache import FeedCache
+import followee_cache
+from followee_cache import FolloweeCache
 from flask import Flask, jsonify, request
-from random import Random
-import psycopg2
-from psycopg2.extras import execute_batch
-from time import time_ns
+import metrics
+import multiprocessing
+from multiprocessing.connection import wait
+import numpy as np
+import ordering
+from priming import PrimingState, Primer
+import psycopg2.errors
+from sampling import DEFAULT_SAMPLE_SIZE, sample_candidates
+import seed_store
+import socket
+from storage import POST_COLLECTION, record_uri, REPOST_COLLECTION
+import timeline
+from timeline import TimelineStore
+from time import monotonic, time, time_ns
 from waitress import serve
 
 SERVICE_DID = f'did:web:{config.HOSTNAME}'
 
-CACHE = DidInMemoryCache()
-ID_RESOLVER = IdResolver(cache=CACHE)
+CACHE = PersistentDidCache(config.FEED_SERVER_DID_CACHE_SIZE, config.FEED_SERVER_DID_CACHE_PATH)
+ID_RESOLVER = IdResolver(plc_url=config.FEED_SERVER_PLC_ENDPOINT or None, timeout=config.FEED_SERVER_DID_TIMEOUT, cache=CACHE)
+TOKEN_CACHE = VerifiedTokenCache(config.FEED_SERVER_TOKEN_CACHE_SIZE)
 
-user_last_seeds: dict[str, int] = {}
+FOLLOWEE_CACHE = FolloweeCache(config.FEED_SERVER_FOLLOWEE_CACHE_SIZE)
+FEED_CACHE = FeedCache(config.FEED_SERVER_FEED_CACHE_SIZE, config.FEED_SERVER_FEED_CACHE_TTL)
+TIMELINE_STORE = TimelineStore() if config.TIMELINE_STORE else None
+# What's served instead when a request runs out of its latency budget
+LAST_CANDIDATES = CandidateCache(config.FEED_SERVER_FALLBACK_CACHE_SIZE)
+RECENT_POSTS = RecentPosts(config.FEED_SERVER_RECENT_POSTS)
+
+def resolve_pds(did: str) -> str:
+    return config.FEED_SERVER_PDS_ENDPOINT or ID_RESOLVER.did.resolve(did).get_pds_endpoint()
+
+PRIMER = Primer(config.FEED_SERVER_PRIMING_WORKERS, resolve_pds, FOLLOWEE_CACHE.put)
+
+metrics.PRIMING_QUEUE_DEPTH.set_function(lambda: PRIMER.stats()['queue_depth'])
+metrics.track_cache('token', TOKEN_CACHE)
+metrics.track_cache('did', CACHE)
+metrics.track_cache('followee', FOLLOWEE_CACHE)
+metrics.track_cache('feed', FEED_CACHE)
+metrics.track_cache('last_candidates', LAST_CANDIDATES)
+metrics.RECENT_POSTS_AGE_SECONDS.set_function(lambda: time() - RECENT_POSTS.refreshed_at if RECENT_POSTS.refreshed_at is not None else float('nan'))
+
+# Per-request details are printed too, not just exported as metrics
+log_requests = config.FEED_SERVER_LOG_REQUESTS
+
+SEED_STORE = seed_store.create(config.FEED_SERVER_SEED_STORE, config.FEED_SERVER_SEED_STORE_SIZE)
 
 class AuthorizationError(Exception):
     ...
 
-def hashcode(text: str, r: Random) -> int:
-    l = list(text)
-    r.shuffle(l)
-    return hash(''.join(l))
+class BudgetExceeded(Exception):
+    # The request's latency budget ran out during stage
+    def __init__(self, stage: str):
+        super().__init__(f'Latency budget exceeded during {stage}')
+        self.stage = stage
+
+def remaining_seconds(deadline: float) -> float:
+    return max(deadline - monotonic(), 0.0)
+
+# Db statements in the block are cancelled at the deadline (a monotonic() time), which raises BudgetExceeded
+@contextmanager
+def budgeted(db_cursor, deadline: float, stage: str):
+    if remaining_seconds(deadline) == 0.0:
+        raise BudgetExceeded(stage)
+    db.set_statement_timeout(db_cursor, remaining_seconds(deadline))
+    try:
+        yield
+    except psycopg2.errors.QueryCanceled:
+        raise BudgetExceeded(stage)
+
+def find_feed_config(feed_uri: str) -> dict:
+    for feed_config in config.FEEDS.values():
+        if feed_config.get('uri') == feed_uri or feed_uri.endswith(f"/{feed_config['record_name']}"):
+            return feed_config
+    return {}
 
 app = Flask(__name__)
 
@@ -29,6 +93,13 @@ app = Flask(__name__)
 def index():
     return 'ATProto Feed Generator powered by The AT Protocol SDK for Python (https://github.com/MarshalX/atproto).'
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Any one worker's metrics would only be a part of the total
+    if config.FEED_SERVER_WORKERS > 1:
+        return f'Each of the {config.FEED_SERVER_WORKERS} workers serves its metrics on its own port, from {config.FEED_SERVER_METRICS_PORT}', 404
+    return metrics.render()
+
 @app.route('/.well-known/did.json', methods=['GET'])
 def did_json():
     return jsonify({
@@ -55,9 +126,15 @@ def describe_feed_generator():
 
 @app.route('/xrpc/app.bsky.feed.getFeedSkeleton', methods=['GET'])
 def get_feed_skeleton():
+    request_start_time = time_ns()
     feed = request.args.get('feed', default=None, type=str)
     include_reposts = feed.endswith('chaos')
-    print(f'Include reposts: {include_reposts}')
+    if log_requests:
+        print(f'Include reposts: {include_reposts}')
+    feed_config = find_feed_config(feed)
+    sample_size = feed_config.get('sample_size', DEFAULT_SAMPLE_SIZE)
+    # Past this, whatever is still running is given up on and a fallback feed is served
+    deadline = monotonic() + feed_config.get('latency_budget_seconds', config.FEED_SERVER_LATENCY_BUDGET)
 
     # Get requester DID
     authorization = request.headers.get('Authorization')
@@ -66,10 +143,18 @@ def get_feed_skeleton():
     if not authorization.startswith('Bearer '):
         return 'Invalid authorization header', 401
     jwt = authorization[len('Bearer '):].strip()
-    try:
-        requester_did = verify_jwt(jwt, ID_RESOLVER.did.resolve_atproto_key).iss
-    except TokenInvalidSignatureError as ex:
-        return f'Invalid signature: {ex}', 401
+    requester_did = TOKEN_CACHE.get(jwt)
+    if requester_did is None:
+        try:
+            payload = verify_jwt(jwt, ID_RESOLVER.did.resolve_atproto_key)
+        except TokenInvalidSignatureError as ex:
+            return f'Invalid signature: {ex}', 401
+        requester_did = payload.iss
+        TOKEN_CACHE.put(jwt, requester_did, payload.exp)
+    if log_requests:
+        token_stats = TOKEN_CACHE.stats()
+        did_stats = CACHE.stats()
+        print(f"Token cache: {token_stats['hits']} hits, {token_stats['misses']} misses. DID cache: {did_stats['hits']} hits, {did_stats['misses']} misses, {did_stats['entries']} entries.")
 
     try:
         cursor = request.args.get('cursor', default=None, type=str)
@@ -77,155 +162,201 @@ def get_feed_skeleton():
         return 'Malformed cursor', 400
 
     limit = request.args.get('limit', default=20, type=int)
-    print(f'Feed refreshed by {requester_did} - cursor = {cursor} - limit = {limit}:')
-
-    db_con = psycopg2.connect(database='bluesky',
-                           host='db',
-                           user='postgres',
-                           password=config.DB_PASSWORD,
-                           port=5432)
-    db_cursor = db_con.cursor()
-
-    # If necessary, populate the requester's following list
-    # (for any people they followed before this feed service started running)
-    db_cursor.execute('SELECT 1 FROM follows WHERE follower = %s', (requester_did, ))
-    if db_cursor.rowcount <= 0:
-        print(f'Priming follows for {requester_did}.')
-
-        start_time = time_ns()
-
-        did_doc = ID_RESOLVER.did.resolve(requester_did)
-        client = Client(did_doc.get_pds_endpoint())
-        follows = client.com.atproto.repo.list_records(models.ComAtprotoRepoListRecords.Params(
-            repo=requester_did,
-            collection=models.ids.AppBskyGraphFollow,
-            limit=100,
-        ))
-        follows_cursor = None
-        authors = []
-        follow_infos = []
-        while True:
-            follows = client.com.atproto.repo.list_records(models.ComAtprotoRepoListRecords.Params(
-                repo=requester_did,
-                collection=models.ids.AppBskyGraphFollow,
-                limit=100,
-                cursor=follows_cursor,
-            ))
-
-            for follow in follows.records:
-                authors.append((
-                    follow.value.subject,
-                    False,
-                ))
-                follow_infos.append((
-                    follow.uri,
-                    requester_did,
-                    follow.value.subject,
-                ))
-
-            follows_cursor = follows.cursor
-            if follows_cursor == None:
-                break
-
-        # Add all follows
-        if len(follow_infos) > 0:
-            db_cursor.execute('ALTER TABLE follows DISABLE TRIGGER check_follows_primed_trigger')
-            execute_batch(db_cursor, 'INSERT INTO follows VALUES(%s, %s, %s) ON CONFLICT DO NOTHING', follow_infos)
-            db_cursor.execute('ALTER TABLE follows ENABLE TRIGGER check_follows_primed_trigger')
-            print(f'Inserted {len(follow_infos)} follows into database.')
-
-        print('Committing queries')
-        db_con.commit()
-
-        end_time = time_ns()
-        elapsed_time_ms = (end_time - start_time) // 1_000_000
-
-        print(f'Time to update follows: {elapsed_time_ms} ms.)')
+    if log_requests:
+        print(f'Feed refreshed by {requester_did} - cursor = {cursor} - limit = {limit}:')
 
+    # See ordering.parse_cursor for the cursor's format
+    cursor_position: int = None
     cursor_rand_id: int = None
+    cursor_seed: int = None
     if cursor is not None:
         try:
-            rand_id_str, did = cursor.split('::')
-            cursor_rand_id = int(rand_id_str)
+            cursor_position, cursor_rand_id, cursor_seed, did = ordering.parse_cursor(cursor)
         except ValueError as ex:
             return f'Malformed cursor "{cursor}"', 400
         if did != requester_did:
             return f'JWT and cursor DID do not match', 400
     limit = limit if limit < 600 else 600
 
-    start_time = time_ns()
-    # Collect posts
-    db_cursor.execute(f"""
-                        SELECT uri, repost_uri, cid_rev
-                        FROM posts
-                        WHERE author IN
-                            (SELECT followee FROM follows WHERE follower = '{requester_did}')
-                        {'AND repost_uri IS NULL' if not include_reposts else ''}
-                        ORDER BY cid_rev
-			LIMIT 1000
-                        """)
-    posts = db_cursor.fetchall()
-    print(f'Num posts: {len(posts)}')
-    end_time = time_ns()
-    elapsed_time_ms = (end_time - start_time) // 1_000_000
-    print(f'Query time: {elapsed_time_ms} ms.')
+    # Pages keep the sorting seed from their cursor. Otherwise it comes from the seed store, shared by every
+    # worker, and an undefined cursor with a larger limit indicates a full refresh, so the seed moves on to
+    # reorder everything.
+    seed = cursor_seed
+    if seed is None and cursor is not None:
+        try:
+            with db.connection(remaining_seconds(deadline)) as db_con:
+                seed = SEED_STORE.get(db_con, requester_did)
+        except db.PoolTimeout:
+            return serve_fallback(requester_did, include_reposts, 0, sample_size, cursor_position, cursor_rand_id, limit, 'db_pool', request_start_time)
 
-    # Get the sorting seed
-    seed = user_last_seeds.get(requester_did, 0)
+    # Pages after a refresh are sliced straight out of the cached shuffled feed (if this worker built it,
+    # otherwise the feed is rebuilt from the same seed)
+    if cursor is not None:
+        cached_feed = FEED_CACHE.get((requester_did, seed, include_reposts))
+        if cached_feed is not None:
+            if log_requests:
+                print('Serving page from feed cache.')
+            page = ordering.feed_page(requester_did, seed, cached_feed.posts, cached_feed.rand_ids, cursor_position, cursor_rand_id, limit)
+            metrics.REQUEST_SECONDS.labels('feed_cache').observe((time_ns() - request_start_time) / 1_000_000_000)
+            return jsonify(page)
 
-    # An undefined cursor and larger limit indicates a full refresh, so we'll update the seed to reorder everything
-    if cursor is None and limit > 20:
-        seed += 1
-        user_last_seeds[requester_did] = seed
+    try:
+        with db.connection(remaining_seconds(deadline)) as db_con:
+            if seed is None:
+                seed = SEED_STORE.increment(db_con, requester_did) if limit > 20 else SEED_STORE.get(db_con, requester_did)
+            db_cursor = db_con.cursor()
+            feed_posts, rand_ids = build_feed(db_cursor, requester_did, include_reposts, seed, sample_size, deadline)
+    except db.PoolTimeout:
+        return serve_fallback(requester_did, include_reposts, seed or 0, sample_size, cursor_position, cursor_rand_id, limit, 'db_pool', request_start_time)
+    except BudgetExceeded as ex:
+        return serve_fallback(requester_did, include_reposts, seed, sample_size, cursor_position, cursor_rand_id, limit, ex.stage, request_start_time)
+
+    FEED_CACHE.put((requester_did, seed, include_reposts), feed_posts, rand_ids)
+    if log_requests:
+        cache_stats = FEED_CACHE.stats()
+        print(f"Feed cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['posts']} posts.")
+
+    page = ordering.feed_page(requester_did, seed, feed_posts, rand_ids, cursor_position, cursor_rand_id, limit)
+    metrics.REQUEST_SECONDS.labels('built').observe((time_ns() - request_start_time) / 1_000_000_000)
+    return jsonify(page)
+
+# Serves the user's last candidate set, or failing that recent posts from everyone, shuffled with the request's seed (0 if
+# the seed store couldn't be reached in time). Not cached, so the next page tries a full build again.
+def serve_fallback(requester_did: str, include_reposts: bool, seed: int, sample_size: int, cursor_position: int, cursor_rand_id: int,
+                   limit: int, stage: str, request_start_time: int):
+    posts = LAST_CANDIDATES.get((requester_did, include_reposts))
+    source = 'last_candidates'
+    if posts is None:
+        posts = RECENT_POSTS.sample(include_reposts, sample_size, f'{requester_did}:{seed}')
+        source = 'recent_posts'
+    metrics.FALLBACKS.labels(source, stage).inc()
+    if log_requests:
+        print(f'Latency budget ran out during {stage}, serving {len(posts)} posts from {source}.')
+
+    feed_posts, rand_ids = shuffle_feed(posts, requester_did, include_reposts, seed)
+    page = ordering.feed_page(requester_did, seed, feed_posts, rand_ids, cursor_position, cursor_rand_id, limit)
+    metrics.REQUEST_SECONDS.labels('fallback').observe((time_ns() - request_start_time) / 1_000_000_000)
+    return jsonify(page)
+
+# Raises BudgetExceeded if the deadline passes before the candidates are in
+def build_feed(db_cursor, requester_did: str, include_reposts: bool, seed: int, sample_size: int, deadline: float) -> tuple[list[dict], np.ndarray]:
+    # Followees rarely change between pages, so they come from the cache when possible
+    followees, generation = FOLLOWEE_CACHE.get(requester_did)
+    if followees is None:
+        start_time = time_ns()
+        try:
+            with budgeted(db_cursor, deadline, 'followees'):
+                followees = db.followees(db_cursor, requester_did)
+            metrics.QUERY_SECONDS.labels('followees', 'db').observe((time_ns() - start_time) / 1_000_000_000)
+            if len(followees) > 0:
+                FOLLOWEE_CACHE.put(requester_did, followees, generation)
+        finally:
+            FOLLOWEE_CACHE.end_fill(requester_did)
+    if log_requests:
+        cache_stats = FOLLOWEE_CACHE.stats()
+        print(f"Followee cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries.")
+
+    # If necessary, populate the requester's following list in the background
+    # (for any people they followed before this feed service started running)
+    if len(followees) == 0:
+        job = PRIMER.prime(requester_did)
+        wait_seconds = min(config.FEED_SERVER_PRIMING_WAIT, remaining_seconds(deadline))
+        job.finished.wait(wait_seconds)
+        # A slow priming serves a partial feed from the follows fetched so far; the next refresh gets the full one
+        followees = tuple(job.followees)
+        metrics.PRIMING_WAITS.labels(job.state).inc()
+        if log_requests:
+            print(f'Priming follows for {requester_did}: {job.state}, {len(followees)} follows so far. Priming queue depth: {PRIMER.stats()["queue_depth"]}.')
+        # Unless the budget cut the wait short before any follows came in
+        if len(followees) == 0 and job.state in (PrimingState.Queued, PrimingState.Running) and wait_seconds < config.FEED_SERVER_PRIMING_WAIT:
+            raise BudgetExceeded('priming')
+
+    start_time = time_ns()
+    # Collect a random sample of posts, fixed for this user and seed
+    sample_seed = f'{requester_did}:{seed}'
+    if TIMELINE_STORE is not None and TIMELINE_STORE.ready:
+        posts_source = 'timeline_store'
+        posts = TIMELINE_STORE.candidates(followees, include_reposts, sample_size, sample_seed)
+    else:
+        posts_source = 'db'
+        with budgeted(db_cursor, deadline, 'candidates'):
+            posts = sample_candidates(db_cursor, followees, include_reposts, sample_size, sample_seed)
+    end_time = time_ns()
+    metrics.QUERY_SECONDS.labels('candidates', posts_source).observe((end_time - start_time) / 1_000_000_000)
+    metrics.CANDIDATES.observe(len(posts))
+    if log_requests:
+        elapsed_time_ms = (end_time - start_time) // 1_000_000
+        print(f'Num posts: {len(posts)}')
+        print(f'Query time ({posts_source}): {elapsed_time_ms} ms.')
+    LAST_CANDIDATES.put((requester_did, include_reposts), posts)
 
-    r = Random(seed)
+    return shuffle_feed(posts, requester_did, include_reposts, seed)
 
+# Candidates in this user and seed's order, as skeleton feed items, with the shuffle key of each
+def shuffle_feed(posts: list[tuple], requester_did: str, include_reposts: bool, seed: int) -> tuple[list[dict], np.ndarray]:
     start_time = time_ns()
+    order, rand_ids = ordering.shuffle([cid_key for _, _, cid_key, _, _ in posts], ordering.shuffle_key(requester_did, seed))
     feed = []
-    for uri, repost_uri, cid_rev in posts:
+    for index in order:
+        author, rkey, _, subject_author, subject_rkey = posts[index]
         post: dict
-        if include_reposts and repost_uri is not None and repost_uri != '':
+        if include_reposts and subject_author is not None:
             post = {
-                'post': repost_uri,
+                'post': record_uri(subject_author, POST_COLLECTION, subject_rkey),
                 'reason': {
                     '$type': 'app.bsky.feed.defs#skeletonReasonRepost',
-                    'repost': uri,
+                    'repost': record_uri(author, REPOST_COLLECTION, rkey),
                 },
-                'rand_id': hashcode(cid_rev, r),
             }
         else:
             post = {
-                'post': uri,
-                'rand_id': hashcode(cid_rev, r),
+                'post': record_uri(author, POST_COLLECTION if subject_author is None else REPOST_COLLECTION, rkey),
             }
         
         feed.append(post)
-    
-    feed.sort(key=lambda p: p['rand_id'])
-
-    # Find position based on rand_id from cursor
-    position = 0
-    if cursor_rand_id is not None:
-        for post in feed:
-            if post['rand_id'] > cursor_rand_id:
-                break
-            position += 1
-
-    # Slice feed from position to limit
-    feed_slice = feed[position:position+limit]
-    if len(feed_slice) > 0:
-        cursor_rand_id = feed_slice[-1]['rand_id']
-
-    cursor = f'{cursor_rand_id}::{requester_did}'
 
     end_time = time_ns()
-    elapsed_time_ms = (end_time - start_time) // 1_000_000
-    print(f'Sort time: {elapsed_time_ms} ms.')
-
-    body = { 'cursor': cursor, 'feed': feed_slice }
-    
-    return jsonify(body)
+    metrics.SORT_SECONDS.observe((end_time - start_time) / 1_000_000_000)
+    if log_requests:
+        elapsed_time_ms = (end_time - start_time) // 1_000_000
+        print(f'Sort time: {elapsed_time_ms} ms.')
+
+    return feed, rand_ids
+
+# Everything with threads is started here, after worker processes are forked
+def run_worker(sockets: list[socket.socket] = None, worker_index: int = None):
+    if worker_index is not None and config.FEED_SERVER_METRICS_PORT > 0:
+        metrics.serve(config.FEED_SERVER_METRICS_PORT + worker_index)
+    PRIMER.start()
+    auth_cache.start_saver(CACHE, config.FEED_SERVER_DID_CACHE_SAVE_INTERVAL)
+    followee_cache.start_listener(FOLLOWEE_CACHE)
+    if TIMELINE_STORE is not None:
+        timeline.start_listener(TIMELINE_STORE)
+    fallback.start_refresher(RECENT_POSTS, config.FEED_SERVER_RECENT_POSTS_REFRESH)
+    print('Server started!')
+    if sockets is not None:
+        serve(app, sockets=sockets)
+    else:
+        serve(app, host='0.0.0.0', port=5000)
 
 if __name__ == '__main__':
-    print('Server started!')
-    serve(app, host='0.0.0.0', port=5000)
+    CACHE.load()
+    setup_con = db.connect()
+    SEED_STORE.setup(setup_con)
+    setup_con.close()
+
+    if config.FEED_SERVER_WORKERS > 1:
+        # Every worker process accepts connections from the same listening socket
+        server_socket = socket.create_server(('0.0.0.0', 5000), backlog=1024)
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=run_worker, args=([server_socket], index)) for index in range(config.FEED_SERVER_WORKERS)]
+        for worker in workers:
+            worker.start()
+        print(f'Started {len(workers)} feed server workers.')
+        wait([worker.sentinel for worker in workers])
+        print('A feed server worker exited! Restarting...')
+        for worker in workers:
+            worker.terminate()
+        exit(1)
+    else:
+        run_worker()
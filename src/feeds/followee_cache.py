@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from change_stream import FOLLOWS_CHANGED_CHANNEL, listen
+import db
+from threading import Lock, Thread
+
+class FolloweeCache:
+    # LRU of follower -> followee DIDs. Memory is bounded by the total number of followees held across all
+    # entries, since a few users following thousands of accounts dominate the size.
+    def __init__(self, max_followees: int):
+        self.max_followees = max_followees
+        self.entries: OrderedDict[str, tuple[str, ...]] = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        # Followers whose followees are being read from the db right now: [generation, reads in flight]. An
+        # invalidation that lands while a read is in flight bumps the generation, so only reads started after it
+        # get cached. Removed once the last read finishes, cached or not.
+        self.pending_fills: dict[str, list[int]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # On a miss, returns None and the generation to pass to put, and the caller must call end_fill once its read is done
+    def get(self, follower: str) -> tuple[tuple[str, ...], int]:
+        with self.lock:
+            followees = self.entries.get(follower)
+            if followees is None:
+                self.misses += 1
+                fill = self.pending_fills.setdefault(follower, [0, 0])
+                fill[1] += 1
+                return None, fill[0]
+            self.entries.move_to_end(follower)
+            self.hits += 1
+            return followees, None
+
+    # Without a generation (priming, which just stored the follows itself) the followees are always cached
+    def put(self, follower: str, followees: tuple[str, ...], generation: int = None):
+        with self.lock:
+            if generation is not None:
+                fill = self.pending_fills.get(follower)
+                if fill is None or fill[0] != generation:
+                    return
+            if len(followees) > self.max_followees:
+                return
+
+            old_followees = self.entries.pop(follower, None)
+            if old_followees is not None:
+                self.size -= len(old_followees)
+            self.entries[follower] = followees
+            self.size += len(followees)
+
+            while self.size > self.max_followees:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def end_fill(self, follower: str):
+        with self.lock:
+            fill = self.pending_fills.get(follower)
+            if fill is None:
+                return
+            fill[1] -= 1
+            if fill[1] <= 0:
+                del self.pending_fills[follower]
+
+    def invalidate(self, follower: str):
+        with self.lock:
+            fill = self.pending_fills.get(follower)
+            if fill is not None:
+                fill[0] += 1
+            followees = self.entries.pop(follower, None)
+            if followees is not None:
+                self.size -= len(followees)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            for fill in self.pending_fills.values():
+                fill[0] += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'followees': self.size,
+            }
+
+def _clear(cache: FolloweeCache):
+    # Anything could have changed while we weren't listening
+    cache.clear()
+    print('Listening for follow changes.')
+
+# The firehose sends the DID of each primed follower whose follows changed, once the change is committed
+def listen_for_follow_changes(cache: FolloweeCache):
+    listen('Follow change listener', db.connect, [FOLLOWS_CHANGED_CHANNEL],
+           on_connect=lambda cur: _clear(cache), on_notify=lambda cur, payload: cache.invalidate(payload))
+
+def start_listener(cache: FolloweeCache):
+    Thread(target=listen_for_follow_changes, args=(cache, ), daemon=True).start()
@@ -0,0 +1,34 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest, Histogram, start_http_server
+
+# Prometheus metrics for the feed server, served at /metrics by the Flask app (see render), or by each worker process
+# on its own port when there are several (see serve)
+
+_QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUEST_SECONDS = Histogram('feeds_request_seconds', 'getFeedSkeleton time, by where the page came from', ['source'], buckets=_QUERY_BUCKETS)
+QUERY_SECONDS = Histogram('feeds_query_seconds', 'Time to fetch followees or candidate posts, by query and source', ['query', 'source'], buckets=_QUERY_BUCKETS)
+SORT_SECONDS = Histogram('feeds_sort_seconds', 'Time to shuffle candidates into a feed', buckets=_QUERY_BUCKETS)
+CANDIDATES = Histogram('feeds_candidates', 'Candidate posts per built feed', buckets=(0, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+PRIMING_SECONDS = Histogram('feeds_priming_seconds', "Time to fetch and store a new user's follows, by outcome", ['state'], buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0))
+PRIMING_WAITS = Counter('feeds_priming_waits', 'Feed requests that waited on priming, by the state priming was in when they stopped waiting', ['state'])
+FALLBACKS = Counter('feeds_fallbacks', 'Feeds served from a fallback after the latency budget ran out, by fallback and the stage that ran out of time', ['source', 'stage'])
+
+PRIMING_QUEUE_DEPTH = Gauge('feeds_priming_queue_depth', 'Users waiting for their follows to be primed')
+CACHE_ENTRIES = Gauge('feeds_cache_entries', 'Entries held in each in-memory cache', ['cache'])
+CACHE_HITS = Gauge('feeds_cache_hits', 'Hits of each in-memory cache since startup', ['cache'])
+CACHE_MISSES = Gauge('feeds_cache_misses', 'Misses of each in-memory cache since startup', ['cache'])
+RECENT_POSTS_AGE_SECONDS = Gauge('feeds_recent_posts_age_seconds', 'Seconds since the fallback recent posts were last refreshed')
+
+# Exposes a cache's stats() counts, read on each scrape
+def track_cache(name: str, cache):
+    CACHE_ENTRIES.labels(name).set_function(lambda: cache.stats()['entries'])
+    CACHE_HITS.labels(name).set_function(lambda: cache.stats()['hits'])
+    CACHE_MISSES.labels(name).set_function(lambda: cache.stats()['misses'])
+
+def render() -> tuple[bytes, int, dict[str, str]]:
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+def serve(port: int):
+    if port > 0:
+        start_http_server(port)
+        print(f'Serving metrics on port {port}.')
@@ -0,0 +1,131 @@
+import argparse
+from atproto_crypto.consts import P256_CURVE_ORDER, P256_JWT_ALG
+from atproto_crypto.did import format_multikey
+from bisect import bisect_left, bisect_right
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from random import Random
+from storage import tid_string
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+# Stand-in PDS serving com.atproto.repo.listRecords for follow records, so priming can be run and timed locally.
+# Every repo deterministically follows `follows` of `universe` synthetic accounts (see mock_did).
+# Also stands in for the PLC directory, serving each DID's document with a signing key derived from the DID,
+# so bench_feeds.py can sign request JWTs that the feed server verifies as usual.
+# Run with: python mock_pds.py --port 5001, and set feed_server.pds_endpoint (and plc_endpoint) to 'http://localhost:5001'
+
+def mock_did(index: int) -> str:
+    return f'did:plc:mock{index:020d}'
+
+def mock_follows(did: str, follow_count: int, universe: int) -> list[str]:
+    return Random(did).sample(range(universe), min(follow_count, universe))
+
+def mock_signing_key(did: str) -> ec.EllipticCurvePrivateKey:
+    secret = int.from_bytes(sha256(did.encode()).digest(), 'big') % (P256_CURVE_ORDER - 1) + 1
+    return ec.derive_private_key(secret, ec.SECP256R1())
+
+def mock_did_document(did: str, pds_endpoint: str) -> dict:
+    public_key = mock_signing_key(did).public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {
+        '@context': ['https://www.w3.org/ns/did/v1', 'https://w3id.org/security/multikey/v1'],
+        'id': did,
+        'alsoKnownAs': [f'at://{did.split(":")[-1]}.mock.test'],
+        'verificationMethod': [{
+            'id': f'{did}#atproto',
+            'type': 'Multikey',
+            'controller': did,
+            'publicKeyMultibase': format_multikey(P256_JWT_ALG, public_key),
+        }],
+        'service': [{
+            'id': '#atproto_pds',
+            'type': 'AtprotoPersonalDataServer',
+            'serviceEndpoint': pds_endpoint,
+        }],
+    }
+
+class MockPds:
+    def __init__(self, follow_count: int, universe: int, latency_seconds: float):
+        self.follow_count = follow_count
+        self.universe = universe
+        self.latency_seconds = latency_seconds
+
+    # Follow records in rkey order, like the repo's MST. The rkeys are TIDs, since priming skips anything else.
+    def records(self, did: str) -> list[tuple[str, str]]:
+        return [(tid_string(rkey), mock_did(index)) for rkey, index in enumerate(mock_follows(did, self.follow_count, self.universe))]
+
+    def list_records(self, did: str, limit: int, cursor: str, reverse: bool) -> dict:
+        records = self.records(did)
+        rkeys = [rkey for rkey, _ in records]
+        # Newest (highest rkey) first by default, oldest first when reversed; the cursor is the last rkey returned
+        if reverse:
+            start = 0 if cursor is None else bisect_right(rkeys, cursor)
+            page = records[start:start + limit]
+        else:
+            end = len(records) if cursor is None else bisect_left(rkeys, cursor)
+            page = records[max(end - limit, 0):end][::-1]
+
+        sleep(self.latency_seconds)
+        response = {
+            'records': [{
+                'uri': f'at://{did}/app.bsky.graph.follow/{rkey}',
+                'cid': 'bafyreih6mockmockmockmockmockmockmockmockmockmockmockmock',
+                'value': {
+                    '$type': 'app.bsky.graph.follow',
+                    'subject': subject,
+                    'createdAt': '2024-01-01T00:00:00.000Z',
+                },
+            } for rkey, subject in page],
+        }
+        if len(page) == limit:
+            response['cursor'] = page[-1][0]
+        return response
+
+def make_handler(pds: MockPds):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            if url.path.startswith('/did:plc:'):
+                response = mock_did_document(url.path[1:], f'http://{self.headers.get("Host")}')
+            elif url.path == '/xrpc/com.atproto.repo.listRecords' and params.get('collection') == 'app.bsky.graph.follow':
+                response = pds.list_records(
+                    params['repo'],
+                    min(int(params.get('limit', 50)), 100),
+                    params.get('cursor'),
+                    params.get('reverse') == 'true',
+                )
+            else:
+                self.send_error(404)
+                return
+
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=5001)
+    arg_parser.add_argument('--follows', type=int, default=1000, help='Follows per repo')
+    arg_parser.add_argument('--universe', type=int, default=100_000, help='Number of distinct followable accounts')
+    arg_parser.add_argument('--latency-ms', type=float, default=50.0, help='Added delay per listRecords page')
+    args = arg_parser.parse_args()
+
+    pds = MockPds(args.follows, args.universe, args.latency_ms / 1000)
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), make_handler(pds))
+    print(f'Mock PDS listening on port {args.port}.')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
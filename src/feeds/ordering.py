@@ -0,0 +1,68 @@
+import numpy as np
+import zlib
+
+# Deterministic shuffling of a whole candidate list in one vectorized pass. Each post gets a 64-bit key
+# from a keyed hash of its cid_key (splitmix64-style mixing), and the feed order is the posts sorted by key.
+# Unlike hash(), the keys are the same in every process and across restarts.
+
+_GAMMA = np.uint64(0x9e3779b97f4a7c15)
+_MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_2 = np.uint64(0x94d049bb133111eb)
+
+def _mix(z: np.ndarray) -> np.ndarray:
+    z = (z ^ (z >> np.uint64(30))) * _MIX_1
+    z = (z ^ (z >> np.uint64(27))) * _MIX_2
+    return z ^ (z >> np.uint64(31))
+
+def shuffle_key(requester_did: str, seed: int) -> int:
+    return (zlib.crc32(requester_did.encode()) << 32) ^ (seed & 0xffffffff)
+
+def permutation_keys(cid_keys: list[int], key: int) -> np.ndarray:
+    words = np.array(cid_keys, dtype=np.int64).view(np.uint64)
+    with np.errstate(over='ignore'):
+        hashes = np.full(len(cid_keys), np.uint64(key & 0xffffffffffffffff), dtype=np.uint64)
+        return _mix(_mix(hashes + _GAMMA) ^ words)
+
+# Returns the indexes of cid_keys in shuffled order, and each one's key in that order (ascending)
+def shuffle(cid_keys: list[int], key: int) -> tuple[np.ndarray, np.ndarray]:
+    keys = permutation_keys(cid_keys, key)
+    order = np.argsort(keys, kind='stable')
+    return order, keys[order]
+
+# Cursors are "<position>:<rand_id>:<seed>::<did>" - the position in the shuffled feed to continue from, the rand_id
+# (key) of the last post served, used to find the place again if the feed was rebuilt in between, and the seed the
+# feed was shuffled with. Older "<position>:<rand_id>::<did>" cursors have no seed. Returns (position, rand_id, seed,
+# did), and raises ValueError for a malformed cursor. Cursors from before keyed shuffling ("<rand_id>::<did>", a
+# hash() that's often negative) and keys out of range can't be placed in the feed, so those restart from the top.
+def parse_cursor(cursor: str) -> tuple[int, int, int, str]:
+    position_str, did = cursor.split('::')
+    fields = [int(field) for field in position_str.split(':')]
+    if len(fields) not in (2, 3):
+        if len(fields) != 1:
+            raise ValueError(f'Expected 1 to 3 fields, got {len(fields)}')
+        return None, None, None, did
+    position, rand_id = fields[:2]
+    seed = fields[2] if len(fields) == 3 else None
+    if not 0 <= rand_id < 2**64:
+        return None, None, seed, did
+    return position, rand_id, seed, did
+
+# Slices a page of limit posts out of the shuffled feed, continuing from the cursor's place in it
+def feed_page(requester_did: str, seed: int, feed: list[dict], rand_ids: np.ndarray, cursor_position: int, cursor_rand_id: int, limit: int) -> dict:
+    # The cursor's position is used directly if the post before it is still the one the cursor was given for,
+    # otherwise the position is found from the rand_id
+    position = 0
+    if cursor_position is not None and 0 < cursor_position <= len(rand_ids) and rand_ids[cursor_position - 1] == cursor_rand_id:
+        position = cursor_position
+    elif cursor_rand_id is not None:
+        position = int(np.searchsorted(rand_ids, np.uint64(cursor_rand_id), side='right'))
+
+    # Slice feed from position to limit
+    feed_slice = feed[position:position+limit]
+    if len(feed_slice) == 0:
+        return { 'feed': feed_slice }
+
+    end_position = position + len(feed_slice)
+    cursor = f'{end_position}:{rand_ids[end_position - 1]}:{seed}::{requester_did}'
+
+    return { 'cursor': cursor, 'feed': feed_slice }
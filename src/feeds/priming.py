@@ -0,0 +1,182 @@
+from atproto import Client, models, Request
+from change_stream import FOLLOWS_PRIMED_CHANNEL
+import config
+from dataclasses import dataclass, field
+import db
+import metrics
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import time
+
+# Filling in the follows of users who haven't used the feed since before we started following the firehose.
+# Runs on a pool of background workers, so feed requests never wait on a slow PDS.
+
+class PrimingState:
+    Queued = 'queued'
+    Running = 'running'
+    Done = 'done'
+    Failed = 'failed'
+
+@dataclass
+class PrimingJob:
+    did: str
+    state: str = PrimingState.Queued
+    queued_at: float = field(default_factory=time)
+    started_at: float = None
+    finished_at: float = None
+    # Grows as pages arrive, so requests made while priming can serve a partial feed
+    followees: list[str] = field(default_factory=lambda: [])
+    error: str = None
+    finished: Event = field(default_factory=Event)
+
+    def duration(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time()) - self.started_at
+
+class _PageWalk:
+    # Shared state of the two directions of a listRecords walk: newest-first and oldest-first, each
+    # stopping once it reaches records the other has already seen
+    def __init__(self):
+        self.lock = Lock()
+        self.records: dict[str, str] = {} # follow uri -> followee did
+        self.lowest_newest_first: str = None
+        self.highest_oldest_first: str = None
+
+def _rkey(uri: str) -> str:
+    return uri[uri.rfind('/') + 1:]
+
+def _walk_follows(client: Client, did: str, reverse: bool, walk: _PageWalk, job: PrimingJob):
+    cursor = None
+    while True:
+        page = client.com.atproto.repo.list_records(models.ComAtprotoRepoListRecords.Params(
+            repo=did,
+            collection=models.ids.AppBskyGraphFollow,
+            limit=100,
+            cursor=cursor,
+            reverse=reverse,
+        ))
+
+        with walk.lock:
+            met = False
+            for record in page.records:
+                rkey = _rkey(record.uri)
+                if reverse:
+                    met = walk.lowest_newest_first is not None and rkey >= walk.lowest_newest_first
+                else:
+                    met = walk.highest_oldest_first is not None and rkey <= walk.highest_oldest_first
+                if met:
+                    break
+
+                if record.uri not in walk.records:
+                    walk.records[record.uri] = record.value.subject
+                    job.followees.append(record.value.subject)
+                if reverse:
+                    walk.highest_oldest_first = rkey
+                else:
+                    walk.lowest_newest_first = rkey
+
+        cursor = page.cursor
+        if met or cursor is None or len(page.records) == 0:
+            return
+
+# Pages through the repo's follow records from both ends at once, roughly halving the time for big follow lists
+def list_follows(client: Client, did: str, job: PrimingJob) -> dict[str, str]:
+    walk = _PageWalk()
+    errors = []
+    def walk_direction(reverse: bool):
+        try:
+            _walk_follows(client, did, reverse, walk, job)
+        except Exception as ex:
+            errors.append(ex)
+
+    oldest_first = Thread(target=walk_direction, args=(True, ), daemon=True)
+    oldest_first.start()
+    walk_direction(False)
+    oldest_first.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return walk.records
+
+# Own connection rather than a pooled one, so waiting feed requests can't starve priming of connections
+def store_follows(did: str, follows: dict[str, str]):
+    db_con = db.connect()
+    try:
+        db_cursor = db_con.cursor()
+        if len(follows) > 0:
+            db.insert_follows(db_cursor, did, follows)
+        # From here on the firehose keeps this user's new follows
+        db_cursor.execute('SELECT pg_notify(%s, %s)', (FOLLOWS_PRIMED_CHANNEL, did))
+        db_con.commit()
+    finally:
+        db_con.close()
+
+class Primer:
+    def __init__(self, worker_count: int, resolve_pds, on_primed):
+        self.resolve_pds = resolve_pds
+        self.on_primed = on_primed
+        self.queue: Queue[PrimingJob] = Queue()
+        self.jobs: dict[str, PrimingJob] = {}
+        self.lock = Lock()
+        self.completed = 0
+        self.failed = 0
+        self.total_duration = 0.0
+        self.workers = [Thread(target=self._work, daemon=True) for _ in range(worker_count)]
+
+    # Separate from __init__, so each forked feed server worker process starts its own threads
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    # Queues priming for the user unless it's already queued or running
+    def prime(self, did: str) -> PrimingJob:
+        with self.lock:
+            job = self.jobs.get(did)
+            if job is not None and job.state in (PrimingState.Queued, PrimingState.Running):
+                return job
+            job = self.jobs[did] = PrimingJob(did)
+        self.queue.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.state = PrimingState.Running
+            job.started_at = time()
+            try:
+                client = Client(self.resolve_pds(job.did), Request(timeout=config.FEED_SERVER_PRIMING_REQUEST_TIMEOUT))
+                follows = list_follows(client, job.did, job)
+                store_follows(job.did, follows)
+                job.followees = list(follows.values())
+                job.state = PrimingState.Done
+                self.on_primed(job.did, tuple(job.followees))
+            except Exception as ex:
+                job.error = str(ex).strip()
+                job.state = PrimingState.Failed
+            job.finished_at = time()
+            job.finished.set()
+            metrics.PRIMING_SECONDS.labels(job.state).observe(job.duration())
+
+            with self.lock:
+                if job.state == PrimingState.Done:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.total_duration += job.duration()
+                # Requests waiting on the job hold their own reference, so it can be forgotten here
+                if self.jobs.get(job.did) is job:
+                    del self.jobs[job.did]
+
+            print(f'Priming {job.state} for {job.did}: {len(job.followees)} follows in {job.duration() * 1000:.0f} ms.'
+                  f'{f" Error: {job.error}" if job.error else ""} Queue depth: {self.queue.qsize()}.')
+
+    def stats(self) -> dict[str, float]:
+        with self.lock:
+            finished = self.completed + self.failed
+            return {
+                'queue_depth': self.queue.qsize(),
+                'running': sum(1 for job in self.jobs.values() if job.state == PrimingState.Running),
+                'completed': self.completed,
+                'failed': self.failed,
+                'average_duration_ms': self.total_duration / finished * 1000 if finished > 0 else 0.0,
+            }
@@ -0,0 +1,38 @@
+from bisect import bisect_right
+import db
+from itertools import accumulate
+from random import Random
+import zlib
+
+DEFAULT_SAMPLE_SIZE = 1000
+
+# Splits a uniform sample of sample_size posts (without replacement) across authors, given how many
+# posts each author has. Every post is equally likely to be picked, however many posts its author has.
+def allocate_sample(author_counts: list[tuple[str, int]], sample_size: int, r: Random) -> tuple[list[str], list[int]]:
+    cumulative_counts = list(accumulate(count for _, count in author_counts))
+    allocated = [0] * len(author_counts)
+    for index in r.sample(range(cumulative_counts[-1]), sample_size):
+        allocated[bisect_right(cumulative_counts, index)] += 1
+
+    authors = []
+    counts = []
+    for (author, _), count in zip(author_counts, allocated):
+        if count > 0:
+            authors.append(author)
+            counts.append(count)
+    return authors, counts
+
+# Uniform random sample of up to sample_size of the followees' posts. The sample is fixed for a given
+# sample_seed (so pages of one shuffle agree), and a new seed draws a new sample.
+def sample_candidates(cur, followees: tuple[str, ...], include_reposts: bool, sample_size: int, sample_seed: str) -> list[tuple]:
+    author_counts = db.author_post_counts(cur, followees, include_reposts)
+    total_count = sum(count for _, _, count in author_counts)
+    if total_count <= sample_size:
+        return db.author_posts(cur, [author_id for _, author_id, _ in author_counts], [author for author, _, _ in author_counts], include_reposts)
+
+    # Sorted so the allocation only depends on the seed, not on the order Postgres returned the counts in
+    author_counts.sort()
+    author_ids = {author: author_id for author, author_id, _ in author_counts}
+    authors, counts = allocate_sample([(author, count) for author, _, count in author_counts], sample_size, Random(sample_seed))
+    # Postgres orders each author's posts by a hash of their cid_keys seeded with this
+    return db.sample_posts(cur, [author_ids[author] for author in authors], authors, counts, zlib.crc32(sample_seed.encode()), include_reposts)
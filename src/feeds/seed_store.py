@@ -0,0 +1,81 @@
+from hashlib import blake2b
+import mmap
+import multiprocessing
+import numpy as np
+
+# Each user's shuffle seed, moved on by every full refresh. Kept out of the worker's own memory so any feed
+# server worker process (or, with the postgres backend, any replica) can serve any user.
+# Both backends take the request's pooled db connection, which the postgres one commits.
+
+class PostgresSeedStore:
+    def setup(self, con):
+        con.cursor().execute(
+            """CREATE TABLE IF NOT EXISTS feed_seeds(
+                did TEXT PRIMARY KEY,
+                seed INT NOT NULL
+            )""")
+        con.commit()
+
+    def get(self, con, did: str) -> int:
+        cur = con.cursor()
+        cur.execute('SELECT seed FROM feed_seeds WHERE did = %s', (did, ))
+        row = cur.fetchone()
+        con.commit()
+        return row[0] if row is not None else 0
+
+    def increment(self, con, did: str) -> int:
+        cur = con.cursor()
+        cur.execute('INSERT INTO feed_seeds VALUES(%s, 1) ON CONFLICT (did) DO UPDATE SET seed = feed_seeds.seed + 1 RETURNING seed', (did, ))
+        seed = cur.fetchone()[0]
+        con.commit()
+        return seed
+
+# Probes before a full run of slots gives up and reuses the DID's first slot
+_MAX_PROBES = 32
+
+class SharedMemorySeedStore:
+    # Open-addressed table of 64-bit DID hashes and seeds in an anonymous shared mapping, created before the
+    # worker processes are forked so they all share it. Only for workers on one host. When the table is too
+    # full, a DID can take over another's slot, which only resets that user's seed.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = mmap.mmap(-1, capacity * 12)
+        self.keys = np.frombuffer(self.buffer, dtype=np.uint64, count=capacity)
+        self.seeds = np.frombuffer(self.buffer, dtype=np.int32, count=capacity, offset=capacity * 8)
+        self.lock = multiprocessing.get_context('fork').Lock()
+
+    def setup(self, con):
+        pass
+
+    def _find(self, key: int) -> int:
+        home = key % self.capacity
+        for probe in range(_MAX_PROBES):
+            slot = (home + probe) % self.capacity
+            if self.keys[slot] == key or self.keys[slot] == 0:
+                return slot
+        return home
+
+    def get(self, con, did: str) -> int:
+        key = _did_key(did)
+        with self.lock:
+            slot = self._find(key)
+            return int(self.seeds[slot]) if self.keys[slot] == key else 0
+
+    def increment(self, con, did: str) -> int:
+        key = _did_key(did)
+        with self.lock:
+            slot = self._find(key)
+            if self.keys[slot] != key:
+                self.keys[slot] = key
+                self.seeds[slot] = 0
+            self.seeds[slot] += 1
+            return int(self.seeds[slot])
+
+# Never 0, which marks an empty slot
+def _did_key(did: str) -> int:
+    return int.from_bytes(blake2b(did.encode(), digest_size=8).digest(), 'little') | 1
+
+def create(backend: str, capacity: int):
+    if backend == 'shared_memory':
+        return SharedMemorySeedStore(capacity)
+    return PostgresSeedStore()
@@ -0,0 +1,55 @@
+import change_stream
+from change_stream import listen
+import pytest
+
+class Stop(BaseException):
+    ...
+
+class StubListenCursor:
+    def __init__(self):
+        self.executed: list[str] = []
+
+    def execute(self, query: str, params: tuple = None):
+        self.executed.append(query)
+
+class StubListenConnection:
+    # Delivers its payloads on the first poll, then has nothing more
+    def __init__(self, payloads: list[str]):
+        self.autocommit = False
+        self.notifies = []
+        self.payloads = payloads
+        self.cur = StubListenCursor()
+        self.closed = False
+
+    def cursor(self) -> StubListenCursor:
+        return self.cur
+
+    def poll(self):
+        self.notifies.extend(type('Notify', (), {'payload': payload}) for payload in self.payloads)
+        self.payloads = []
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(change_stream.select, 'select', lambda *args: ([], [], []))
+    monkeypatch.setattr(change_stream, 'sleep', lambda seconds: None)
+
+def test_listen_reconnects_and_reloads_after_an_error(no_waiting):
+    connections = [StubListenConnection(['a', 'bad']), StubListenConnection(['c'])]
+    connects = iter(connections)
+    events = []
+    def on_notify(cur, payload: str):
+        if payload == 'bad':
+            raise ValueError(payload)
+        events.append(payload)
+    def on_idle(cur):
+        raise Stop()
+    # Stop isn't an Exception, so it ends the loop once the second connection has gone idle
+    with pytest.raises(Stop):
+        listen('Test listener', lambda: next(connects), ['channel'], on_connect=lambda cur: events.append('connect'),
+               on_notify=on_notify, on_idle=on_idle, on_error=lambda: events.append('error'))
+    assert connections[0].closed and not connections[1].closed
+    assert events == ['connect', 'a', 'error', 'connect', 'c']
+    assert all(con.autocommit and con.cur.executed == ['LISTEN channel'] for con in connections)
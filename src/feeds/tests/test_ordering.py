@@ -0,0 +1,42 @@
+import numpy as np
+import ordering
+import pytest
+
+DID = 'did:plc:requester'
+
+def shuffled_feed(count: int, seed: int) -> tuple[list[dict], np.ndarray]:
+    order, rand_ids = ordering.shuffle(list(range(count)), ordering.shuffle_key(DID, seed))
+    return [{'post': f'at://did:plc:author/app.bsky.feed.post/{index}'} for index in order], rand_ids
+
+def test_pages_follow_each_other():
+    feed, rand_ids = shuffled_feed(50, 7)
+    first = ordering.feed_page(DID, 7, feed, rand_ids, None, None, 20)
+    position, rand_id, seed, did = ordering.parse_cursor(first['cursor'])
+    assert (position, seed, did) == (20, 7, DID)
+    second = ordering.feed_page(DID, seed, feed, rand_ids, position, rand_id, 20)
+    assert first['feed'] + second['feed'] == feed[:40]
+
+def test_rebuilt_feed_continues_after_cursor_key():
+    feed, rand_ids = shuffled_feed(50, 7)
+    position, rand_id, _, _ = ordering.parse_cursor(ordering.feed_page(DID, 7, feed, rand_ids, None, None, 20)['cursor'])
+    # The same posts minus the first one served, so the cursor's position no longer matches
+    page = ordering.feed_page(DID, 7, feed[1:], rand_ids[1:], position, rand_id, 20)
+    assert page['feed'] == feed[20:40]
+
+def test_legacy_cursor_with_negative_rand_id_restarts():
+    feed, rand_ids = shuffled_feed(50, 7)
+    position, rand_id, seed, did = ordering.parse_cursor(f'-12345::{DID}')
+    assert (position, rand_id, seed, did) == (None, None, None, DID)
+    assert ordering.feed_page(DID, 7, feed, rand_ids, position, rand_id, 20)['feed'] == feed[:20]
+
+@pytest.mark.parametrize('rand_id', [-1, 2**64])
+def test_out_of_range_rand_id_restarts(rand_id: int):
+    feed, rand_ids = shuffled_feed(50, 7)
+    position, rand_id, seed, _ = ordering.parse_cursor(f'20:{rand_id}:7::{DID}')
+    assert (position, rand_id, seed) == (None, None, 7)
+    assert ordering.feed_page(DID, seed, feed, rand_ids, position, rand_id, 20)['feed'] == feed[:20]
+
+@pytest.mark.parametrize('cursor', ['', 'abc::did:plc:x', '1:2:3:4::did:plc:x', '1:2::did:plc:x::extra', '12345'])
+def test_malformed_cursor(cursor: str):
+    with pytest.raises(ValueError):
+        ordering.parse_cursor(cursor)
@@ -0,0 +1,61 @@
+import db
+from http.server import ThreadingHTTPServer
+from itertools import count
+from mock_pds import make_handler, mock_did, mock_follows, MockPds
+import priming
+from priming import PrimingState, Primer
+import pytest
+from threading import Thread
+
+FOLLOW_COUNT = 250
+UNIVERSE = 1000
+
+class RecordingPds(MockPds):
+    # Also remembers the direction of every listRecords page served
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.directions: list[bool] = []
+
+    def list_records(self, did: str, limit: int, cursor: str, reverse: bool) -> dict:
+        self.directions.append(reverse)
+        return super().list_records(did, limit, cursor, reverse)
+
+@pytest.fixture
+def pds() -> RecordingPds:
+    return RecordingPds(FOLLOW_COUNT, UNIVERSE, 0.0)
+
+@pytest.fixture
+def pds_endpoint(pds: RecordingPds):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(pds))
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+def test_primer_stores_every_follow(pds: RecordingPds, pds_endpoint: str, monkeypatch):
+    # The rows store_follows would insert, with actor ids handed out as DIDs are first seen
+    next_id = count()
+    actor_ids: dict[str, int] = {}
+    stored: dict[str, list[tuple]] = {}
+    def store_follows(did: str, follows: dict[str, str]):
+        for actor in (did, *follows.values()):
+            if actor not in actor_ids:
+                actor_ids[actor] = next(next_id)
+        stored[did] = db.follow_rows(actor_ids, did, follows)
+    monkeypatch.setattr(priming, 'store_follows', store_follows)
+
+    primed = {}
+    primer = Primer(1, lambda did: pds_endpoint, lambda did, followees: primed.setdefault(did, followees))
+    primer.start()
+    did = mock_did(UNIVERSE + 1)
+    job = primer.prime(did)
+    assert job.finished.wait(30.0)
+    assert job.state == PrimingState.Done, job.error
+
+    # The walk pages from both ends, and together they cover every record exactly once
+    assert set(pds.directions) == {False, True}
+    assert len(pds.directions) < 2 * FOLLOW_COUNT // 100 + 2
+    followees = [mock_did(index) for index in mock_follows(did, FOLLOW_COUNT, UNIVERSE)]
+    assert sorted(primed[did]) == sorted(followees)
+    # The mock's rkeys are TIDs of each follow's position, so none of them are skipped
+    assert sorted(stored[did]) == sorted((actor_ids[did], actor_ids[followee], rkey) for rkey, followee in enumerate(followees))
@@ -0,0 +1,235 @@
+from array import array
+from change_stream import decode_post_changes, listen, POSTS_CHANGED_CHANNEL
+import db
+from random import Random
+from storage import parse_uri, REPOST_COLLECTION
+from threading import Lock, Thread
+from time import time
+
+_HOUR = 3600
+
+class TimelineBucket:
+    # One hour of posts and reposts, stored column-wise. Numeric columns live in typed arrays, and each
+    # author's rows are an array of row indexes, so memory grows with post count rather than with objects. A dict
+    # of each row's key finds duplicates and deletes without scanning the author's rows.
+    def __init__(self, hour_start: int):
+        self.hour_start = hour_start
+        self.author_ids = array('I')
+        self.created_at = array('d')
+        self.deleted = array('b')
+        self.rkeys = array('q')
+        self.cid_keys = array('q')
+        # Reposted post's author and rkey, -1 and 0 for posts
+        self.subject_author_ids = array('i')
+        self.subject_rkeys = array('q')
+        self.rows_by_author: dict[int, array] = {}
+        # (author, rkey, is_repost) -> row, for rows that aren't deleted
+        self.rows_by_key: dict[tuple[int, int, bool], int] = {}
+        # Every author id the bucket's rows refer to, as author or reposted author
+        self.referenced_author_ids: set[int] = set()
+
+    def find(self, author_id: int, rkey: int, is_repost: bool) -> int:
+        return self.rows_by_key.get((author_id, rkey, is_repost), -1)
+
+    def delete(self, row: int):
+        self.deleted[row] = True
+        del self.rows_by_key[(self.author_ids[row], self.rkeys[row], self.subject_author_ids[row] >= 0)]
+
+    def add(self, author_id: int, rkey: int, cid_key: int, subject_author_id: int, subject_rkey: int, created_at: float):
+        row = len(self.rkeys)
+        self.author_ids.append(author_id)
+        self.created_at.append(created_at)
+        self.deleted.append(False)
+        self.rkeys.append(rkey)
+        self.cid_keys.append(cid_key)
+        self.subject_author_ids.append(subject_author_id)
+        self.subject_rkeys.append(subject_rkey)
+        author_rows = self.rows_by_author.get(author_id)
+        if author_rows is None:
+            author_rows = self.rows_by_author[author_id] = array('I')
+        author_rows.append(row)
+        self.rows_by_key[(author_id, rkey, subject_author_id >= 0)] = row
+
+class TimelineStore:
+    # Per-author timelines of every stored post and repost over the retention window, kept as a ring of
+    # hourly buckets (mirroring the hourly posts partitions) so expiring an hour just drops its bucket
+    def __init__(self, retention_hours: int = 13):
+        self.retention_seconds = retention_hours * _HOUR
+        self.lock = Lock()
+        self.ready = False
+        self._reset()
+
+    def _reset(self):
+        self.author_ids: dict[str, int] = {}
+        self.author_dids: list[str] = []
+        # Number of buckets referring to each author id. Ids no bucket refers to any more are freed and reused.
+        self.author_refs = array('I')
+        self.free_author_ids: list[int] = []
+        self.buckets: dict[int, TimelineBucket] = {}
+        self.post_count = 0
+
+    def _author_id(self, author: str) -> int:
+        author_id = self.author_ids.get(author)
+        if author_id is None:
+            if len(self.free_author_ids) > 0:
+                author_id = self.free_author_ids.pop()
+                self.author_dids[author_id] = author
+            else:
+                author_id = len(self.author_dids)
+                self.author_dids.append(author)
+                self.author_refs.append(0)
+            self.author_ids[author] = author_id
+        return author_id
+
+    def _reference(self, bucket: TimelineBucket, author_id: int):
+        if author_id not in bucket.referenced_author_ids:
+            bucket.referenced_author_ids.add(author_id)
+            self.author_refs[author_id] += 1
+
+    def _release(self, author_id: int):
+        self.author_refs[author_id] -= 1
+        if self.author_refs[author_id] == 0:
+            del self.author_ids[self.author_dids[author_id]]
+            self.author_dids[author_id] = None
+            self.free_author_ids.append(author_id)
+
+    # Rows are (author, rkey, cid_key, subject author, subject rkey, created_at), as in the posts table but with DIDs
+    def _add(self, author: str, rkey: int, cid_key: int, subject_author: str, subject_rkey: int, created_at: float):
+        is_repost = subject_author is not None
+        hour_start = int(created_at) - int(created_at) % _HOUR
+        if hour_start + _HOUR <= time() - self.retention_seconds:
+            return
+
+        bucket = self.buckets.get(hour_start)
+        if bucket is None:
+            bucket = self.buckets[hour_start] = TimelineBucket(hour_start)
+
+        author_id = self._author_id(author)
+        if bucket.find(author_id, rkey, is_repost) >= 0:
+            return
+        self._reference(bucket, author_id)
+        if is_repost:
+            subject_author_id = self._author_id(subject_author)
+            self._reference(bucket, subject_author_id)
+            bucket.add(author_id, rkey, cid_key, subject_author_id, subject_rkey, created_at)
+        else:
+            bucket.add(author_id, rkey, cid_key, -1, 0, created_at)
+        self.post_count += 1
+
+    def _delete(self, uri: str):
+        record = parse_uri(uri)
+        if record is None:
+            return
+        author, collection, rkey = record
+        author_id = self.author_ids.get(author)
+        if author_id is None:
+            return
+        is_repost = collection == REPOST_COLLECTION
+        for bucket in self.buckets.values():
+            row = bucket.find(author_id, rkey, is_repost)
+            if row >= 0:
+                bucket.delete(row)
+                self.post_count -= 1
+                return
+
+    def _expire(self):
+        cutoff = time() - self.retention_seconds
+        for hour_start in [hour_start for hour_start in self.buckets if hour_start + _HOUR <= cutoff]:
+            bucket = self.buckets.pop(hour_start)
+            self.post_count -= len(bucket.rkeys) - sum(bucket.deleted)
+            for author_id in bucket.referenced_author_ids:
+                self._release(author_id)
+
+    def apply_changes(self, payload: str):
+        with self.lock:
+            for change in decode_post_changes(payload):
+                if change[0] == '+':
+                    self._add(*change[1:])
+                else:
+                    self._delete(change[1])
+            self._expire()
+
+    # Uniform random sample of up to sample_size of the followees' posts, fixed for a given sample_seed. Posts are
+    # (author, rkey, cid_key, subject author, subject rkey), like the db's candidate queries.
+    def candidates(self, followees: tuple[str, ...], include_reposts: bool, sample_size: int, sample_seed: str) -> list[tuple]:
+        with self.lock:
+            self._expire()
+            rows = []
+            for followee in sorted(followees):
+                author_id = self.author_ids.get(followee)
+                if author_id is None:
+                    continue
+                for hour_start in sorted(self.buckets):
+                    bucket = self.buckets[hour_start]
+                    for row in bucket.rows_by_author.get(author_id, ()):
+                        if bucket.deleted[row] or (bucket.subject_author_ids[row] >= 0 and not include_reposts):
+                            continue
+                        rows.append((bucket, row))
+
+            if len(rows) > sample_size:
+                rows = Random(sample_seed).sample(rows, sample_size)
+
+            posts = []
+            for bucket, row in rows:
+                author = self.author_dids[bucket.author_ids[row]]
+                subject_author_id = bucket.subject_author_ids[row]
+                if subject_author_id >= 0:
+                    posts.append((author, bucket.rkeys[row], bucket.cid_keys[row], self.author_dids[subject_author_id], bucket.subject_rkeys[row]))
+                else:
+                    posts.append((author, bucket.rkeys[row], bucket.cid_keys[row], None, None))
+            return posts
+
+    def load(self, con):
+        # Built off to the side and swapped in, so requests keep being served (from SQL) while it loads
+        loaded = TimelineStore(self.retention_seconds // _HOUR)
+        cur = con.cursor(name='timeline_load')
+        cur.itersize = 10_000
+        cur.execute(
+            """SELECT author.did, posts.rkey, posts.cid_key, subject.did, posts.subject_rkey, EXTRACT(EPOCH FROM posts.created_at)::FLOAT8
+               FROM posts
+               JOIN actors author ON author.id = posts.author_id
+               LEFT JOIN actors subject ON subject.id = posts.subject_author_id""")
+        for row in cur:
+            loaded._add(*row)
+        cur.close()
+        con.commit()
+
+        with self.lock:
+            self.author_ids = loaded.author_ids
+            self.author_dids = loaded.author_dids
+            self.author_refs = loaded.author_refs
+            self.free_author_ids = loaded.free_author_ids
+            self.buckets = loaded.buckets
+            self.post_count = loaded.post_count
+            self.ready = True
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'ready': self.ready,
+                'posts': self.post_count,
+                'authors': len(self.author_ids),
+                'buckets': len(self.buckets),
+            }
+
+def _load(store: TimelineStore):
+    # Changes that land while loading are queued on the listening connection and applied after,
+    # and adds that were already loaded are skipped as duplicates
+    store.ready = False
+    start_time = time()
+    load_con = db.connect()
+    try:
+        store.load(load_con)
+    finally:
+        load_con.close()
+    print(f'Loaded {store.stats()["posts"]} posts into timeline store in {time() - start_time:.1f} seconds.')
+
+def _not_ready(store: TimelineStore):
+    store.ready = False
+
+def listen_for_post_changes(store: TimelineStore):
+    listen('Timeline store listener', db.connect, [POSTS_CHANGED_CHANNEL], on_connect=lambda cur: _load(store),
+           on_notify=lambda cur, payload: store.apply_changes(payload), on_error=lambda: _not_ready(store))
+
+def start_listener(store: TimelineStore):
+    Thread(target=listen_for_post_changes, args=(store, ), daemon=True).start()
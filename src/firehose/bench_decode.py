@@ -0,0 +1,93 @@
+from atproto import AtUri, CAR, firehose_models, models, parse_subscribe_repos_message
+import argparse
+from dataclasses import dataclass
+from decoder import decode_commit
+from records import ActionType, RecordType
+from synthetic import FrameGenerator
+from time import perf_counter_ns
+
+# Micro-benchmark of per-commit decode cost: the previous full pydantic decode vs. decoder.decode_commit
+# Run with: python bench_decode.py --frames 20000
+
+_FULL_DECODE_RECORDS = [
+    (RecordType.Post, models.AppBskyFeedPost, models.ids.AppBskyFeedPost),
+    (RecordType.Like, models.AppBskyFeedLike, models.ids.AppBskyFeedLike),
+    (RecordType.Follow, models.AppBskyGraphFollow, models.ids.AppBskyGraphFollow),
+    (RecordType.Repost, models.AppBskyFeedRepost, models.ids.AppBskyFeedRepost),
+]
+
+# The record type from before records.Record, holding the full model of each create
+@dataclass
+class FullRecord:
+    record_type: RecordType
+    action_type: ActionType
+    record_info: dict
+
+# The decode path from before collection filtering: every op gets an AtUri and every create a full model
+def decode_commit_full(message: firehose_models.MessageFrame) -> list[FullRecord]:
+    records: list[FullRecord] = []
+
+    commit = parse_subscribe_repos_message(message)
+    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+        return records
+
+    if not commit.blocks:
+        return records
+
+    car = CAR.from_bytes(commit.blocks)
+    for op in commit.ops:
+        if op.action == 'update':
+            continue
+
+        uri = AtUri.from_str(f'at://{commit.repo}/{op.path}')
+
+        if op.action == 'create':
+            if not op.cid:
+                continue
+
+            record_raw_data = car.blocks.get(op.cid)
+            if not record_raw_data:
+                continue
+
+            record = models.get_or_create(record_raw_data, strict=False)
+            for record_type, record_module, record_nsid in _FULL_DECODE_RECORDS:
+                if uri.collection == record_nsid and models.is_record_type(record, record_module):
+                    create_info = {'record': record, 'uri': str(uri), 'cid': str(op.cid), 'author': commit.repo}
+                    records.append(FullRecord(record_type, ActionType.Created, create_info))
+
+        if op.action == 'delete':
+            for record_type, _, record_nsid in _FULL_DECODE_RECORDS:
+                if uri.collection == record_nsid:
+                    records.append(FullRecord(record_type, ActionType.Deleted, {'uri': str(uri)}))
+
+    return records
+
+def run(name: str, decode, messages: list[firehose_models.MessageFrame]) -> float:
+    record_count = 0
+    start_time = perf_counter_ns()
+    for message in messages:
+        record_count += len(decode(message))
+    elapsed_ns = perf_counter_ns() - start_time
+    per_commit_us = elapsed_ns / len(messages) / 1000
+    print(f'{name}: {per_commit_us:.1f} us/commit, {len(messages) / (elapsed_ns / 1e9):.0f} commits/sec, {record_count} records')
+    return per_commit_us
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--frames', type=int, default=20000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    generator = FrameGenerator(seed=args.seed)
+    messages = [firehose_models.Frame.from_bytes(frame) for frame in generator.frames(args.frames)]
+
+    # Warm up both paths so model/schema caches are built before timing
+    decode_commit_full(messages[0])
+    decode_commit(messages[0])
+
+    full_us = run('Full decode', decode_commit_full, messages)
+    lazy_us = run('Lazy decode', decode_commit, messages)
+    print(f'Speedup: {full_us / lazy_us:.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+from atproto import firehose_models
+from bench_decode import decode_commit_full, FullRecord
+from datetime import datetime, timezone
+from dateutil import parser
+from decoder import decode_commit, parse_timestamp
+import gc
+import pickle
+from records import ActionType, Record, RecordType
+from synthetic import FrameGenerator
+from time import perf_counter_ns
+import tracemalloc
+
+# Memory per queued record for each record representation the ingest queue has used, on synthetic frames:
+# - model: the full atproto model of each create in a dict (the original, which also queued likes)
+# - dict: a dict of just the stored fields, created_at still a string
+# - tuple: records.Record, created_at parsed to epoch seconds
+# Also compares the created_at parse, and the pickled size sent from decode workers.
+# Run with: python bench_records.py --frames 20000
+
+# The dict representation, rebuilt from a Record with the fields it used to carry
+def dict_record(record: Record) -> FullRecord:
+    if record.action_type == ActionType.Deleted:
+        return FullRecord(record.record_type, record.action_type, {'uri': record.uri})
+    if record.record_type == RecordType.Follow:
+        return FullRecord(record.record_type, record.action_type, {'uri': record.uri, 'author': record.author, 'subject': record.subject})
+
+    # Records only keep 8 bytes of the CID now, so this stands in for the full CID string of the usual length
+    cid = f'bafyrei{record.cid_key & 0xffffffffffffffff:052x}'
+    info = {'uri': record.uri, 'cid': cid, 'author': record.author,
+            'created_at': datetime.fromtimestamp(record.created_at, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')}
+    if record.record_type == RecordType.Post:
+        info['reply'] = record.reply
+    else:
+        info['subject_uri'] = record.subject
+    return FullRecord(record.record_type, record.action_type, info)
+
+def measure(name: str, build) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    records = build()
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bytes_per_record = (after - before) / len(records)
+    pickled_bytes = len(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)) / len(records)
+    print(f'{name}: {bytes_per_record:.0f} bytes/record queued, {pickled_bytes:.0f} bytes/record pickled ({len(records)} records)')
+    return bytes_per_record
+
+def time_parse(name: str, parse, values: list[str]):
+    start_time = perf_counter_ns()
+    for value in values:
+        parse(value)
+    print(f'{name}: {(perf_counter_ns() - start_time) / len(values) / 1000:.2f} us/timestamp')
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--frames', type=int, default=20000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    generator = FrameGenerator(seed=args.seed)
+    messages = [firehose_models.Frame.from_bytes(frame) for frame in generator.frames(args.frames)]
+    decode_commit_full(messages[0])
+
+    model_bytes = measure('model', lambda: [record for message in messages for record in decode_commit_full(message)])
+    # Each representation is built from a fresh decode, so none of them share strings with another
+    dict_bytes = measure('dict', lambda: [dict_record(record) for message in messages for record in decode_commit(message)])
+    tuple_bytes = measure('tuple', lambda: [record for message in messages for record in decode_commit(message)])
+    print(f'Tuple records take {model_bytes / tuple_bytes:.1f}x less memory than model records, {dict_bytes / tuple_bytes:.1f}x less than dict records.')
+
+    records = [record for message in messages for record in decode_commit(message)]
+    created_ats = [dict_record(record).record_info['created_at'] for record in records if record.created_at is not None]
+    time_parse('dateutil isoparse', lambda value: parser.isoparse(value).astimezone(timezone.utc), created_ats)
+    time_parse('parse_timestamp', parse_timestamp, created_ats)
+
+if __name__ == '__main__':
+    main()
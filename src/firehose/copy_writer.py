@@ -0,0 +1,72 @@
+import config
+from datetime import datetime, timezone
+from io import BytesIO
+import struct
+
+# Binary COPY format: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_TRAILER = struct.pack('!h', -1)
+_NULL_FIELD = struct.pack('!i', -1)
+
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def encode_text(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('!i', len(data)) + data
+
+def encode_int4(value: int) -> bytes:
+    return struct.pack('!ii', 4, value)
+
+def encode_int8(value: int) -> bytes:
+    return struct.pack('!iq', 8, value)
+
+def encode_timestamptz(value: datetime) -> bytes:
+    # Postgres stores timestamptz as microseconds since 2000-01-01 UTC
+    delta = value - _PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return struct.pack('!iq', 8, micros)
+
+POST_COLUMNS = (encode_int4, encode_int4, encode_int8, encode_int8, encode_int8, encode_timestamptz) # author_id, subject_author_id, rkey, subject_rkey, cid_key, created_at
+FOLLOW_COLUMNS = (encode_int4, encode_int4, encode_int8) # follower_id, followee_id, rkey
+FOLLOW_KEY_COLUMNS = (encode_int4, encode_int8) # follower_id, rkey
+
+def encode_rows(rows: list[tuple], encoders: tuple) -> BytesIO:
+    buffer = BytesIO()
+    buffer.write(_COPY_HEADER)
+    field_count = struct.pack('!h', len(encoders))
+    for row in rows:
+        buffer.write(field_count)
+        for value, encoder in zip(row, encoders):
+            buffer.write(_NULL_FIELD if value is None else encoder(value))
+    buffer.write(_COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+def copy_rows(cur, table: str, rows: list[tuple], encoders: tuple):
+    cur.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT binary)', encode_rows(rows, encoders))
+
+def create_staging_tables(cur):
+    # Temp tables are never WAL-logged and are private to this connection, and ON COMMIT DELETE ROWS
+    # empties them at the end of every flush without needing a separate TRUNCATE
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS posts_staging (LIKE posts) ON COMMIT DELETE ROWS')
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS follows_staging (LIKE follows) ON COMMIT DELETE ROWS')
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS follows_deleted_staging (follower_id INT, rkey BIGINT) ON COMMIT DELETE ROWS')
+
+def write_rows(cur, post_rows: list[tuple], follow_rows: list[tuple], deleted_follow_rows: list[tuple]):
+    if len(post_rows) > 0:
+        copy_rows(cur, 'posts_staging', post_rows, POST_COLUMNS)
+        cur.execute('INSERT INTO posts SELECT * FROM posts_staging ON CONFLICT DO NOTHING')
+        if config.FIREHOSE_LOG_FLUSHES:
+            print(f'Inserted {cur.rowcount} posts and reposts into database.')
+
+    if len(follow_rows) > 0:
+        copy_rows(cur, 'follows_staging', follow_rows, FOLLOW_COLUMNS)
+        cur.execute('INSERT INTO follows SELECT * FROM follows_staging ON CONFLICT DO NOTHING')
+        if config.FIREHOSE_LOG_FLUSHES:
+            print(f'Inserted {cur.rowcount} follows into database.')
+
+    if len(deleted_follow_rows) > 0:
+        copy_rows(cur, 'follows_deleted_staging', deleted_follow_rows, FOLLOW_KEY_COLUMNS)
+        cur.execute('DELETE FROM follows USING follows_deleted_staging d WHERE follows.follower_id = d.follower_id AND follows.rkey = d.rkey')
+        if config.FIREHOSE_LOG_FLUSHES:
+            print(f'Deleted {cur.rowcount} follows from database.')
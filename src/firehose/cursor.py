@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+import heapq
+from threading import Lock
+
+CURSOR_ID = 'firehose'
+
+def create_cursor_table(cur):
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS firehose_cursor(
+            id TEXT PRIMARY KEY,
+            seq BIGINT NOT NULL
+        )"""
+    )
+
+def load_cursor(cur, cursor_id: str = CURSOR_ID) -> int:
+    cur.execute('SELECT seq FROM firehose_cursor WHERE id = %s', (cursor_id, ))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def save_cursor(cur, seq: int, cursor_id: str = CURSOR_ID):
+    cur.execute('INSERT INTO firehose_cursor VALUES(%s, %s) ON CONFLICT (id) DO UPDATE SET seq = EXCLUDED.seq', (cursor_id, seq))
+
+class CursorTracker:
+    # Tracks which firehose seqs have had all of their records put on the record queue.
+    # Frames can finish out of order when decoded in parallel, so the safe cursor is the highest seq
+    # with every earlier started frame also finished.
+    def __init__(self):
+        self.lock = Lock()
+        self.pending: list[int] = []
+        self.finished: set[int] = set()
+        self.watermark: int = None
+        self.last_event_time: str = None
+
+    def frame_started(self, seq: int):
+        with self.lock:
+            heapq.heappush(self.pending, seq)
+
+    def frame_finished(self, seq: int, event_time: str):
+        with self.lock:
+            self.finished.add(seq)
+            while len(self.pending) > 0 and self.pending[0] in self.finished:
+                done_seq = heapq.heappop(self.pending)
+                self.finished.remove(done_seq)
+                self.watermark = done_seq
+            if event_time:
+                self.last_event_time = event_time
+
+    def frame_done(self, seq: int, event_time: str):
+        self.frame_started(seq)
+        self.frame_finished(seq, event_time)
+
+    def low_watermark(self) -> int:
+        with self.lock:
+            return self.watermark
+
+    # Seconds between the newest decoded event and now
+    def lag(self) -> float:
+        event_time = self.last_event_time
+        if event_time is None:
+            return 0.0
+        try:
+            event_dt = datetime.fromisoformat(event_time)
+        except ValueError:
+            return 0.0
+        if event_dt.tzinfo is None:
+            event_dt = event_dt.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - event_dt).total_seconds()
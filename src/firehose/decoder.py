@@ -0,0 +1,221 @@
+from atproto import firehose_models, models
+from cursor import CursorTracker
+from datetime import datetime, timezone
+from dateutil import parser
+from ingest_buffer import IngestBuffer
+import libipld
+import multiprocessing
+from queue import Empty
+from records import ActionType, Record, RecordType
+from storage import cid_key
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep, time
+import zlib
+
+# Collections we store, keyed by NSID. Likes aren't used by either feed, so they're dropped here too.
+_INTERESTED_COLLECTIONS: dict[str, RecordType] = {
+    models.ids.AppBskyFeedPost: RecordType.Post,
+    models.ids.AppBskyGraphFollow: RecordType.Follow,
+    models.ids.AppBskyFeedRepost: RecordType.Repost,
+}
+
+# createdAt is almost always RFC 3339, which the C datetime.fromisoformat handles; anything else goes through
+# dateutil. Timestamps without a zone are taken as UTC. Returns None for unparseable dates.
+def parse_timestamp(value: str) -> float:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            parsed = parser.isoparse(value)
+        except (ValueError, OverflowError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    try:
+        return parsed.timestamp()
+    except (ValueError, OverflowError):
+        return None
+
+# Each of these pulls only the fields that get written to the db out of the raw dag-cbor record
+def _post_record(raw: dict, uri: str, cid: bytes, author: str) -> Record:
+    created_at = raw.get('createdAt')
+    if not isinstance(created_at, str):
+        return None
+    created_at = parse_timestamp(created_at)
+    if created_at is None:
+        return None
+    return Record(RecordType.Post, ActionType.Created, uri, author, cid_key(cid), created_at, reply=bool(raw.get('reply')))
+
+def _repost_record(raw: dict, uri: str, cid: bytes, author: str) -> Record:
+    created_at = raw.get('createdAt')
+    if not isinstance(created_at, str):
+        return None
+    created_at = parse_timestamp(created_at)
+    if created_at is None:
+        return None
+    subject = raw.get('subject')
+    subject_uri = subject.get('uri') if isinstance(subject, dict) else None
+    return Record(RecordType.Repost, ActionType.Created, uri, author, cid_key(cid), created_at, subject_uri)
+
+def _follow_record(raw: dict, uri: str, cid: bytes, author: str) -> Record:
+    subject = raw.get('subject')
+    if not isinstance(subject, str):
+        return None
+    return Record(RecordType.Follow, ActionType.Created, uri, author, subject=subject)
+
+_RECORD_DECODERS = {
+    RecordType.Post: _post_record,
+    RecordType.Repost: _repost_record,
+    RecordType.Follow: _follow_record,
+}
+
+def decode_commit(message: firehose_models.MessageFrame) -> list[Record]:
+    records: list[Record] = []
+
+    if message.type != '#commit':
+        return records
+
+    # Works on the raw frame body rather than the pydantic commit model. Ops are filtered on the collection
+    # in their path before anything else, and the CAR blocks are only decoded once an interesting create shows up.
+    body = message.body
+    repo: str = body.get('repo')
+    blocks: dict[bytes, dict] = None
+    for op in body.get('ops') or []:
+        action = op.get('action')
+        if action == 'update':
+            continue
+
+        path: str = op.get('path') or ''
+        collection = path[:path.find('/')]
+        record_type = _INTERESTED_COLLECTIONS.get(collection)
+        if record_type is None:
+            continue
+
+        uri = f'at://{repo}/{path}'
+
+        if action == 'create':
+            cid: bytes = op.get('cid')
+            if not cid:
+                continue
+
+            if blocks is None:
+                if not body.get('blocks'):
+                    return records
+                _, blocks = libipld.decode_car(body['blocks'])
+
+            record_raw_data = blocks.get(cid)
+            if not record_raw_data or record_raw_data.get('$type') != collection:
+                continue
+
+            record = _RECORD_DECODERS[record_type](record_raw_data, uri, cid, repo)
+            if record is not None:
+                records.append(record)
+
+        if action == 'delete':
+            records.append(Record(record_type, ActionType.Deleted, uri))
+
+    return records
+
+def repo_shard(repo: str, shard_count: int) -> int:
+    # zlib.crc32 rather than hash(), since hash() of a str is randomized per process
+    return zlib.crc32(repo.encode()) % shard_count
+
+def _decode_worker(input_queue: multiprocessing.Queue, output_queue: multiprocessing.Queue, max_batch_size: int):
+    while True:
+        messages = [input_queue.get()]
+        while len(messages) < max_batch_size:
+            try:
+                messages.append(input_queue.get_nowait())
+            except Empty:
+                break
+
+        frames: list[tuple[int, str]] = []
+        records: list[Record] = []
+        for message in messages:
+            if message is None:
+                output_queue.put((frames, records))
+                return
+
+            try:
+                records.extend(decode_commit(message))
+            except Exception as ex:
+                print(f'Failed to decode frame: {ex}')
+            frames.append((message.body.get('seq'), message.body.get('time')))
+
+        output_queue.put((frames, records))
+
+class DecodePool:
+    def __init__(self, worker_count: int, record_queue: IngestBuffer, cursor_tracker: CursorTracker, keep_record = None, max_backlog: int = 10_000, max_batch_size: int = 100, report_interval: float = 10.0):
+        self.record_queue = record_queue
+        # Submitting blocks while max_backlog frames are waiting to be decoded, so a full record queue
+        # (which blocks the collector) pushes back on the websocket thread too
+        self.backlog_slots = BoundedSemaphore(max_backlog)
+        self.blocked_submits = 0
+        self.keep_record = keep_record
+        self.cursor_tracker = cursor_tracker
+        self.report_interval = report_interval
+
+        self.frames_submitted = 0
+        self.frames_decoded = 0
+        self.lock = Lock()
+
+        # Every frame from a given repo goes to the same worker, and each worker handles its frames in order,
+        # so a create followed by a delete of the same record is always queued in that order
+        self.output_queue = multiprocessing.Queue()
+        self.input_queues = [multiprocessing.Queue() for _ in range(worker_count)]
+        self.workers = [multiprocessing.Process(target=_decode_worker, args=(input_queue, self.output_queue, max_batch_size), daemon=True)
+                        for input_queue in self.input_queues]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        Thread(target=self._collect, daemon=True).start()
+        Thread(target=self._report, daemon=True).start()
+
+    def submit(self, message: firehose_models.MessageFrame):
+        # Only commits have records we care about, so skip everything else before paying to send it to a worker
+        if message.type != '#commit':
+            return
+
+        repo = message.body.get('repo')
+        if not repo:
+            return
+
+        if not self.backlog_slots.acquire(blocking=False):
+            self.blocked_submits += 1
+            self.backlog_slots.acquire()
+
+        self.cursor_tracker.frame_started(message.body.get('seq'))
+        self.input_queues[repo_shard(repo, len(self.input_queues))].put(message)
+        with self.lock:
+            self.frames_submitted += 1
+
+    def backlog(self) -> int:
+        with self.lock:
+            return self.frames_submitted - self.frames_decoded
+
+    def _collect(self):
+        while True:
+            frames, records = self.output_queue.get()
+            for record in records:
+                if self.keep_record is None or self.keep_record(record):
+                    self.record_queue.put(record)
+            for seq, event_time in frames:
+                self.cursor_tracker.frame_finished(seq, event_time)
+                self.backlog_slots.release()
+            with self.lock:
+                self.frames_decoded += len(frames)
+
+    def _report(self):
+        last_frames_decoded = 0
+        last_report_time = time()
+        while True:
+            sleep(self.report_interval)
+            now = time()
+            with self.lock:
+                frames_decoded = self.frames_decoded
+                backlog = self.frames_submitted - self.frames_decoded
+            frames_per_second = (frames_decoded - last_frames_decoded) / (now - last_report_time)
+            print(f'Decoded {frames_per_second:.1f} frames/sec across {len(self.workers)} workers. Backlog: {backlog} frames. Blocked submits: {self.blocked_submits}.')
+            last_frames_decoded = frames_decoded
+            last_report_time = now
@@ -0,0 +1,192 @@
+import config
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+import metrics
+from partitions import PartitionManager
+from storage import parse_uri, POST_COLLECTION, record_uri, REPOST_COLLECTION, tid_value
+from threading import Lock, Thread
+from time import time
+
+# Most post and repost deletes are for records we never stored (replies, old posts, posts from before we
+# started), so each delete is first checked against a per-partition Bloom filter of the stored uris.
+# Only possible matches are sent to the db, grouped by partition, so each DELETE only probes the author
+# and rkey index of the partitions that can hold them.
+
+# A TID rkey encodes microseconds since the epoch, then a 10 bit clock id
+def tid_time(rkey: str) -> datetime:
+    value = tid_value(rkey)
+    if value is None:
+        return None
+    try:
+        return datetime.fromtimestamp(((value & 0xffffffffffffffff) >> 10) / 1_000_000, timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+def uri_digest(uri: str) -> bytes:
+    return blake2b(uri.encode(), digest_size=16).digest()
+
+class BloomFilter:
+    def __init__(self, bit_count: int, hash_count: int = 4):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bytearray((bit_count + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        # Double hashing: position i is h1 + i * h2
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, digest: bytes):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+    def update(self, other: 'BloomFilter'):
+        combined = int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')
+        self.bits = bytearray(combined.to_bytes(len(self.bits), 'little'))
+
+class StoredUriFilter:
+    def __init__(self, partition_manager: PartitionManager, bits_per_hour: int):
+        self.partition_manager = partition_manager
+        self.bits_per_hour = bits_per_hour
+        self.lock = Lock()
+        self.filters: dict[datetime, BloomFilter] = {} # partition start -> filter
+        # Until the filters have been rebuilt from the posts table, every delete has to go to the db
+        self.ready = False
+
+    def _filter_for(self, filters: dict[datetime, BloomFilter], created_at: datetime) -> BloomFilter:
+        partition_range = self.partition_manager.partition_range(created_at)
+        if partition_range is None:
+            return None
+        start, end = partition_range
+        bloom = filters.get(start)
+        if bloom is None:
+            bloom = filters[start] = BloomFilter(max(int(self.bits_per_hour * (end - start) / timedelta(hours=1)), 8))
+        return bloom
+
+    # Rows are post infos, (uri, ..., created_at)
+    def add(self, rows: list[tuple]):
+        with self.lock:
+            for row in rows:
+                bloom = self._filter_for(self.filters, row[-1])
+                if bloom is not None:
+                    bloom.add(uri_digest(row[0]))
+
+    # Filters of partitions that have been dropped go with them
+    def expire(self):
+        with self.lock:
+            for start in [start for start in self.filters if self.partition_manager.partition_range(start) is None]:
+                del self.filters[start]
+
+    # Groups the uris by the partitions that may hold them, and counts the ones that can't be stored anywhere.
+    # Every partition whose filter matches is probed, since a match in the TID timestamp's partition (where
+    # created_at usually falls) can be a false positive for a post stored in another one.
+    def match(self, uris: list[str]) -> tuple[dict[datetime, list[str]], int]:
+        matches: dict[datetime, list[str]] = {}
+        skipped = 0
+        with self.lock:
+            for uri in uris:
+                digest = uri_digest(uri)
+                likely_start = None
+                rkey_time = tid_time(uri[uri.rfind('/') + 1:])
+                if rkey_time is not None:
+                    partition_range = self.partition_manager.partition_range(rkey_time)
+                    if partition_range is not None:
+                        likely_start = partition_range[0]
+
+                starts = sorted((start for start, bloom in self.filters.items() if digest in bloom), key=lambda start: start != likely_start)
+                if len(starts) == 0:
+                    skipped += 1
+                for start in starts:
+                    matches.setdefault(start, []).append(uri)
+        return matches, skipped
+
+    def rebuild(self, con):
+        # Built off to the side and merged in, so posts inserted while it loads are kept
+        start_time = time()
+        loaded: dict[datetime, BloomFilter] = {}
+        cur = con.cursor(name='stored_uris_load')
+        cur.itersize = 50_000
+        cur.execute(
+            """SELECT actors.did, posts.rkey, posts.subject_author_id IS NOT NULL, posts.created_at
+               FROM posts JOIN actors ON actors.id = posts.author_id""")
+        row_count = 0
+        for author, rkey, is_repost, created_at in cur:
+            bloom = self._filter_for(loaded, created_at)
+            if bloom is not None:
+                bloom.add(uri_digest(record_uri(author, REPOST_COLLECTION if is_repost else POST_COLLECTION, rkey)))
+            row_count += 1
+        cur.close()
+        con.commit()
+
+        with self.lock:
+            for start, bloom in loaded.items():
+                if start in self.filters:
+                    bloom.update(self.filters[start])
+                self.filters[start] = bloom
+            self.ready = True
+        print(f'Rebuilt stored uri filter from {row_count} posts in {time() - start_time:.1f} seconds.')
+
+def start_rebuild(stored_uris: StoredUriFilter, connect):
+    def rebuild():
+        con = connect()
+        try:
+            stored_uris.rebuild(con)
+        except Exception as ex:
+            print(f'Stored uri filter rebuild error! Deletes will not be filtered. {ex}')
+        finally:
+            con.close()
+    Thread(target=rebuild, daemon=True).start()
+
+# Deletes are matched on author, rkey and whether they're reposts
+_DELETE_POSTS = """
+    DELETE FROM posts
+    USING unnest(%s::INT[], %s::BIGINT[], %s::BOOL[]) AS d(author_id, rkey, is_repost)
+    WHERE posts.author_id = d.author_id AND posts.rkey = d.rkey AND (posts.subject_author_id IS NOT NULL) = d.is_repost"""
+
+# Uris of authors that were never stored can't match anything, and are left out
+def _delete_keys(uris: list[str], find_actor_ids) -> tuple[list[int], list[int], list[bool]]:
+    parsed = [record for record in map(parse_uri, uris) if record is not None]
+    actor_ids = find_actor_ids({author for author, _, _ in parsed})
+    author_ids, rkeys, is_reposts = [], [], []
+    for author, collection, rkey in parsed:
+        author_id = actor_ids.get(author)
+        if author_id is not None:
+            author_ids.append(author_id)
+            rkeys.append(rkey)
+            is_reposts.append(collection == REPOST_COLLECTION)
+    return author_ids, rkeys, is_reposts
+
+# Returns the uris that were sent to the db. find_actor_ids(dids) returns the ids of the DIDs that are stored.
+def delete_posts(cur, stored_uris: StoredUriFilter, uris: list[str], find_actor_ids) -> list[str]:
+    if len(uris) == 0:
+        return []
+
+    if not stored_uris.ready:
+        cur.execute(_DELETE_POSTS, _delete_keys(uris, find_actor_ids))
+        metrics.POST_DELETES.labels('applied').inc(len(uris))
+        if config.FIREHOSE_LOG_FLUSHES:
+            print(f'Deleted {cur.rowcount} posts and reposts from database ({len(uris)} deletes, stored uri filter not ready).')
+        return uris
+
+    stored_uris.expire()
+    matches, skipped = stored_uris.match(uris)
+    deleted_count = 0
+    applied = set()
+    for start, partition_uris in matches.items():
+        partition_range = stored_uris.partition_manager.partition_range(start)
+        if partition_range is None:
+            continue
+        # The created_at range lets the planner prune every other partition
+        cur.execute(f'{_DELETE_POSTS} AND posts.created_at >= %s AND posts.created_at < %s', (*_delete_keys(partition_uris, find_actor_ids), *partition_range))
+        deleted_count += cur.rowcount
+        applied.update(partition_uris)
+    metrics.POST_DELETES.labels('applied').inc(len(applied))
+    metrics.POST_DELETES.labels('skipped').inc(skipped)
+    if config.FIREHOSE_LOG_FLUSHES:
+        print(f'Deleted {deleted_count} posts and reposts from database ({len(applied)} deletes applied across {len(matches)} partitions, {skipped} skipped).')
+    return list(applied)
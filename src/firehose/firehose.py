@@ -1,371 +1,456 @@
-from atproto import AtUri, CAR, firehose_models, FirehoseSubscribeReposClient, models, parse_subscribe_repos_message
-from queue import SimpleQueue
+from atproto import firehose_models, FirehoseSubscribeReposClient, models
+from change_stream import FOLLOWS_CHANGED_CHANNEL, publish_post_changes
 import config
+import copy_writer
+from cursor import create_cursor_table, CURSOR_ID, CursorTracker, load_cursor, save_cursor
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta, timezone
-from dateutil import parser
-from enum import auto, Enum
-import psycopg2
+from datetime import datetime, timezone
+from decoder import decode_commit, DecodePool
+from ingest_buffer import FlushPolicy, IngestBuffer
+import deletes
+import metrics
+from deletes import StoredUriFilter
+import ingest_filter
+from ingest_filter import IngestFilter
+import migrate_schema
+import os
+import partitions
+from partitions import PartitionManager
+import psycopg2.errors
 from psycopg2.extras import execute_batch
+from records import ActionType, Record, RecordType
+import shards
+import storage
+from storage import ActorCache, parse_uri, POST_COLLECTION, tid_value
 from threading import Thread
-from time import sleep, time, time_ns
-from types import ModuleType
-
-class RecordType(Enum):
-    Post = 0
-    Like = 1
-    Follow = 2
-    Repost = 3
-
-@dataclass
-class RecordInfo:
-    record_type: RecordType
-    record_module: ModuleType
-    record_nsid: str
-
-_INTERESTED_RECORDS = [
-    RecordInfo(RecordType.Post, models.AppBskyFeedPost, models.ids.AppBskyFeedPost),
-    RecordInfo(RecordType.Like, models.AppBskyFeedLike, models.ids.AppBskyFeedLike),
-    RecordInfo(RecordType.Follow, models.AppBskyGraphFollow, models.ids.AppBskyGraphFollow),
-    RecordInfo(RecordType.Repost, models.AppBskyFeedRepost, models.ids.AppBskyFeedRepost),
-]
-
-class ActionType:
-    Created = 0
-    Deleted = 1
-
-@dataclass
-class Record:
-    record_type: RecordType
-    action_type: ActionType
-    record_info: dict
+from time import time, time_ns
 
 @dataclass
 class RecordCollection:
     created: list = field(default_factory=lambda: [])
     deleted: list = field(default_factory=lambda: [])
 
-record_queue = SimpleQueue()
-
-last_purge_time = 0
-
-def process_events():
-    con = psycopg2.connect(database='bluesky',
-                           host='db',
-                           user='postgres',
-                           password=config.DB_PASSWORD,
-                           port=5432)
+record_queue = IngestBuffer(config.FIREHOSE_QUEUE_SIZE)
+cursor_tracker = CursorTracker()
+
+write_mode = config.FIREHOSE_WRITE_MODE
+# Per-flush timing and row counts are printed too, not just exported as metrics
+log_flushes = config.FIREHOSE_LOG_FLUSHES
+
+retention_hours = 13
+partition_manager = PartitionManager(config.FIREHOSE_PARTITION_HOURS, config.FIREHOSE_PARTITIONS_AHEAD, retention_hours, config.FIREHOSE_CREATED_AT_INDEX)
+stored_uris = StoredUriFilter(partition_manager, config.FIREHOSE_DELETE_FILTER_BITS_PER_HOUR)
+record_filter = IngestFilter()
+actor_cache = ActorCache(config.FIREHOSE_ACTOR_CACHE_SIZE)
+
+# Rows are in the posts and follows tables' column order (see storage.create_tables)
+def write_rows_batch(cur, post_rows, repost_rows, follow_rows, deleted_follow_rows):
+    # Add posts to db
+    if len(post_rows) > 0:
+        execute_batch(cur, 'INSERT INTO posts VALUES(%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', post_rows)
+        if log_flushes:
+            print(f'Inserted {len(post_rows)} posts into database.')
+
+    # Add reposts to db
+    if len(repost_rows) > 0:
+        execute_batch(cur, 'INSERT INTO posts VALUES(%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', repost_rows)
+        if log_flushes:
+            print(f'Inserted {len(repost_rows)} reposts into database.')
+
+    if len(follow_rows) > 0:
+        execute_batch(cur, 'INSERT INTO follows VALUES(%s, %s, %s) ON CONFLICT DO NOTHING', follow_rows)
+        if log_flushes:
+            print(f'Inserted {len(follow_rows)} follows into database.')
+
+    if len(deleted_follow_rows) > 0:
+        execute_batch(cur, 'DELETE FROM follows WHERE follower_id = %s AND rkey = %s', deleted_follow_rows)
+        if log_flushes:
+            print(f'Deleted {len(deleted_follow_rows)} follows from database.')
+
+def connect_db(**kwargs):
+    return psycopg2.connect(database='bluesky',
+                            host='db',
+                            user='postgres',
+                            password=config.DB_PASSWORD,
+                            port=5432,
+                            **kwargs)
+
+# Tells the feeds service which primed users' follows changed, so it can drop them from its followee cache.
+# Only primed users' follows get this far. Notifications are only delivered once the flush commits.
+def notify_follow_changes(cur, created_follow_infos, deleted_follow_infos):
+    followers = {follow_info[0] for follow_info in created_follow_infos}
+    followers.update(follow_info[0] for follow_info in deleted_follow_infos)
+    if len(followers) == 0:
+        return
+
+    cur.execute(f"SELECT pg_notify('{FOLLOWS_CHANGED_CHANNEL}', follower) FROM unnest(%s::TEXT[]) AS follower", (list(followers), ))
+
+def create_tables(cur):
+    # Tables from before the compact layout are converted in place first
+    if migrate_schema.has_text_tables(cur):
+        migrate_schema.migrate(cur, partition_manager)
+
+    storage.create_tables(cur)
+    if config.FIREHOSE_CREATED_AT_INDEX == 'brin':
+        # Each partition gets its own BRIN index instead (see PartitionManager)
+        cur.execute('DROP INDEX IF EXISTS idx_posts_created_at')
+    else:
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at)')
+
+    # Follows of users who aren't primed are dropped before they're queued now (see IngestFilter)
+    cur.execute('DROP TRIGGER IF EXISTS check_follows_primed_trigger ON follows')
+    cur.execute('DROP FUNCTION IF EXISTS check_follows_primed()')
+    create_cursor_table(cur)
+
+# Runs first in the flush's transaction, since a missing partition rolls it back
+def write_rows(con, cur, times_to_create: set[datetime], post_rows, repost_rows, follow_rows, deleted_follow_rows):
+    for attempt in range(2):
+        # Partitions are normally created ahead of time, this only covers hours the partition manager missed
+        partition_manager.ensure(cur, times_to_create)
+        try:
+            if write_mode == 'copy':
+                copy_writer.write_rows(cur,
+                                       post_rows + repost_rows,
+                                       follow_rows,
+                                       deleted_follow_rows)
+            else:
+                write_rows_batch(cur, post_rows, repost_rows, follow_rows, deleted_follow_rows)
+            return
+        except psycopg2.errors.CheckViolation as ex:
+            # No partition for some post: one the map still had has been dropped since it was last loaded (shards
+            # only reload it every minute), so reload it and create whatever is still missing
+            if attempt > 0:
+                raise
+            print(f'Posts partition missing, reloading partitions. {str(ex).strip()}')
+            con.rollback()
+            partition_manager.load(cur)
+
+# connect and on_flush(record_count, flush_seconds) let replay.py run this against a scratch schema and time each flush.
+# Shard processes (see shards.py) save their own cursor_id, and leave the tables and partitions to the coordinator.
+def process_events(client: FirehoseSubscribeReposClient, connect = connect_db, on_flush = None, cursor_id: str = CURSOR_ID, manage_schema: bool = True):
+    con = connect()
     cur = con.cursor()
 
-    cur.execute(
-        """CREATE TABLE IF NOT EXISTS posts(
-            uri TEXT,
-            cid_rev TEXT,
-            repost_uri TEXT,
-            created_at TIMESTAMPTZ NOT NULL,
-            author TEXT
-        ) PARTITION BY RANGE(created_at)""")
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_posts_uri ON posts (uri)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at)')
-
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_posts_author ON posts (author)')
-    cur.execute(
-        """CREATE TABLE IF NOT EXISTS follows(
-            uri TEXT PRIMARY KEY,
-            follower TEXT,
-            followee TEXT
-        )"""
-    )
-    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_follows_uri ON follows (uri)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_follows_follower ON follows (follower)')
-
-    cur.execute(
-        """CREATE OR REPLACE FUNCTION check_follows_primed()
-            RETURNS TRIGGER
-            LANGUAGE PLPGSQL
-            AS
-            $$
-            BEGIN
-            IF (SELECT EXISTS(SELECT 1 FROM follows WHERE follower=NEW.follower)) THEN
-            RETURN NEW;
-            ELSE
-            RETURN OLD;
-            END IF;
-            END;
-            $$""")
-    cur.execute(
-        """DO
-            $$BEGIN
-            CREATE TRIGGER check_follows_primed_trigger
-            BEFORE INSERT
-            ON follows
-            FOR EACH ROW
-            EXECUTE PROCEDURE check_follows_primed();
-            EXCEPTION
-            WHEN duplicate_object THEN
-                NULL;
-            END;$$;
-        """)
+    if manage_schema:
+        create_tables(cur)
+    if write_mode == 'copy':
+        copy_writer.create_staging_tables(cur)
+    partition_manager.load(cur)
+    if manage_schema:
+        partition_manager.create_upcoming(cur, datetime.now(timezone.utc))
     con.commit()
+    partitions.start_maintenance(partition_manager, connect, owner=manage_schema)
+    deletes.start_rebuild(stored_uris, connect)
+
+    last_saved_seq = load_cursor(cur, cursor_id)
 
     last_update_time = time()
-    db_update_interval = 2.0
+    db_update_interval = config.FIREHOSE_FLUSH_INTERVAL
+    flush_policy = FlushPolicy(db_update_interval, config.FIREHOSE_FLUSH_TARGET_SECONDS, config.FIREHOSE_MIN_BATCH_SIZE, min(config.FIREHOSE_MAX_BATCH_SIZE, record_queue.max_size))
     last_successful_update_time = time()
     update_success_threshhold = 30.0
+    last_follows_filtered = record_filter.follows_filtered
+    last_posts_filtered = record_filter.posts_filtered
+    last_filter_report_time = time()
+
+    metrics.QUEUE_DEPTH.set_function(record_queue.qsize)
+    metrics.BATCH_SIZE.set_function(lambda: flush_policy.batch_size)
+    metrics.LAG_SECONDS.set_function(cursor_tracker.lag)
+    metrics.PARTITIONS.set_function(lambda: len(partition_manager.partitions))
+    metrics.PRIMED_USERS.set_function(lambda: len(record_filter.primed_followers))
+    metrics.INTERESTING_AUTHORS.set_function(lambda: len(record_filter.interesting_authors))
     while True:
-        time_since_last_update = time() - last_update_time
-        wait_time = db_update_interval - time_since_last_update
-        if wait_time >= 0.0:
-            sleep(wait_time)
+        # Flush once a full batch is queued or the interval is up. While we're behind the live edge (e.g.
+        # resuming from a saved cursor after a restart) the queue fills fast, so flushes go back to back.
+        flush_trigger = flush_policy.wait(record_queue, last_update_time)
+        lag = cursor_tracker.lag()
         last_update_time = time()
 
         time_since_last_successful_update = time() - last_successful_update_time
         if time_since_last_successful_update >= update_success_threshhold:
             print(f"Error: It's been {update_success_threshhold} seconds since the last successful firehose update. Restarting...")
-            exit(1)
+            # exit() would only end this thread
+            os._exit(1)
 
         start_time = time_ns()
 
-        cutoff_time = datetime.now(timezone.utc) - timedelta(hours=13)
-        now_time = datetime.now(timezone.utc) + timedelta(minutes=10) # padding "now" time in case firehose is out of sync with computer system time
+        # created_at is parsed to epoch seconds when records are decoded
+        cutoff_time = time() - retention_hours * 3600
+        now_time = time() + 10 * 60 # padding "now" time in case firehose is out of sync with computer system time
 
         record_collections: list[RecordCollection] = [RecordCollection() for _ in RecordType]
-        global record_queue
-        if record_queue.empty():
+
+        # Every frame up to the watermark has its records in the queue already, so once this flush
+        # commits, it's safe to resume from there
+        watermark = cursor_tracker.low_watermark()
+        if record_queue.empty() and watermark == last_saved_seq:
             continue
 
-        while not record_queue.empty():
-            record: Record = record_queue.get_nowait()
+        records: list[Record] = record_queue.drain()
+        for record in records:
             if record.action_type == ActionType.Created:
-                record_collections[record.record_type.value].created.append(record.record_info)
+                record_collections[record.record_type.value].created.append(record)
             else:
-                record_collections[record.record_type.value].deleted.append(record.record_info)
+                record_collections[record.record_type.value].deleted.append(record)
 
         queue_finished_time = time_ns()
         elapsed_time_ms = (queue_finished_time - start_time) / 1_000_000
-        print(f'Time to pull from queue: {elapsed_time_ms} ms.')
+        metrics.FLUSH_STAGE_SECONDS.labels('queue').observe(elapsed_time_ms / 1000)
+        if log_flushes:
+            print(f'Time to pull from queue: {elapsed_time_ms} ms.')
 
-        # Posts
+        # Posts and reposts are collected as (uri, author, rkey, cid_key, subject_author, subject_rkey, created_at)
+        # post infos, with DIDs; they're turned into rows of actor ids once the actors are interned
         post_collection = record_collections[RecordType.Post.value]
         times_to_create: set[datetime] = set()
         created_post_infos = []
         for created_post in post_collection.created:
-            author = created_post['author']
-            record = created_post['record']
-
             # Posts can be given custom created_at dates - if it's too old, or in the future, we ignore it
-            created_at_dt = parser.isoparse(record.created_at).astimezone(timezone.utc)
-            if created_at_dt < cutoff_time or created_at_dt > now_time:
+            if created_post.created_at < cutoff_time or created_post.created_at > now_time:
                 continue
 
             # Ignoring replies
-            if hasattr(record, 'reply') and record.reply:
+            if created_post.reply:
+                continue
+
+            # Record keys that aren't TIDs can't be stored
+            rkey = tid_value(created_post.uri[created_post.uri.rfind('/') + 1:])
+            if rkey is None:
                 continue
 
             # Log each hour block that a post has been created in, for table partitioning
-            created_at_hour = datetime(year=created_at_dt.year, month=created_at_dt.month, day=created_at_dt.day, hour=created_at_dt.hour, tzinfo=created_at_dt.tzinfo)
-            times_to_create.add(created_at_hour)
+            created_at_dt = datetime.fromtimestamp(created_post.created_at, timezone.utc)
+            times_to_create.add(created_at_dt.replace(minute=0, second=0, microsecond=0))
 
-            cid: str = created_post['cid']
-            
             created_post_infos.append((
-                created_post['uri'],
-                cid[::-1], # Reversed, for more random sorting
+                created_post.uri,
+                created_post.author,
+                rkey,
+                created_post.cid_key,
+                None,
                 None,
                 created_at_dt,
-                author,
             ))
 
-        # Add partitions to the table for each hour (if they don't exist)
-        for table_time in times_to_create:
-            cur.execute(f"CREATE TABLE IF NOT EXISTS posts_{table_time.strftime('y%Ym%md%dh%H')} PARTITION OF posts\
-                            FOR VALUES FROM (%s) TO (%s)", (table_time, table_time + timedelta(hours=1)))
-
-        # Add posts to db
-        if len(created_post_infos) > 0:
-            execute_batch(cur, 'INSERT INTO posts VALUES(%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', created_post_infos)
-            print(f'Inserted {len(created_post_infos)} posts into database.')
-
         # Collect deleted posts
-        deleted_post_infos = []
-        for deleted_post in post_collection.deleted:
-            deleted_post_infos.append((
-                deleted_post['uri'],
-            ))
-
-        # Delete posts from db
-        if len(deleted_post_infos) > 0:
-            execute_batch(cur, 'DELETE FROM posts WHERE uri = %s', deleted_post_infos)
-            print(f'Deleted {len(deleted_post_infos)} posts from database.')
+        deleted_post_uris = [deleted_post.uri for deleted_post in post_collection.deleted]
 
         # Reposts
         repost_collection = record_collections[RecordType.Repost.value]
-        times_to_create: set[datetime] = set()
         created_repost_infos = []
         for created_repost in repost_collection.created:
-            record = created_repost['record']
-            author = created_repost['author']
-
             # Posts can be given custom created_at dates - if it's too old, or in the future, we ignore it
-            created_at_dt = parser.isoparse(record.created_at).astimezone(timezone.utc)
-            if created_at_dt < cutoff_time or created_at_dt > datetime.now(timezone.utc) + timedelta(minutes=5):
+            if created_repost.created_at < cutoff_time or created_repost.created_at > time() + 5 * 60:
+                continue
+
+            # Ignore empty reposts, and reposts of anything but a post
+            if created_repost.subject is None:
                 continue
-            
-            # Ignore empty reposts
-            if not hasattr(record, 'subject') or record.subject is None:
+            subject = parse_uri(created_repost.subject)
+            if subject is None or subject[1] != POST_COLLECTION:
                 continue
 
-            # Log each hour block that a post has been created in, for table partitioning
-            created_at_hour = datetime(year=created_at_dt.year, month=created_at_dt.month, day=created_at_dt.day, hour=created_at_dt.hour, tzinfo=created_at_dt.tzinfo)
-            times_to_create.add(created_at_hour)
+            rkey = tid_value(created_repost.uri[created_repost.uri.rfind('/') + 1:])
+            if rkey is None:
+                continue
 
-            cid: str = created_post['cid']
+            # Log each hour block that a post has been created in, for table partitioning
+            created_at_dt = datetime.fromtimestamp(created_repost.created_at, timezone.utc)
+            times_to_create.add(created_at_dt.replace(minute=0, second=0, microsecond=0))
 
             created_repost_infos.append((
-                created_repost['uri'],
-                cid[::-1], # Reversed for more random sorting
-                record.subject.uri,
+                created_repost.uri,
+                created_repost.author,
+                rkey,
+                created_repost.cid_key,
+                subject[0],
+                subject[2],
                 created_at_dt,
-                author,
             ))
 
-        # Add partitions to the table for each hour (if they don't exist)
-        for table_time in times_to_create:
-            cur.execute(f"CREATE TABLE IF NOT EXISTS posts_{table_time.strftime('y%Ym%md%dh%H')} PARTITION OF posts\
-                            FOR VALUES FROM (%s) TO (%s)", (table_time, table_time + timedelta(hours=1)))
-
-        # Add reposts to db
-        if len(created_repost_infos) > 0:
-            execute_batch(cur, 'INSERT INTO posts VALUES(%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING', created_repost_infos)
-            print(f'Inserted {len(created_repost_infos)} reposts into database.')
-
         # Collect deleted reposts
-        deleted_repost_infos = []
-        for deleted_repost in repost_collection.deleted:
-            deleted_repost_infos.append((
-                deleted_repost['uri'],
-            ))
-
-        # Delete reposts from db
-        if len(deleted_repost_infos) > 0:
-            execute_batch(cur, 'DELETE FROM posts WHERE uri = %s', deleted_repost_infos)
-            print(f'Deleted {len(deleted_repost_infos)} reposts from database.')
+        deleted_repost_uris = [deleted_repost.uri for deleted_repost in repost_collection.deleted]
 
-        # Follows
+        # Follows, as (follower, followee, rkey) and deleted ones as (follower, rkey)
         follow_collection = record_collections[RecordType.Follow.value]
-        authors = []
         created_follow_infos = []
         for created_follow in follow_collection.created:
-            author = created_follow['author']
-
-            authors.append((
-                author,
-                False,
-            ))
+            rkey = tid_value(created_follow.uri[created_follow.uri.rfind('/') + 1:])
+            if rkey is None:
+                continue
             created_follow_infos.append((
-                created_follow['uri'],
-                author,
-                created_follow['record'].subject
+                created_follow.author,
+                created_follow.subject,
+                rkey,
             ))
 
-        if len(created_follow_infos) > 0:
-            execute_batch(cur, 'INSERT INTO follows VALUES(%s, %s, %s) ON CONFLICT DO NOTHING', created_follow_infos)
-            print(f'Inserted {len(created_follow_infos)} follows into database.')
-
         deleted_follow_infos = []
         for deleted_follow in follow_collection.deleted:
+            follow = parse_uri(deleted_follow.uri) # at://<follower>/app.bsky.graph.follow/<rkey>
+            if follow is None:
+                continue
             deleted_follow_infos.append((
-                deleted_follow['uri'],
+                follow[0],
+                follow[2],
             ))
 
-        if len(deleted_follow_infos) > 0:
-            execute_batch(cur, 'DELETE FROM follows WHERE uri = %s', deleted_follow_infos)
-            print(f'Deleted {len(deleted_follow_infos)} follows from database.')
-
-        global last_purge_time
-        time_since_last_purge = time() - last_purge_time
-        if time_since_last_purge >= 60.0 * 60.0:
-            # Query to collect all partitions of 'posts' table
-            cur.execute(
-                """ SELECT child.relname AS name
-                    FROM pg_inherits
-                        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
-                        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
-                        JOIN pg_namespace nmsp_parent ON nmsp_parent.oid = parent.relnamespace
-                        JOIN pg_namespace nmsp_child ON nmsp_child.oid = child.relnamespace
-                    WHERE parent.relname = 'posts'
-                    ORDER BY name ASC
-                """)
-            for row in cur.fetchall():
-                # Parse the datetime from the table name - if it's older than the threshhold, drop it
-                table_name = row[0]
-                table_time_str = f'{table_name}+0000'
-                table_time = datetime.strptime(table_time_str, 'posts_y%Ym%md%dh%H%z')
-                if table_time < cutoff_time:
-                    print(f'Dropping partition {table_name}')
-                    cur.execute(f"DROP TABLE {table_name}")
-                else:
-                    print(f'Leaving partition {table_name} in the db')
-
-            print('Purged old posts.')
-            last_purge_time = time()
-
-        print('Committing queries')
+        collect_finished_time = time_ns()
+        elapsed_time_ms = (collect_finished_time - queue_finished_time) / 1_000_000
+        metrics.FLUSH_STAGE_SECONDS.labels('collect').observe(elapsed_time_ms / 1000)
+        if log_flushes:
+            print(f'Time to collect rows: {elapsed_time_ms} ms.')
+
+            follows_filtered = record_filter.follows_filtered
+            posts_filtered = record_filter.posts_filtered
+            filter_report_seconds = time() - last_filter_report_time
+            print(f'Filtered out {(follows_filtered - last_follows_filtered) / filter_report_seconds:.1f} follows/sec '
+                  f'({len(record_filter.primed_followers)} primed users) and {(posts_filtered - last_posts_filtered) / filter_report_seconds:.1f} posts/sec '
+                  f'({len(record_filter.interesting_authors)} followed authors).')
+            last_follows_filtered = follows_filtered
+            last_posts_filtered = posts_filtered
+            last_filter_report_time = time()
+
+        # New actors are committed on their own, before any rows refer to them (see ActorCache)
+        new_dids = set()
+        for post_info in created_post_infos:
+            new_dids.add(post_info[1])
+        for repost_info in created_repost_infos:
+            new_dids.add(repost_info[1])
+            new_dids.add(repost_info[4])
+        for follow_info in created_follow_infos:
+            new_dids.add(follow_info[0])
+            new_dids.add(follow_info[1])
+        for follow_info in deleted_follow_infos:
+            new_dids.add(follow_info[0])
+        actor_ids = actor_cache.lookup(cur, new_dids, create=True)
+        con.commit()
+
+        post_rows = [(actor_ids[author], None, rkey, None, cid_key, created_at)
+                     for _, author, rkey, cid_key, _, _, created_at in created_post_infos]
+        repost_rows = [(actor_ids[author], actor_ids[subject_author], rkey, subject_rkey, cid_key, created_at)
+                       for _, author, rkey, cid_key, subject_author, subject_rkey, created_at in created_repost_infos]
+        follow_rows = [(actor_ids[follower], actor_ids[followee], rkey) for follower, followee, rkey in created_follow_infos]
+        deleted_follow_rows = [(actor_ids[follower], rkey) for follower, rkey in deleted_follow_infos]
+
+        write_rows(con, cur, times_to_create, post_rows, repost_rows, follow_rows, deleted_follow_rows)
+
+        # Posts and reposts deletes, after the inserts so deletes of records created in this flush still apply.
+        # Deletes only need the ids of actors that are already stored.
+        stored_uris.add(created_post_infos)
+        stored_uris.add(created_repost_infos)
+        applied_delete_uris = deletes.delete_posts(cur, stored_uris, deleted_post_uris + deleted_repost_uris,
+                                                   lambda dids: actor_cache.lookup(cur, dids, create=False))
+
+        notify_follow_changes(cur, created_follow_infos, deleted_follow_infos)
+        if config.TIMELINE_STORE:
+            publish_post_changes(cur, created_post_infos + created_repost_infos, [(uri, ) for uri in applied_delete_uris])
+
+        write_finished_time = time_ns()
+        elapsed_time_ms = (write_finished_time - collect_finished_time) / 1_000_000
+        metrics.FLUSH_STAGE_SECONDS.labels('write').observe(elapsed_time_ms / 1000)
+        if log_flushes:
+            print(f'Time to write rows ({write_mode}): {elapsed_time_ms} ms.')
+
+        if watermark is not None and watermark != last_saved_seq:
+            save_cursor(cur, watermark, cursor_id)
+
+        if log_flushes:
+            print('Committing queries')
         con.commit()
 
+        # Reconnects pick up from the last committed seq instead of the live edge
+        if watermark is not None and watermark != last_saved_seq:
+            client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=watermark))
+            last_saved_seq = watermark
+
         end_time = time_ns()
-        elapsed_time_ms = (end_time - start_time) // 1_000_000
-        print(f'Time to update db: {elapsed_time_ms} ms. ({elapsed_time_ms / (db_update_interval * 1000) * 100:.3}% of {db_update_interval} seconds.)')
+        flush_seconds = (end_time - start_time) / 1_000_000_000
+        metrics.FLUSH_STAGE_SECONDS.labels('commit').observe((end_time - write_finished_time) / 1_000_000_000)
+        metrics.FLUSH_SECONDS.observe(flush_seconds)
+        metrics.FLUSH_RECORDS.observe(len(records))
+        metrics.FLUSHES.labels(flush_trigger).inc()
+        metrics.ROWS_WRITTEN.labels('posts', 'insert').inc(len(created_post_infos) + len(created_repost_infos))
+        metrics.ROWS_WRITTEN.labels('posts', 'delete').inc(len(applied_delete_uris))
+        metrics.ROWS_WRITTEN.labels('follows', 'insert').inc(len(created_follow_infos))
+        metrics.ROWS_WRITTEN.labels('follows', 'delete').inc(len(deleted_follow_infos))
+
+        flush_policy.update(len(records), flush_seconds)
+        if on_flush is not None:
+            on_flush(len(records), flush_seconds)
+        if log_flushes:
+            elapsed_time_ms = (end_time - start_time) // 1_000_000
+            print(f'Time to update db: {elapsed_time_ms} ms. ({elapsed_time_ms / (db_update_interval * 1000) * 100:.3}% of {db_update_interval} seconds.)')
+            print(f'Cursor: {last_saved_seq} - lag: {lag:.1f} seconds.')
+            queue_stats = record_queue.stats()
+            print(f"Flushed {len(records)} records (trigger: {flush_trigger}). Queue depth: {queue_stats['depth']}/{queue_stats['max_size']}, "
+                  f"next batch size: {flush_policy.batch_size}, blocked puts: {queue_stats['blocked_puts']} ({queue_stats['blocked_seconds']:.1f} seconds).")
 
         last_successful_update_time = time()
 
-def main():
-    params = models.ComAtprotoSyncSubscribeRepos.Params()
-    client = FirehoseSubscribeReposClient(params)
-
+# The flush loop's thread can't just end: the record queue would fill up and leave the websocket thread blocked in
+# put() forever, with the process still alive, so Docker would never restart it
+def run_process_events(client: FirehoseSubscribeReposClient):
+    try:
+        process_events(client)
+    except BaseException as ex:
+        print(f'Flush loop error! {ex!r} Restarting...')
+    os._exit(1)
+
+# keep_record decides which decoded records are queued (None keeps everything)
+def make_message_handler(decode_pool: DecodePool, keep_record):
     def on_message_handler(message: firehose_models.MessageFrame) -> None:
-        commit = parse_subscribe_repos_message(message)
-        if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
-            return
-        
-        if not commit.blocks:
+        if decode_pool is not None:
+            decode_pool.submit(message)
             return
 
-        car = CAR.from_bytes(commit.blocks)
-        global record_queue
-        for op in commit.ops:
-            if op.action == 'update':
-                continue
+        for record in decode_commit(message):
+            if keep_record is None or keep_record(record):
+                record_queue.put(record)
+
+        seq = message.body.get('seq')
+        if seq is not None:
+            cursor_tracker.frame_done(seq, message.body.get('time'))
+
+    return on_message_handler
 
-            uri = AtUri.from_str(f'at://{commit.repo}/{op.path}')
+def main():
+    if config.FIREHOSE_SHARDS > 1:
+        shards.run_coordinator(config.FIREHOSE_SHARDS)
+        return
 
-            if op.action == 'create':
-                if not op.cid:
-                    continue
+    # Resume from the last seq committed to the db, so events from while we were down aren't lost
+    con = connect_db()
+    cur = con.cursor()
+    create_cursor_table(cur)
+    con.commit()
+    start_cursor = load_cursor(cur)
+    con.close()
+    print(f'Starting firehose from cursor {start_cursor}.')
 
-                record_raw_data = car.blocks.get(op.cid)
-                if not record_raw_data:
-                    continue
+    params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=start_cursor)
+    client = FirehoseSubscribeReposClient(params)
 
-                record = models.get_or_create(record_raw_data, strict=False)
-                for record_info in _INTERESTED_RECORDS:
-                    if uri.collection == record_info.record_nsid and models.is_record_type(record, record_info.record_module):
-                        create_info = {'record': record, 'uri': str(uri), 'cid': str(op.cid), 'author': commit.repo}
-                        record_queue.put(Record(record_info.record_type, ActionType.Created, create_info))
+    # Decode worker processes are forked before any other threads are started
+    decode_pool: DecodePool = None
+    if config.FIREHOSE_DECODE_WORKERS > 0:
+        decode_pool = DecodePool(config.FIREHOSE_DECODE_WORKERS, record_queue, cursor_tracker, record_filter.keep)
+        decode_pool.start()
 
-            if op.action == 'delete':
-                for record_info in _INTERESTED_RECORDS:
-                    if uri.collection == record_info.record_nsid:
-                        delete_info = {'uri': str(uri)}
-                        record_queue.put(Record(record_info.record_type, ActionType.Deleted, delete_info))
+    on_message_handler = make_message_handler(decode_pool, record_filter.keep)
 
     def on_error_handler(ex: BaseException) -> None:
         print(f'Firehose error! {ex}')
         exit(1)
 
-    t = Thread(target = process_events)
+    metrics.serve(config.FIREHOSE_METRICS_PORT)
+
+    t = Thread(target = run_process_events, args = (client, ))
     t.start()
 
+    # Nothing can be filtered until we know who's primed and who they follow
+    ingest_filter.start_listener(record_filter, connect_db)
+    record_filter.ready.wait()
+
     client.start(on_message_handler, on_error_handler)
 
 if __name__ == "__main__":
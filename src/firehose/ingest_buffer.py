@@ -0,0 +1,73 @@
+import metrics
+from queue import Full, Queue
+from records import Record
+from time import perf_counter, sleep, time
+
+class IngestBuffer:
+    # Bounded queue of decoded records waiting for the next flush. When it's full, put blocks the producer
+    # (the websocket thread, or the decode pool's collector), which pushes back on the relay instead of
+    # growing memory until the watchdog kills the process. Records are never dropped, since the cursor
+    # would move on past them and they'd be lost for good.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.queue: Queue[Record] = Queue(max_size)
+
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+
+    def put(self, record: Record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            start_time = perf_counter()
+            self.queue.put(record)
+            blocked_seconds = perf_counter() - start_time
+            self.blocked_puts += 1
+            self.blocked_seconds += blocked_seconds
+            metrics.QUEUE_BLOCKED_PUTS.inc()
+            metrics.QUEUE_BLOCKED_SECONDS.inc(blocked_seconds)
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    def empty(self) -> bool:
+        return self.queue.empty()
+
+    # Everything queued so far (the flush loop is the only consumer, so these gets never wait)
+    def drain(self) -> list[Record]:
+        return [self.queue.get_nowait() for _ in range(self.queue.qsize())]
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'depth': self.queue.qsize(),
+            'max_size': self.max_size,
+            'blocked_puts': self.blocked_puts,
+            'blocked_seconds': self.blocked_seconds,
+        }
+
+class FlushPolicy:
+    # Flushes once batch_size records are queued or interval seconds have passed, whichever comes first.
+    # batch_size follows the measured cost per record so a size-triggered flush takes about target_seconds:
+    # bigger batches while the db keeps up (fewer, cheaper commits), smaller ones when it slows down.
+    def __init__(self, interval: float, target_seconds: float, min_batch_size: int, max_batch_size: int):
+        self.interval = interval
+        self.target_seconds = target_seconds
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size = min_batch_size
+
+    def wait(self, buffer: IngestBuffer, last_flush_time: float) -> str:
+        while True:
+            if buffer.qsize() >= self.batch_size:
+                return 'size'
+            if time() - last_flush_time >= self.interval:
+                return 'time'
+            sleep(0.05)
+
+    def update(self, record_count: int, flush_seconds: float):
+        if record_count == 0 or flush_seconds <= 0.0:
+            return
+        ideal_batch_size = self.target_seconds * record_count / flush_seconds
+        # Smoothed, so one slow flush doesn't swing the batch size all the way
+        batch_size = int(0.5 * self.batch_size + 0.5 * ideal_batch_size)
+        self.batch_size = max(self.min_batch_size, min(batch_size, self.max_batch_size))
@@ -0,0 +1,104 @@
+from change_stream import FOLLOWS_CHANGED_CHANNEL, FOLLOWS_PRIMED_CHANNEL, listen
+from records import ActionType, Record, RecordType
+from storage import FOLLOW_COLLECTION, record_uri
+from threading import Event, Lock, Thread
+
+_SELECT_FOLLOWS = """
+    SELECT follower.did, follows.rkey, followee.did
+    FROM follows
+        JOIN actors follower ON follower.id = follows.follower_id
+        JOIN actors followee ON followee.id = follows.followee_id"""
+
+class IngestFilter:
+    # Drops records no feed user needs before they reach the record queue. Only primed users (people who
+    # have loaded a feed) have their follows read, and only the posts of accounts they follow can end up
+    # in a feed, so:
+    # - follows are kept only if the follower is primed
+    # - posts and reposts are kept only if their author is followed by a primed user ("interesting authors")
+    # Both sets are loaded from the follows table, then kept up to date from the kept follows themselves and
+    # the feeds service's notifications as it primes new users.
+    def __init__(self):
+        self.lock = Lock()
+        self.primed_followers: set[str] = set()
+        self.interesting_authors: dict[str, int] = {} # followee -> number of primed users following them
+        self.follow_subjects: dict[str, str] = {} # primed users' follow uri -> followee, for applying deletes
+        self.ready = Event()
+
+        # Only ever increased, by whichever single thread is queueing records
+        self.follows_kept = 0
+        self.follows_filtered = 0
+        self.posts_kept = 0
+        self.posts_filtered = 0
+
+    def _add_follow(self, uri: str, followee: str):
+        if uri in self.follow_subjects:
+            return
+        self.follow_subjects[uri] = followee
+        self.interesting_authors[followee] = self.interesting_authors.get(followee, 0) + 1
+
+    def _remove_follow(self, uri: str):
+        followee = self.follow_subjects.pop(uri, None)
+        if followee is None:
+            return
+        follower_count = self.interesting_authors[followee] - 1
+        if follower_count > 0:
+            self.interesting_authors[followee] = follower_count
+        else:
+            del self.interesting_authors[followee]
+
+    def keep(self, record: Record) -> bool:
+        if record.record_type == RecordType.Follow:
+            uri = record.uri
+            with self.lock:
+                if record.action_type == ActionType.Created:
+                    if record.author not in self.primed_followers:
+                        self.follows_filtered += 1
+                        return False
+                    self._add_follow(uri, record.subject)
+                else:
+                    if uri.split('/')[2] not in self.primed_followers: # at://<follower>/app.bsky.graph.follow/<rkey>
+                        self.follows_filtered += 1
+                        return False
+                    self._remove_follow(uri)
+            self.follows_kept += 1
+            return True
+
+        # Deletes still go through, since the author may have been unfollowed after their post was stored
+        if record.action_type == ActionType.Created:
+            if record.author not in self.interesting_authors:
+                self.posts_filtered += 1
+                return False
+            self.posts_kept += 1
+        return True
+
+    def load(self, cur):
+        cur.execute(_SELECT_FOLLOWS)
+        with self.lock:
+            self.primed_followers = set()
+            self.interesting_authors = {}
+            self.follow_subjects = {}
+            for follower, rkey, followee in cur:
+                self.primed_followers.add(follower)
+                self._add_follow(record_uri(follower, FOLLOW_COLLECTION, rkey), followee)
+        self.ready.set()
+
+    def add_primed_user(self, cur, did: str):
+        cur.execute(f'{_SELECT_FOLLOWS} WHERE follower.did = %s', (did, ))
+        with self.lock:
+            self.primed_followers.add(did)
+            for follower, rkey, followee in cur:
+                self._add_follow(record_uri(follower, FOLLOW_COLLECTION, rkey), followee)
+
+# With follow_changes, follows written by other firehose shards are picked up too: a primed user's follows are only
+# seen by the shard handling their repo, but the posts of who they follow can be in any shard. Follows deleted by
+# other shards aren't, which only means a few more posts are kept than needed.
+def _load(ingest_filter: IngestFilter, cur):
+    ingest_filter.load(cur)
+    print(f'Loaded {len(ingest_filter.primed_followers)} primed users following {len(ingest_filter.interesting_authors)} authors.')
+
+def listen_for_primed_users(ingest_filter: IngestFilter, connect, follow_changes: bool):
+    channels = [FOLLOWS_PRIMED_CHANNEL, FOLLOWS_CHANGED_CHANNEL] if follow_changes else [FOLLOWS_PRIMED_CHANNEL]
+    listen('Primed user listener', connect, channels, on_connect=lambda cur: _load(ingest_filter, cur), on_notify=ingest_filter.add_primed_user)
+
+def start_listener(ingest_filter: IngestFilter, connect, follow_changes: bool = False):
+    Thread(target=listen_for_primed_users, args=(ingest_filter, connect, follow_changes), daemon=True).start()
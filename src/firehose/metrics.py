@@ -0,0 +1,32 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Prometheus metrics for the firehose, served by a small HTTP listener (see serve)
+
+_FLUSH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+FLUSH_SECONDS = Histogram('firehose_flush_seconds', 'Time to flush a batch of records to the db, from draining the queue to commit', buckets=_FLUSH_BUCKETS)
+FLUSH_STAGE_SECONDS = Histogram('firehose_flush_stage_seconds', 'Time spent in each stage of a flush', ['stage'], buckets=_FLUSH_BUCKETS)
+FLUSH_RECORDS = Histogram('firehose_flush_records', 'Records drained from the queue per flush', buckets=(100, 1000, 5000, 10_000, 25_000, 50_000, 100_000, 200_000))
+FLUSHES = Counter('firehose_flushes', 'Flushes by what triggered them', ['trigger'])
+ROWS_WRITTEN = Counter('firehose_rows_written', 'Rows written to the db', ['table', 'action'])
+POST_DELETES = Counter('firehose_post_deletes', 'Post and repost deletes sent to the db, or skipped by the stored uri filter', ['result'])
+
+QUEUE_DEPTH = Gauge('firehose_queue_depth', 'Decoded records waiting for the next flush')
+QUEUE_BLOCKED_PUTS = Counter('firehose_queue_blocked_puts', 'Records that had to wait for room in the full queue')
+QUEUE_BLOCKED_SECONDS = Counter('firehose_queue_blocked_seconds', 'Time spent waiting for room in the full queue, pausing reads from the relay')
+BATCH_SIZE = Gauge('firehose_batch_size', 'Queued records that trigger a flush before the interval is up')
+LAG_SECONDS = Gauge('firehose_lag_seconds', 'Seconds between the newest decoded event and now')
+PARTITIONS = Gauge('firehose_partitions', 'Partitions of the posts table')
+PRIMED_USERS = Gauge('firehose_primed_users', 'Users whose follows are kept')
+INTERESTING_AUTHORS = Gauge('firehose_interesting_authors', 'Authors followed by a primed user, whose posts are kept')
+
+def serve(port: int):
+    if port > 0:
+        start_http_server(port)
+        print(f'Serving metrics on port {port}.')
+
+# Only with firehose.shards > 1. Shard processes report to the coordinator, which serves these for every shard.
+SHARD_FRAMES = Counter('firehose_shard_frames', 'Commit frames sent to each shard', ['shard'])
+SHARD_RECORDS = Counter('firehose_shard_records', 'Records flushed by each shard', ['shard'])
+SHARD_FLUSH_SECONDS = Histogram('firehose_shard_flush_seconds', "Each shard's flush time", ['shard'], buckets=_FLUSH_BUCKETS)
+SHARD_BACKLOG = Gauge('firehose_shard_backlog', 'Frames sent to each shard that its last committed cursor doesn\'t cover yet', ['shard'])
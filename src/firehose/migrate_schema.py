@@ -0,0 +1,152 @@
+import argparse
+import copy_writer
+from datetime import datetime
+import firehose
+from partitions import PartitionManager
+from storage import ActorCache, cid_key_from_string, create_tables, parse_uri, POST_COLLECTION, REPOST_COLLECTION
+from time import time
+
+# Converts posts and follows from the original layout (full uris, author DIDs and reversed CID strings as TEXT) to
+# the compact one in storage.py. The firehose does this by itself when it starts on the old tables, or it can be
+# run by hand (with the firehose and feeds service stopped) to keep the old tables for comparison:
+#   python migrate_schema.py --keep-old
+# Everything happens in one transaction, so a failed migration leaves the old tables as they were. Rows that can't
+# be stored compactly (record keys that aren't TIDs, reposts of anything but a post) are dropped, and posts written
+# more than once are kept once.
+
+_BATCH_SIZE = 50_000
+
+def has_text_tables(cur) -> bool:
+    cur.execute(
+        """SELECT 1 FROM information_schema.columns
+           WHERE table_schema = current_schema() AND table_name IN ('posts', 'follows') AND column_name = 'uri'""")
+    return cur.fetchone() is not None
+
+# Bytes of table data (with TOAST) and of indexes, summed over every partition
+def relation_sizes(cur, table: str) -> tuple[int, int]:
+    cur.execute(
+        """SELECT COALESCE(sum(pg_table_size(relid)), 0), COALESCE(sum(pg_indexes_size(relid)), 0)
+           FROM pg_partition_tree(%s::regclass) WHERE isleaf""", (table, ))
+    table_bytes, index_bytes = cur.fetchone()
+    return int(table_bytes), int(index_bytes)
+
+def print_sizes(cur, tables: list[str], label: str):
+    total_table_bytes = 0
+    total_index_bytes = 0
+    for table in tables:
+        table_bytes, index_bytes = relation_sizes(cur, table)
+        total_table_bytes += table_bytes
+        total_index_bytes += index_bytes
+        print(f'{label} {table}: {table_bytes / 2**20:.1f} MiB of rows, {index_bytes / 2**20:.1f} MiB of indexes.')
+    print(f'{label} total: {total_table_bytes / 2**20:.1f} MiB of rows, {total_index_bytes / 2**20:.1f} MiB of indexes.')
+
+# Moves the old tables, their partitions and their indexes out of the way of the new ones.
+# Returns the start of each old partition.
+def _rename_text_tables(cur) -> list[datetime]:
+    cur.execute('SELECT relname FROM pg_inherits JOIN pg_class ON pg_inherits.inhrelid = pg_class.oid WHERE inhparent = %s::regclass', ('posts', ))
+    partition_names = [row[0] for row in cur.fetchall()]
+    old_partitions = PartitionManager(1, 0, 0, 'btree')
+    old_partitions.load(cur)
+
+    cur.execute('DROP INDEX IF EXISTS idx_posts_uri, idx_posts_author, idx_posts_created_at')
+    for partition_name in partition_names:
+        cur.execute(f'DROP INDEX IF EXISTS {partition_name}_created_at_brin')
+        cur.execute(f'ALTER TABLE {partition_name} RENAME TO {partition_name}_text')
+    cur.execute('ALTER TABLE posts RENAME TO posts_text')
+
+    cur.execute('DROP TRIGGER IF EXISTS check_follows_primed_trigger ON follows')
+    cur.execute('DROP INDEX IF EXISTS idx_follows_uri, idx_follows_follower')
+    cur.execute('ALTER TABLE follows DROP CONSTRAINT IF EXISTS follows_pkey')
+    cur.execute('ALTER TABLE follows RENAME TO follows_text')
+    return list(old_partitions.partitions)
+
+# Reads the old table in batches on a server-side cursor, interning each batch's actors before copying it
+def _copy_rows(cur, actors: ActorCache, select: str, convert, table: str, encoders: tuple) -> tuple[int, int]:
+    read_cur = cur.connection.cursor(name=f'migrate_{table}')
+    read_cur.itersize = _BATCH_SIZE
+    read_cur.execute(select)
+    # Staged first, since a follow's key can turn up twice (priming and the firehose both wrote the same uri)
+    cur.execute(f'CREATE TEMP TABLE migrate_staging (LIKE {table})')
+    read_count = 0
+    written_count = 0
+    while True:
+        batch = read_cur.fetchmany(_BATCH_SIZE)
+        if len(batch) == 0:
+            break
+        read_count += len(batch)
+        parsed = [row for row in map(convert, batch) if row is not None]
+        actor_ids = actors.lookup(cur, {did for row in parsed for did in row[0] if did is not None}, create=True)
+        rows = [tuple(actor_ids.get(did) for did in dids) + values for dids, values in parsed]
+        cur.execute('TRUNCATE migrate_staging')
+        copy_writer.copy_rows(cur, 'migrate_staging', rows, encoders)
+        cur.execute(f'INSERT INTO {table} SELECT * FROM migrate_staging ON CONFLICT DO NOTHING')
+        written_count += cur.rowcount
+    cur.execute('DROP TABLE migrate_staging')
+    read_cur.close()
+    return read_count, written_count
+
+# Each converter returns ((DIDs to turn into actor ids), (the rest of the row)), or None to drop the row
+def _convert_follow(row: tuple):
+    uri, follower, followee = row
+    follow = parse_uri(uri)
+    if follow is None or follower is None or followee is None:
+        return None
+    return (follower, followee), (follow[2], )
+
+def _convert_post(row: tuple):
+    uri, cid_rev, repost_uri, created_at, author = row
+    post = parse_uri(uri)
+    if post is None or author is None:
+        return None
+    subject = None
+    if post[1] == REPOST_COLLECTION:
+        subject = parse_uri(repost_uri) if repost_uri else None
+        if subject is None or subject[1] != POST_COLLECTION:
+            return None
+    return (author, subject[0] if subject else None), (post[2], subject[2] if subject else None, cid_key_from_string(cid_rev[::-1]), created_at)
+
+def migrate(cur, partition_manager: PartitionManager, keep_old: bool = False):
+    start_time = time()
+    print('Converting posts and follows to the compact layout...')
+    print_sizes(cur, ['posts', 'follows'], 'Before:')
+    partition_starts = _rename_text_tables(cur)
+
+    create_tables(cur)
+    partition_manager.load(cur)
+    partition_manager.ensure(cur, set(partition_starts))
+
+    actors = ActorCache(1_000_000)
+    read_count, written_count = _copy_rows(cur, actors, 'SELECT uri, follower, followee FROM follows_text', _convert_follow, 'follows', copy_writer.FOLLOW_COLUMNS)
+    print(f'Converted {written_count} of {read_count} follows.')
+    read_count, written_count = _copy_rows(cur, actors, 'SELECT uri, cid_rev, repost_uri, created_at, author FROM posts_text', _convert_post, 'posts', copy_writer.POST_COLUMNS)
+    print(f'Converted {written_count} of {read_count} posts and reposts.')
+
+    cur.execute('ANALYZE actors')
+    cur.execute('ANALYZE posts')
+    cur.execute('ANALYZE follows')
+    print_sizes(cur, ['actors', 'posts', 'follows'], 'After:')
+
+    if keep_old:
+        print('The old tables are kept as posts_text and follows_text.')
+    else:
+        cur.execute('DROP TABLE posts_text, follows_text')
+    print(f'Converted to the compact layout in {time() - start_time:.1f} seconds.')
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--keep-old', action='store_true', help='Keep the old tables as posts_text and follows_text')
+    args = arg_parser.parse_args()
+
+    con = firehose.connect_db()
+    cur = con.cursor()
+    if not has_text_tables(cur):
+        print('Already on the compact layout.')
+        return
+    migrate(cur, firehose.partition_manager, args.keep_old)
+    # The created_at index and everything else the firehose sets up
+    firehose.create_tables(cur)
+    con.commit()
+    con.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+from dateutil import parser
+import psycopg2.errors
+import re
+from threading import Lock, Thread
+from time import sleep
+
+# Keeps track of the posts table's time-range partitions in memory, so flushes only issue CREATE TABLE
+# for partitions that don't exist yet, and creates upcoming partitions / drops expired ones on a
+# background connection instead of inside the flush loop.
+
+_BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def partition_name(start: datetime) -> str:
+    return f"posts_{start.strftime('y%Ym%md%dh%H')}"
+
+class PartitionManager:
+    def __init__(self, partition_hours: int, partitions_ahead: int, retention_hours: int, created_at_index: str):
+        self.granularity = timedelta(hours=partition_hours)
+        self.partitions_ahead = partitions_ahead
+        self.retention = timedelta(hours=retention_hours)
+        self.created_at_index = created_at_index
+        self.lock = Lock()
+        self.partitions: dict[datetime, datetime] = {} # start -> end
+
+    def partition_start(self, time: datetime) -> datetime:
+        return _EPOCH + (time - _EPOCH) // self.granularity * self.granularity
+
+    def load(self, cur):
+        cur.execute(
+            """SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+               FROM pg_inherits
+                   JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+               WHERE pg_inherits.inhparent = 'posts'::regclass""")
+        partitions = {}
+        for _, bound in cur.fetchall():
+            match = _BOUND_PATTERN.search(bound)
+            if match is not None:
+                partitions[parser.parse(match.group(1))] = parser.parse(match.group(2))
+        with self.lock:
+            self.partitions = partitions
+
+    def _covering(self, time: datetime) -> datetime:
+        for start, end in self.partitions.items():
+            if start <= time < end:
+                return start
+        return None
+
+    def partition_range(self, time: datetime) -> tuple[datetime, datetime]:
+        with self.lock:
+            start = self._covering(time)
+            return None if start is None else (start, self.partitions[start])
+
+    # Range of the partition that will hold the given time, trimmed to fit between existing partitions
+    # (which may have been made with a different granularity)
+    def _range_for(self, time: datetime) -> tuple[datetime, datetime]:
+        start = self.partition_start(time)
+        end = start + self.granularity
+        for existing_start, existing_end in self.partitions.items():
+            if existing_end <= time:
+                start = max(start, existing_end)
+            elif existing_start > time:
+                end = min(end, existing_start)
+        return start, end
+
+    # Makes sure a partition exists for each of the times (only hitting the db for ones that don't).
+    # The lock isn't held across db calls, since a CREATE can wait on the other connection's transaction.
+    def ensure(self, cur, times: set[datetime]):
+        with self.lock:
+            missing = {self._range_for(time) for time in times if self._covering(time) is None}
+        for start, end in sorted(missing):
+            table_name = partition_name(start)
+            cur.execute(f'CREATE TABLE IF NOT EXISTS {table_name} PARTITION OF posts FOR VALUES FROM (%s) TO (%s)', (start, end))
+            if self.created_at_index == 'brin':
+                cur.execute(f'CREATE INDEX IF NOT EXISTS {table_name}_created_at_brin ON {table_name} USING BRIN (created_at)')
+            with self.lock:
+                self.partitions[start] = end
+
+    # The current partition and the next partitions_ahead after it
+    def create_upcoming(self, cur, now: datetime):
+        time = now
+        for _ in range(self.partitions_ahead + 1):
+            self.ensure(cur, {time})
+            with self.lock:
+                time = self.partitions[self._covering(time)]
+
+    # Partitions that end before the retention window, so none of their posts are still served
+    def expired(self, now: datetime) -> list[datetime]:
+        cutoff = now - self.retention
+        with self.lock:
+            return sorted(start for start, end in self.partitions.items() if end <= cutoff)
+
+    # DETACH CONCURRENTLY doesn't block inserts into the other partitions, unlike a plain DROP TABLE
+    def drop(self, cur, start: datetime):
+        table_name = partition_name(start)
+        try:
+            cur.execute(f'ALTER TABLE posts DETACH PARTITION {table_name} CONCURRENTLY')
+        except psycopg2.errors.ObjectNotInPrerequisiteState:
+            # An earlier detach was interrupted part way through
+            cur.execute(f'ALTER TABLE posts DETACH PARTITION {table_name} FINALIZE')
+        cur.execute(f'DROP TABLE {table_name}')
+        with self.lock:
+            self.partitions.pop(start, None)
+        print(f'Dropped partition {table_name}.')
+
+    # Only the owner creates and drops partitions; other processes writing posts (firehose shards) just reload
+    # the partitions the owner made. Their map can be a minute stale, so a flush that hits a dropped partition
+    # reloads it too (see firehose.write_rows).
+    def maintain(self, connect, interval_seconds: float, owner: bool = True):
+        con = None
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                if con is None or con.closed:
+                    con = connect()
+                    # DETACH CONCURRENTLY can't run inside a transaction block
+                    con.autocommit = True
+                cur = con.cursor()
+                if not owner:
+                    self.load(cur)
+                    sleep(interval_seconds)
+                    continue
+                self.create_upcoming(cur, now)
+                for start in self.expired(now):
+                    self.drop(cur, start)
+            except Exception as ex:
+                print(f'Partition maintenance error! {ex}')
+                if con is not None:
+                    con.close()
+                    con = None
+            sleep(interval_seconds)
+
+def start_maintenance(manager: PartitionManager, connect, interval_seconds: float = 60.0, owner: bool = True):
+    Thread(target=manager.maintain, args=(connect, interval_seconds, owner), daemon=True).start()
@@ -0,0 +1,25 @@
+from enum import Enum
+from typing import NamedTuple
+
+class RecordType(Enum):
+    Post = 0
+    Like = 1
+    Follow = 2
+    Repost = 3
+
+class ActionType:
+    Created = 0
+    Deleted = 1
+
+class Record(NamedTuple):
+    # One decoded create or delete, holding only the fields that get written to the db. A plain tuple has no
+    # per-instance dict and pickles as its values, so queued records stay small and cheap to send between
+    # processes. Deletes only have the uri.
+    record_type: RecordType
+    action_type: int
+    uri: str
+    author: str = None
+    cid_key: int = None # See storage.cid_key
+    created_at: float = None # Epoch seconds
+    subject: str = None # Followee DID for follows, reposted post uri for reposts
+    reply: bool = False
@@ -0,0 +1,239 @@
+import argparse
+from atproto import firehose_models, models
+import config
+from datetime import datetime, timezone
+from decoder import DecodePool
+import firehose
+import gzip
+import os
+import struct
+from synthetic import FrameGenerator
+from threading import Thread
+from time import perf_counter, perf_counter_ns, sleep, time
+from websockets.sync.client import connect as connect_websocket
+
+# Records raw subscribeRepos frames to a file, and replays them through the firehose's own message handler and
+# process_events against a scratch schema in the local Postgres, to measure ingestion without the live relay.
+#   python replay.py record frames.gz --seconds 300
+#   python replay.py synthetic frames.gz --frames 200000
+#   python replay.py run --file frames.gz --speed 10
+#   python replay.py run --synthetic 200000 --speed 0
+# --speed is a multiple of the recorded rate (1 = wall clock, 0 = as fast as possible).
+# Posts older than the retention window are skipped by the flush like any others, so replay recent recordings,
+# or generate synthetic frames (timestamped from now). Flushes publish their notifications as usual, so don't
+# point this at a db a live feeds service is listening to.
+
+RELAY_URI = 'wss://bsky.network/xrpc/com.atproto.sync.subscribeRepos'
+SCHEMA = 'firehose_replay'
+
+# Each frame in a recording: receive time (epoch seconds) and length, then the raw websocket message
+_FRAME_HEADER = struct.Struct('<dI')
+
+def write_frames(path: str, frames) -> int:
+    count = 0
+    with gzip.open(path, 'wb') as file:
+        for received_time, data in frames:
+            file.write(_FRAME_HEADER.pack(received_time, len(data)))
+            file.write(data)
+            count += 1
+    return count
+
+def read_frames(path: str):
+    with gzip.open(path, 'rb') as file:
+        while True:
+            header = file.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                return
+            received_time, length = _FRAME_HEADER.unpack(header)
+            yield received_time, file.read(length)
+
+def relay_frames(cursor: int, max_frames: int, max_seconds: float):
+    uri = RELAY_URI if cursor is None else f'{RELAY_URI}?cursor={cursor}'
+    end_time = time() + max_seconds
+    count = 0
+    with connect_websocket(uri, max_size=None) as websocket:
+        while count < max_frames and time() < end_time:
+            data = websocket.recv()
+            if isinstance(data, str):
+                continue
+            yield time(), data
+            count += 1
+
+def synthetic_frames(frame_count: int, events_per_second: float, seed: int):
+    generator = FrameGenerator(seed=seed)
+    start_time = datetime.now(timezone.utc)
+    for i, frame in enumerate(generator.frames(frame_count, start_time, events_per_second)):
+        yield start_time.timestamp() + i / events_per_second, frame
+
+class ReplayClient:
+    # Stands in for FirehoseSubscribeReposClient: hands pre-loaded frames to the message handler instead of reading
+    # a websocket, paced by their receive times
+    def __init__(self, frames: list[tuple[float, bytes]], speed: float):
+        self.frames = frames
+        self.speed = speed
+        self.cursor: int = None
+
+        self.parse_ns: list[int] = []
+        self.handle_ns: list[int] = []
+        self.start_time: float = None
+        self.sent_time: float = None
+
+    # Called by process_events after each commit
+    def update_params(self, params: models.ComAtprotoSyncSubscribeRepos.Params):
+        self.cursor = params.cursor
+
+    def start(self, on_message_callback, on_callback_error_callback = None):
+        first_received_time = self.frames[0][0]
+        self.start_time = perf_counter()
+        for received_time, data in self.frames:
+            if self.speed > 0.0:
+                delay = self.start_time + (received_time - first_received_time) / self.speed - perf_counter()
+                if delay > 0.0:
+                    sleep(delay)
+
+            parse_start = perf_counter_ns()
+            frame = firehose_models.Frame.from_bytes(data)
+            handle_start = perf_counter_ns()
+            self.parse_ns.append(handle_start - parse_start)
+            if not isinstance(frame, firehose_models.MessageFrame):
+                continue
+            try:
+                on_message_callback(frame)
+            except Exception as ex:
+                if on_callback_error_callback is not None:
+                    on_callback_error_callback(ex)
+            self.handle_ns.append(perf_counter_ns() - handle_start)
+        self.sent_time = perf_counter()
+
+def last_seq(frames: list[tuple[float, bytes]]) -> int:
+    for _, data in reversed(frames):
+        frame = firehose_models.Frame.from_bytes(data)
+        if isinstance(frame, firehose_models.MessageFrame) and frame.body.get('seq') is not None:
+            return frame.body['seq']
+    return None
+
+def percentile(values: list[float], fraction: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+# Peak (VmHWM) and current (VmRSS) resident memory of a process, in MiB
+def memory_mib(pid: int) -> tuple[float, float]:
+    fields = {}
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            name, _, value = line.partition(':')
+            fields[name] = value
+    return int(fields['VmHWM'].split()[0]) / 1024, int(fields['VmRSS'].split()[0]) / 1024
+
+def connect_scratch():
+    return firehose.connect_db(options=f'-c search_path={SCHEMA}')
+
+def reset_schema():
+    con = firehose.connect_db()
+    cur = con.cursor()
+    cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    cur.execute(f'CREATE SCHEMA {SCHEMA}')
+    con.commit()
+    con.close()
+
+def drop_schema():
+    con = firehose.connect_db()
+    cur = con.cursor()
+    cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    con.commit()
+    con.close()
+
+def run(args):
+    if args.file:
+        frames = list(read_frames(args.file))
+    else:
+        frames = list(synthetic_frames(args.synthetic, args.rate, args.seed))
+    if len(frames) == 0:
+        print('No frames to replay.')
+        return
+    final_seq = last_seq(frames)
+    print(f'Replaying {len(frames)} frames at {"max" if args.speed == 0 else f"{args.speed}x"} speed into schema {SCHEMA}.')
+
+    reset_schema()
+    _, baseline_rss = memory_mib(os.getpid())
+
+    # Decode worker processes are forked before any other threads are started
+    decode_pool: DecodePool = None
+    if args.decode_workers > 0:
+        decode_pool = DecodePool(args.decode_workers, firehose.record_queue, firehose.cursor_tracker, None)
+        decode_pool.start()
+
+    client = ReplayClient(frames, args.speed)
+    flushes: list[tuple[int, float]] = []
+    flush_thread = Thread(target=firehose.process_events, args=(client, connect_scratch, lambda count, seconds: flushes.append((count, seconds))), daemon=True)
+    flush_thread.start()
+
+    client.start(firehose.make_message_handler(decode_pool, None))
+
+    # Done once everything sent has been committed
+    while flush_thread.is_alive() and final_seq is not None and (client.cursor is None or client.cursor < final_seq):
+        sleep(0.05)
+    end_time = perf_counter()
+    if not flush_thread.is_alive():
+        print('process_events stopped before the replay finished.')
+
+    elapsed_seconds = end_time - client.start_time
+    send_seconds = client.sent_time - client.start_time
+    flush_seconds = [seconds for _, seconds in flushes]
+    parse_us = [ns / 1000 for ns in client.parse_ns]
+    handle_us = [ns / 1000 for ns in client.handle_ns]
+    print(f'Events: {len(frames)} in {elapsed_seconds:.1f} seconds ({len(frames) / elapsed_seconds:.0f} events/sec committed, '
+          f'{len(frames) / send_seconds:.0f} events/sec handed to the handler).')
+    print(f'Frame parse: mean {sum(parse_us) / len(parse_us):.1f} us, p99 {percentile(parse_us, 0.99):.1f} us.')
+    print(f'Message handler ({"submit to " + str(args.decode_workers) + " decode workers" if decode_pool else "decode + queue"}): '
+          f'mean {sum(handle_us) / max(len(handle_us), 1):.1f} us, p50 {percentile(handle_us, 0.5):.1f} us, p99 {percentile(handle_us, 0.99):.1f} us.')
+    print(f'Flushes: {len(flushes)} ({sum(count for count, _ in flushes)} records), latency p50 {percentile(flush_seconds, 0.5) * 1000:.0f} ms, '
+          f'p95 {percentile(flush_seconds, 0.95) * 1000:.0f} ms, p99 {percentile(flush_seconds, 0.99) * 1000:.0f} ms, max {max(flush_seconds, default=0.0) * 1000:.0f} ms.')
+    peak_rss, _ = memory_mib(os.getpid())
+    worker_peak_rss = [memory_mib(worker.pid)[0] for worker in decode_pool.workers] if decode_pool else []
+    print(f'Peak RSS: {peak_rss:.0f} MiB ({baseline_rss:.0f} MiB with the frames loaded, before replaying)'
+          + (f', decode workers {max(worker_peak_rss):.0f} MiB each at most.' if worker_peak_rss else '.'))
+
+    if not args.keep:
+        drop_schema()
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='Record raw frames from the relay')
+    record_parser.add_argument('path')
+    record_parser.add_argument('--seconds', type=float, default=60.0)
+    record_parser.add_argument('--frames', type=int, default=10_000_000)
+    record_parser.add_argument('--cursor', type=int, default=None)
+
+    synthetic_parser = subparsers.add_parser('synthetic', help='Write a file of synthetic frames')
+    synthetic_parser.add_argument('path')
+    synthetic_parser.add_argument('--frames', type=int, default=100_000)
+    synthetic_parser.add_argument('--rate', type=float, default=1000.0, help='Events per second the frames are spread over')
+    synthetic_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='Replay frames through the ingestion pipeline')
+    source = run_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file')
+    source.add_argument('--synthetic', type=int, help='Replay this many synthetic frames, generated up front')
+    run_parser.add_argument('--rate', type=float, default=1000.0, help='Events per second of the synthetic frames')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--speed', type=float, default=0.0)
+    run_parser.add_argument('--decode-workers', type=int, default=config.FIREHOSE_DECODE_WORKERS)
+    run_parser.add_argument('--keep', action='store_true', help=f'Keep the {SCHEMA} schema afterwards')
+
+    args = arg_parser.parse_args()
+    if args.command == 'record':
+        count = write_frames(args.path, relay_frames(args.cursor, args.frames, args.seconds))
+        print(f'Recorded {count} frames to {args.path}.')
+    elif args.command == 'synthetic':
+        count = write_frames(args.path, synthetic_frames(args.frames, args.rate, args.seed))
+        print(f'Wrote {count} synthetic frames to {args.path}.')
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
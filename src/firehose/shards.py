@@ -0,0 +1,214 @@
+from atproto import firehose_models, FirehoseSubscribeReposClient, models
+from collections import deque
+import config
+from cursor import CURSOR_ID, CursorTracker, load_cursor, save_cursor
+from datetime import datetime, timezone
+from decoder import repo_shard
+import firehose
+import ingest_filter
+import metrics
+import multiprocessing
+import os
+import partitions
+import psycopg2
+from threading import Lock, Thread
+from time import sleep, time
+
+# Splits ingestion between shard_count consumer processes by a hash of the repo DID (see repo_shard), for when one
+# process can't keep up with decoding, filtering and writing the whole firehose. The coordinator holds the one
+# websocket and sends each commit frame to its repo's shard; each shard runs the usual message handler and
+# process_events over its own db connection, saving its own cursor with its writes. Every frame from a repo goes to
+# the same shard in order, so creates and deletes of a record are still written in order.
+# The coordinator's cursor is the highest seq with every earlier frame committed by its shard, which is where
+# reconnects and restarts resume from. Frames a shard had already committed are skipped when they come around again,
+# but frames can still be written again: ones re-sent after a reconnect before their shard's report arrives, and
+# everything after the coordinator's cursor when the shard count changes (each count has its own shard cursors).
+# Those rewrites are dropped by the posts and follows unique keys (see storage.create_tables), and deletes of rows
+# that are already gone do nothing.
+# Each shard has its own metrics (flushes, queue depth, lag...), served on metrics_port + 1 + its index; the
+# coordinator serves lag, partitions and the firehose_shard_* metrics on metrics_port.
+
+def shard_cursor_id(index: int, shard_count: int) -> str:
+    return f'{CURSOR_ID}-shard-{index}-of-{shard_count}'
+
+class ShardReporter:
+    # Stands in for the firehose client in a shard's process_events, so the cursor it would resume from (saved by
+    # the flush that just committed) and each flush's size and time go back to the coordinator
+    def __init__(self, index: int, reports: multiprocessing.Queue):
+        self.index = index
+        self.reports = reports
+
+    def update_params(self, params: models.ComAtprotoSyncSubscribeRepos.Params):
+        self.reports.put(('committed', self.index, params.cursor))
+
+    def on_flush(self, record_count: int, flush_seconds: float):
+        self.reports.put(('flushed', self.index, record_count, flush_seconds))
+
+def _handle_frames(frames: multiprocessing.Queue, on_message_handler):
+    while True:
+        on_message_handler(frames.get())
+
+def run_shard(index: int, shard_count: int, frames: multiprocessing.Queue, reports: multiprocessing.Queue):
+    # Forked before the coordinator starts any threads, so the firehose module's queue, cursor tracker and filters
+    # are fresh copies. The coordinator creates the tables and partitions; this only writes to them.
+    if config.FIREHOSE_METRICS_PORT > 0:
+        metrics.serve(config.FIREHOSE_METRICS_PORT + 1 + index)
+    ingest_filter.start_listener(firehose.record_filter, firehose.connect_db, follow_changes=True)
+    firehose.record_filter.ready.wait()
+
+    on_message_handler = firehose.make_message_handler(None, firehose.record_filter.keep)
+    Thread(target=_handle_frames, args=(frames, on_message_handler), daemon=True).start()
+
+    reporter = ShardReporter(index, reports)
+    firehose.process_events(reporter, on_flush=reporter.on_flush, cursor_id=shard_cursor_id(index, shard_count), manage_schema=False)
+
+class ShardCoordinator:
+    def __init__(self, shard_count: int, shard_cursors: list[int], max_backlog: int, report_interval: float = 10.0):
+        self.shard_count = shard_count
+        self.report_interval = report_interval
+        self.cursor_tracker = CursorTracker()
+
+        self.lock = Lock()
+        # Last seq each shard committed, and the (seq, time) of frames sent to it since
+        self.shard_cursors = shard_cursors
+        self.in_flight: list[deque[tuple[int, str]]] = [deque() for _ in range(shard_count)]
+        self.frames_sent = [0] * shard_count
+        self.records_flushed = [0] * shard_count
+
+        # Sending blocks while max_backlog frames are waiting for a shard, so a shard that falls behind pauses
+        # reading from the firehose like a full record queue does
+        context = multiprocessing.get_context('fork')
+        self.frame_queues = [context.Queue(max_backlog) for _ in range(shard_count)]
+        self.reports = context.Queue()
+        self.shards = [context.Process(target=run_shard, args=(index, shard_count, self.frame_queues[index], self.reports), daemon=True)
+                       for index in range(shard_count)]
+
+    def start_shards(self):
+        for shard in self.shards:
+            shard.start()
+
+    def start(self, client: FirehoseSubscribeReposClient, connect):
+        for index in range(self.shard_count):
+            metrics.SHARD_BACKLOG.labels(str(index)).set_function(lambda index=index: len(self.in_flight[index]))
+        Thread(target=self._collect_reports, daemon=True).start()
+        Thread(target=self._save_cursor, args=(client, connect), daemon=True).start()
+
+    def on_message(self, message: firehose_models.MessageFrame):
+        body = message.body
+        seq = body.get('seq')
+        repo = body.get('repo') if message.type == '#commit' else None
+        if not repo:
+            if seq is not None:
+                self.cursor_tracker.frame_done(seq, body.get('time'))
+            return
+
+        index = repo_shard(repo, self.shard_count)
+        with self.lock:
+            shard_cursor = self.shard_cursors[index]
+            already_committed = shard_cursor is not None and seq <= shard_cursor
+            if not already_committed:
+                self.cursor_tracker.frame_started(seq)
+                self.in_flight[index].append((seq, body.get('time')))
+                self.frames_sent[index] += 1
+        if already_committed:
+            self.cursor_tracker.frame_done(seq, body.get('time'))
+            return
+
+        metrics.SHARD_FRAMES.labels(str(index)).inc()
+        self.frame_queues[index].put(message)
+
+    def _collect_reports(self):
+        while True:
+            report = self.reports.get()
+            if report[0] == 'committed':
+                _, index, seq = report
+                with self.lock:
+                    self.shard_cursors[index] = seq
+                    in_flight = self.in_flight[index]
+                    while len(in_flight) > 0 and in_flight[0][0] <= seq:
+                        frame_seq, event_time = in_flight.popleft()
+                        self.cursor_tracker.frame_finished(frame_seq, event_time)
+            else:
+                _, index, record_count, flush_seconds = report
+                metrics.SHARD_RECORDS.labels(str(index)).inc(record_count)
+                metrics.SHARD_FLUSH_SECONDS.labels(str(index)).observe(flush_seconds)
+                with self.lock:
+                    self.records_flushed[index] += record_count
+
+    def _save_cursor(self, client: FirehoseSubscribeReposClient, connect):
+        con = None
+        last_saved_seq = None
+        last_frames_sent = [0] * self.shard_count
+        last_records_flushed = [0] * self.shard_count
+        last_report_time = time()
+        while True:
+            sleep(config.FIREHOSE_FLUSH_INTERVAL)
+
+            for index, shard in enumerate(self.shards):
+                if not shard.is_alive():
+                    print(f'Firehose shard {index} exited with code {shard.exitcode}! Restarting...')
+                    # exit() would only end this thread
+                    os._exit(1)
+
+            # Shards have already committed every frame up to the watermark
+            watermark = self.cursor_tracker.low_watermark()
+            if watermark is not None and watermark != last_saved_seq:
+                try:
+                    if con is None:
+                        con = connect()
+                    save_cursor(con.cursor(), watermark)
+                    con.commit()
+                    client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=watermark))
+                    last_saved_seq = watermark
+                except psycopg2.Error as ex:
+                    print(f'Failed to save the firehose cursor! {ex}')
+                    if con is not None:
+                        con.close()
+                        con = None
+
+            now = time()
+            if now - last_report_time < self.report_interval:
+                continue
+            with self.lock:
+                frames_sent = list(self.frames_sent)
+                records_flushed = list(self.records_flushed)
+                backlogs = [len(in_flight) for in_flight in self.in_flight]
+            elapsed_seconds = now - last_report_time
+            for index in range(self.shard_count):
+                print(f'Shard {index}: {(frames_sent[index] - last_frames_sent[index]) / elapsed_seconds:.1f} frames/sec, '
+                      f'{(records_flushed[index] - last_records_flushed[index]) / elapsed_seconds:.1f} records/sec, {backlogs[index]} frames uncommitted.')
+            print(f'Cursor: {last_saved_seq} - lag: {self.cursor_tracker.lag():.1f} seconds.')
+            last_frames_sent = frames_sent
+            last_records_flushed = records_flushed
+            last_report_time = now
+
+def run_coordinator(shard_count: int):
+    con = firehose.connect_db()
+    cur = con.cursor()
+    firehose.create_tables(cur)
+    firehose.partition_manager.load(cur)
+    firehose.partition_manager.create_upcoming(cur, datetime.now(timezone.utc))
+    con.commit()
+    # Resume from the oldest frame some shard hasn't committed; each shard skips what it already has
+    start_cursor = load_cursor(cur)
+    shard_cursors = [load_cursor(cur, shard_cursor_id(index, shard_count)) for index in range(shard_count)]
+    con.close()
+    print(f'Starting firehose from cursor {start_cursor} across {shard_count} shards (shard cursors: {shard_cursors}).')
+
+    coordinator = ShardCoordinator(shard_count, shard_cursors, config.FIREHOSE_SHARD_BACKLOG)
+    coordinator.start_shards()
+
+    params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=start_cursor)
+    client = FirehoseSubscribeReposClient(params)
+
+    def on_error_handler(ex: BaseException) -> None:
+        print(f'Firehose error! {ex}')
+        exit(1)
+
+    partitions.start_maintenance(firehose.partition_manager, firehose.connect_db)
+    metrics.LAG_SECONDS.set_function(coordinator.cursor_tracker.lag)
+    metrics.PARTITIONS.set_function(lambda: len(firehose.partition_manager.partitions))
+    metrics.serve(config.FIREHOSE_METRICS_PORT)
+    coordinator.start(client, firehose.connect_db)
+
+    client.start(coordinator.on_message, on_error_handler)
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, timezone
+import hashlib
+import libipld
+from random import Random
+from time import time_ns
+
+# Generates subscribeRepos frames shaped like the live network's, for benchmarks and replay without a relay
+
+_TID_ALPHABET = '234567abcdefghijklmnopqrstuvwxyz'
+
+# Rough share of each collection in the live firehose
+_COLLECTION_WEIGHTS = [
+    ('app.bsky.feed.like', 50),
+    ('app.bsky.feed.post', 15),
+    ('app.bsky.graph.follow', 12),
+    ('app.bsky.feed.repost', 8),
+    ('app.bsky.graph.block', 3),
+    ('app.bsky.graph.listitem', 3),
+    ('app.bsky.actor.profile', 2),
+    ('app.bsky.feed.threadgate', 1),
+]
+
+_WORDS = 'the a to of and in is it you that for on was with this my at be just so like have are not but what out all'.split()
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def make_cid(data: bytes) -> bytes:
+    # CIDv1, dag-cbor codec, sha2-256 multihash
+    return bytes([0x01, 0x71, 0x12, 0x20]) + hashlib.sha256(data).digest()
+
+def make_tid(timestamp_us: int, clock_id: int = 0) -> str:
+    value = (timestamp_us << 10) | (clock_id & 0x3ff)
+    chars = []
+    for _ in range(13):
+        chars.append(_TID_ALPHABET[value & 0x1f])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+def encode_car(root: bytes, blocks: list[tuple[bytes, bytes]]) -> bytes:
+    header = libipld.encode_dag_cbor({'version': 1, 'roots': [root]})
+    out = bytearray(_varint(len(header)) + header)
+    for cid, data in blocks:
+        out += _varint(len(cid) + len(data)) + cid + data
+    return bytes(out)
+
+def encode_frame(body: dict, frame_type: str = '#commit') -> bytes:
+    return libipld.encode_dag_cbor({'op': 1, 't': frame_type}) + libipld.encode_dag_cbor(body)
+
+class FrameGenerator:
+    def __init__(self, seed: int = 0, repo_count: int = 10_000, start_seq: int = 1, delete_ratio: float = 0.05, reply_ratio: float = 0.4):
+        self.random = Random(seed)
+        self.repos = [f'did:plc:{self.random.getrandbits(120):030x}'[:32] for _ in range(repo_count)]
+        self.seq = start_seq
+        self.delete_ratio = delete_ratio
+        self.reply_ratio = reply_ratio
+        self.collections = [collection for collection, _ in _COLLECTION_WEIGHTS]
+        self.weights = [weight for _, weight in _COLLECTION_WEIGHTS]
+        self.recent_posts: list[str] = []
+
+    def _text(self) -> str:
+        return ' '.join(self.random.choice(_WORDS) for _ in range(self.random.randint(3, 40)))
+
+    def _strong_ref(self) -> dict:
+        uri = self.random.choice(self.recent_posts) if self.recent_posts else f'at://{self.random.choice(self.repos)}/app.bsky.feed.post/{make_tid(time_ns() // 1000)}'
+        return {'uri': uri, 'cid': libipld.encode_cid(make_cid(uri.encode()))}
+
+    def _record(self, collection: str, created_at: str) -> dict:
+        if collection == 'app.bsky.feed.post':
+            record = {'$type': collection, 'text': self._text(), 'langs': ['en'], 'createdAt': created_at}
+            if self.random.random() < self.reply_ratio:
+                ref = self._strong_ref()
+                record['reply'] = {'root': ref, 'parent': ref}
+            return record
+        if collection in ('app.bsky.feed.like', 'app.bsky.feed.repost'):
+            return {'$type': collection, 'subject': self._strong_ref(), 'createdAt': created_at}
+        if collection in ('app.bsky.graph.follow', 'app.bsky.graph.block'):
+            return {'$type': collection, 'subject': self.random.choice(self.repos), 'createdAt': created_at}
+        if collection == 'app.bsky.graph.listitem':
+            return {'$type': collection, 'subject': self.random.choice(self.repos), 'list': f'at://{self.random.choice(self.repos)}/app.bsky.graph.list/{make_tid(time_ns() // 1000)}', 'createdAt': created_at}
+        return {'$type': collection, 'createdAt': created_at}
+
+    def next_body(self, now: datetime = None) -> dict:
+        now = now or datetime.now(timezone.utc)
+        created_at = now.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        repo = self.random.choice(self.repos)
+        collection = self.random.choices(self.collections, self.weights)[0]
+        timestamp_us = int(now.timestamp() * 1_000_000)
+
+        ops = []
+        blocks = []
+        if self.random.random() < self.delete_ratio:
+            # Deletes mostly point at records from earlier in the retention window
+            deleted_us = timestamp_us - self.random.randint(0, 13 * 60 * 60 * 1_000_000)
+            ops.append({'action': 'delete', 'path': f'{collection}/{make_tid(deleted_us, self.random.getrandbits(10))}', 'cid': None})
+        else:
+            rkey = make_tid(timestamp_us, self.random.getrandbits(10))
+            data = libipld.encode_dag_cbor(self._record(collection, created_at))
+            cid = make_cid(data)
+            ops.append({'action': 'create', 'path': f'{collection}/{rkey}', 'cid': cid})
+            blocks.append((cid, data))
+            if collection == 'app.bsky.feed.post':
+                self.recent_posts.append(f'at://{repo}/{collection}/{rkey}')
+                if len(self.recent_posts) > 1000:
+                    self.recent_posts = self.recent_posts[-500:]
+
+        # Every commit also carries the signed commit block and a few MST nodes
+        commit_data = libipld.encode_dag_cbor({'did': repo, 'version': 3, 'rev': make_tid(timestamp_us), 'sig': self.random.randbytes(64)})
+        commit_cid = make_cid(commit_data)
+        blocks.append((commit_cid, commit_data))
+        for _ in range(self.random.randint(1, 4)):
+            node_data = libipld.encode_dag_cbor({'e': [{'k': self.random.randbytes(24), 'p': 0, 't': None, 'v': make_cid(self.random.randbytes(8))}], 'l': None})
+            blocks.append((make_cid(node_data), node_data))
+
+        body = {
+            'seq': self.seq,
+            'repo': repo,
+            'rev': make_tid(timestamp_us),
+            'since': None,
+            'commit': commit_cid,
+            'prev': None,
+            'rebase': False,
+            'tooBig': False,
+            'ops': ops,
+            'blocks': encode_car(commit_cid, blocks),
+            'blobs': [],
+            'time': created_at,
+        }
+        self.seq += 1
+        return body
+
+    def next_frame(self, now: datetime = None) -> bytes:
+        return encode_frame(self.next_body(now))
+
+    def frames(self, count: int, start_time: datetime = None, events_per_second: float = 1000.0):
+        start_time = start_time or datetime.now(timezone.utc)
+        for i in range(count):
+            yield self.next_frame(start_time + timedelta(seconds=i / events_per_second))
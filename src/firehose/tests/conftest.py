@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Both services have a metrics module, so the other service's (if its tests were collected first) is forgotten
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.modules.pop('metrics', None)
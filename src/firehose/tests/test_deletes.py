@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+from deletes import StoredUriFilter, uri_digest
+from partitions import PartitionManager
+from storage import tid_string
+
+def at(hour: int, minute: int = 0) -> datetime:
+    return datetime(2026, 10, 17, tzinfo=timezone.utc) + timedelta(hours=hour, minutes=minute)
+
+def post_uri(author: str, rkey_time: datetime) -> str:
+    return f'at://{author}/app.bsky.feed.post/{tid_string(int(rkey_time.timestamp() * 1_000_000) << 10)}'
+
+def stored_filter() -> StoredUriFilter:
+    partition_manager = PartitionManager(1, 2, 13, 'btree')
+    partition_manager.partitions = {at(hour): at(hour + 1) for hour in range(10, 13)}
+    return StoredUriFilter(partition_manager, 2 ** 16)
+
+def test_match_finds_post_in_its_tid_partition():
+    stored_uris = stored_filter()
+    uri = post_uri('did:plc:a', at(11, 30))
+    stored_uris.add([(uri, at(11, 30))])
+    assert stored_uris.match([uri]) == ({at(11): [uri]}, 0)
+
+def test_match_skips_uris_never_stored():
+    stored_uris = stored_filter()
+    stored_uris.add([(post_uri('did:plc:a', at(11, 30)), at(11, 30))])
+    assert stored_uris.match([post_uri('did:plc:b', at(11, 30))]) == ({}, 1)
+
+def test_match_probes_other_partitions_when_the_tid_partition_is_a_false_positive():
+    stored_uris = stored_filter()
+    # Backdated: the rkey says 12:00, but created_at put the post in the 10:00 partition
+    uri = post_uri('did:plc:a', at(12, 15))
+    stored_uris.add([(uri, at(10, 15)), (post_uri('did:plc:b', at(12, 30)), at(12, 30))])
+    # And the 12:00 filter happens to match it too
+    stored_uris.filters[at(12)].add(uri_digest(uri))
+
+    matches, skipped = stored_uris.match([uri])
+    assert skipped == 0
+    assert list(matches) == [at(12), at(10)]
+    assert matches[at(10)] == [uri]
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+import firehose
+from partitions import PartitionManager
+import psycopg2.errors
+import pytest
+
+HOUR = timedelta(hours=1)
+
+def at(hour: int, minute: int = 0) -> datetime:
+    return datetime(2026, 10, 17, tzinfo=timezone.utc) + timedelta(hours=hour, minutes=minute)
+
+def manager(partition_hours: int = 1, partitions: list[tuple[datetime, datetime]] = ()) -> PartitionManager:
+    partition_manager = PartitionManager(partition_hours, 2, 13, 'btree')
+    partition_manager.partitions = dict(partitions)
+    return partition_manager
+
+class StubCursor:
+    # Answers PartitionManager.load with the partitions that exist in the "db", and records everything executed
+    def __init__(self, partitions: list[tuple[datetime, datetime]]):
+        self.partitions = partitions
+        self.executed: list[str] = []
+
+    def execute(self, query: str, params: tuple = None):
+        self.executed.append(query)
+
+    def fetchall(self) -> list[tuple]:
+        return [(f'posts_{index}', f"FOR VALUES FROM ('{start}') TO ('{end}')") for index, (start, end) in enumerate(self.partitions)]
+
+class StubConnection:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+def test_range_for_aligns_to_granularity():
+    assert manager()._range_for(at(12, 30)) == (at(12), at(13))
+    assert manager(partition_hours=2)._range_for(at(13, 30)) == (at(12), at(14))
+
+def test_range_for_fits_between_existing_partitions():
+    # Made with a different granularity, so the new one is trimmed on both sides instead of overlapping them
+    partition_manager = manager(partition_hours=4, partitions=[(at(9), at(11)), (at(13), at(15))])
+    # 08:00-12:00 starts inside 09:00-11:00, and 12:00-16:00 runs into 13:00-15:00
+    assert partition_manager._range_for(at(11, 30)) == (at(11), at(12))
+    assert partition_manager._range_for(at(12, 30)) == (at(12), at(13))
+
+@pytest.mark.parametrize('now', [at(14), at(14, 30), at(14, 59)])
+def test_expired_only_once_the_whole_partition_is_past_retention(now: datetime):
+    partition_manager = manager(partitions=[(at(hour), at(hour + 1)) for hour in range(16)])
+    # The cutoff is between 01:00 and 02:00, so the 01:00 partition still holds posts inside the window
+    assert partition_manager.expired(now) == [at(0)]
+
+def test_expired_at_exact_boundary():
+    partition_manager = manager(partitions=[(at(0), at(1)), (at(1), at(2))])
+    assert partition_manager.expired(at(14) - timedelta(microseconds=1)) == []
+    assert partition_manager.expired(at(14)) == [at(0)]
+
+def test_write_rows_recreates_a_partition_dropped_since_the_map_was_loaded(monkeypatch):
+    # The map still has 10:00, which the coordinator has since dropped
+    partition_manager = manager(partitions=[(at(10), at(11)), (at(11), at(12))])
+    cur = StubCursor([(at(11), at(12))])
+    con = StubConnection()
+    writes = []
+    def write_rows_batch(*rows):
+        writes.append(rows)
+        if len(writes) == 1:
+            raise psycopg2.errors.CheckViolation('no partition of relation "posts" found for row')
+    monkeypatch.setattr(firehose, 'partition_manager', partition_manager)
+    monkeypatch.setattr(firehose, 'write_mode', 'batch')
+    monkeypatch.setattr(firehose, 'write_rows_batch', write_rows_batch)
+
+    firehose.write_rows(con, cur, {at(10)}, [], [], [], [])
+
+    assert len(writes) == 2
+    assert con.rollbacks == 1
+    assert [query for query in cur.executed if query.startswith('CREATE TABLE')] == [
+        'CREATE TABLE IF NOT EXISTS posts_y2026m10d17h10 PARTITION OF posts FOR VALUES FROM (%s) TO (%s)']
+    assert partition_manager.partitions == {at(10): at(11), at(11): at(12)}
+
+def test_write_rows_gives_up_after_one_retry(monkeypatch):
+    def write_rows_batch(*rows):
+        raise psycopg2.errors.CheckViolation('no partition of relation "posts" found for row')
+    monkeypatch.setattr(firehose, 'partition_manager', manager())
+    monkeypatch.setattr(firehose, 'write_mode', 'batch')
+    monkeypatch.setattr(firehose, 'write_rows_batch', write_rows_batch)
+
+    with pytest.raises(psycopg2.errors.CheckViolation):
+        firehose.write_rows(StubConnection(), StubCursor([]), {at(10)}, [], [], [], [])
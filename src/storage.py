@@ -0,0 +1,135 @@
+from base64 import b32decode
+from collections import OrderedDict
+from hashlib import blake2b
+import re
+
+# Compact row format shared by the firehose (which writes posts and follows) and the feeds service (which primes
+# follows and reads both). Every DID is stored once in the actors table and rows refer to it by id, record keys are
+# TIDs stored as the 64-bit integer they encode, and a post keeps only 8 bytes of its CID's digest, which is all the
+# feed shuffle needs. URIs are rebuilt from these when a feed is served.
+
+POST_COLLECTION = 'app.bsky.feed.post'
+REPOST_COLLECTION = 'app.bsky.feed.repost'
+FOLLOW_COLLECTION = 'app.bsky.graph.follow'
+
+# A TID is 13 base32-sortable characters encoding microseconds since the epoch, then a 10 bit clock id. The first
+# character only carries 4 bits, so every TID is 64 bits, kept in a signed BIGINT as its two's complement.
+_TID_CHARS = '234567abcdefghijklmnopqrstuvwxyz'
+_TID_PATTERN = re.compile('[2-7a-j][2-7a-z]{12}')
+_TID_TO_BASE32 = str.maketrans(_TID_CHARS, '0123456789abcdefghijklmnopqrstuv')
+_TID_PAIRS = [first + second for first in _TID_CHARS for second in _TID_CHARS]
+
+# None for record keys that aren't TIDs. The lexicons of every record we store require TID keys.
+def tid_value(rkey: str) -> int:
+    if _TID_PATTERN.fullmatch(rkey) is None:
+        return None
+    value = int(rkey.translate(_TID_TO_BASE32), 32)
+    return value - (1 << 64) if value >> 63 else value
+
+def tid_string(value: int) -> str:
+    value &= 0xffffffffffffffff
+    return (_TID_CHARS[value >> 60] + _TID_PAIRS[(value >> 50) & 0x3ff] + _TID_PAIRS[(value >> 40) & 0x3ff] + _TID_PAIRS[(value >> 30) & 0x3ff]
+            + _TID_PAIRS[(value >> 20) & 0x3ff] + _TID_PAIRS[(value >> 10) & 0x3ff] + _TID_PAIRS[value & 0x3ff])
+
+# The last 8 bytes of a binary CID are the end of its sha-256 digest, so they're already uniformly random
+def cid_key(cid: bytes) -> int:
+    return int.from_bytes(cid[-8:], 'big', signed=True)
+
+# For CIDs as base32 multibase strings ("bafyrei..."), e.g. the reversed cid_rev column of the old tables
+def cid_key_from_string(cid: str) -> int:
+    try:
+        encoded = cid[1:].upper()
+        return cid_key(b32decode(encoded + '=' * (-len(encoded) % 8)))
+    except ValueError:
+        return cid_key(blake2b(cid.encode(), digest_size=8).digest())
+
+# at://<did>/<collection>/<rkey> -> (did, collection, rkey as a TID value), or None if the rkey isn't a TID
+def parse_uri(uri: str) -> tuple[str, str, int]:
+    parts = uri.split('/')
+    if len(parts) != 5 or parts[0] != 'at:' or parts[1] != '':
+        return None
+    rkey = tid_value(parts[4])
+    if rkey is None:
+        return None
+    return parts[2], parts[3], rkey
+
+def record_uri(did: str, collection: str, rkey: int) -> str:
+    return f'at://{did}/{collection}/{tid_string(rkey)}'
+
+def create_tables(cur):
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS actors(
+            id INT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            did TEXT NOT NULL UNIQUE
+        )""")
+    # Only fixed-width columns, 4 byte ones first so nothing is padded. Reposts have the reposted post's author
+    # and rkey in subject_author_id and subject_rkey, which are null for posts.
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS posts(
+            author_id INT NOT NULL,
+            subject_author_id INT,
+            rkey BIGINT NOT NULL,
+            subject_rkey BIGINT,
+            cid_key BIGINT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        ) PARTITION BY RANGE(created_at)""")
+    # Serves both the candidate queries (by author) and deletes (by author and rkey), and makes replayed inserts
+    # conflict. Unique indexes on a partitioned table have to include the partition key, which is the same for a
+    # replay of the same record.
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_posts_key ON posts (author_id, rkey, created_at)')
+    # Followees are read with an index-only scan
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS follows(
+            follower_id INT NOT NULL,
+            followee_id INT NOT NULL,
+            rkey BIGINT NOT NULL,
+            PRIMARY KEY (follower_id, rkey) INCLUDE (followee_id)
+        )""")
+
+# Looks up the ids of DIDs, without adding any that aren't there yet
+def find_actors(cur, dids) -> dict[str, int]:
+    cur.execute('SELECT did, id FROM actors WHERE did = ANY(%s)', (list(dids), ))
+    return dict(cur.fetchall())
+
+# Ids of the DIDs, adding the ones that aren't there yet. Only missing DIDs are inserted, since every conflicting
+# insert would still use up an id. They're inserted in sorted order, so concurrent writers (firehose shards,
+# priming) wait on each other's new rows in the same order instead of deadlocking.
+def intern_actors(cur, dids) -> dict[str, int]:
+    dids = sorted(set(dids))
+    if len(dids) == 0:
+        return {}
+    ids = find_actors(cur, dids)
+    missing = [did for did in dids if did not in ids]
+    if len(missing) > 0:
+        cur.execute('INSERT INTO actors(did) SELECT unnest(%s::TEXT[]) ON CONFLICT (did) DO NOTHING RETURNING did, id', (missing, ))
+        ids.update(cur.fetchall())
+        # Added by another writer since we looked
+        raced = [did for did in missing if did not in ids]
+        if len(raced) > 0:
+            ids.update(find_actors(cur, raced))
+    return ids
+
+class ActorCache:
+    # LRU of DID -> actor id, so most writes don't have to look their actors up. Ids never change once assigned,
+    # but new ones are cached as soon as they're inserted, so commit a lookup before anything that could roll it back.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.ids: OrderedDict[str, int] = OrderedDict()
+
+    def lookup(self, cur, dids, create: bool) -> dict[str, int]:
+        found: dict[str, int] = {}
+        missing = []
+        for did in dids:
+            actor_id = self.ids.get(did)
+            if actor_id is None:
+                missing.append(did)
+            else:
+                self.ids.move_to_end(did)
+                found[did] = actor_id
+        if len(missing) > 0:
+            looked_up = intern_actors(cur, missing) if create else find_actors(cur, missing)
+            self.ids.update(looked_up)
+            found.update(looked_up)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+        return found